@@ -0,0 +1,123 @@
+"""Many simultaneous jobs against a slow stand-in FHIR server, run by the job
+workers (a thread per job) or by the AsyncEngine (tasks on one event loop).
+
+Every job is submitted at once.  Each fetches a small Patient $everything
+bundle and posts its clone back, the server taking ``latency`` to answer
+each request.  The server runs in a child process, so the threads counted
+are the engine's.  Reports jobs per second, the peak number of threads,
+peak RSS and the time from submitting to the last job done.
+
+Run from the project directory with ``python -m benchmarks.bench_async``;
+the arguments are the engine (threads or async), jobs, entries per bundle,
+server latency in ms, job workers (threads) and connections per server
+(async).
+"""
+
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+
+import cherrypy
+
+import py_de_id.pydeid
+from py_de_id import process_request
+from py_de_id.jobs import JobScheduler
+from py_de_id.scheduler import DeliveryScheduler
+from py_de_id.store import JobStore
+from benchmarks.bundles import everything
+from benchmarks.fhir_server import FhirServer
+
+
+def serve(bundles, latency, ports):
+    FhirServer.request_queue_size = 1024
+    server = FhirServer(latency, bundles=bundles)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+class ThreadCount(threading.Thread):
+    """Samples the number of threads of this process"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
+
+
+def main(engine="async", jobs=1000, entries=20, latency_ms=200, workers=8, connections=100):
+    jobs, entries, latency_ms, workers, connections = map(
+        int, (jobs, entries, latency_ms, workers, connections)
+    )
+    cherrypy.log.screen = False
+    bundles = {f"p{n}": everything(f"p{n}", entries, 1) for n in range(jobs)}
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(bundles, latency_ms / 1000, ports), daemon=True
+    )
+    server.start()
+    url = f"http://127.0.0.1:{ports.get()}/fhir/"
+
+    store = JobStore(":memory:")
+    scheduler = JobScheduler(workers, max_queued=jobs, max_per_tenant=jobs, store=store)
+    py_de_id.pydeid.job_store = store
+    py_de_id.pydeid.job_scheduler = scheduler
+    py_de_id.pydeid.delivery_scheduler = DeliveryScheduler(rate=10000, max_rate=10000)
+    if engine == "async":
+        from py_de_id.aio import AsyncEngine
+
+        async_engine = AsyncEngine(jobs, jobs, connections)
+        submit = async_engine.submit
+    else:
+        submit = lambda job_id, tenant: scheduler.submit(job_id, tenant, process_request, job_id)
+
+    print(
+        f"{engine}: {jobs} jobs of {entries} entries, {latency_ms}ms server latency,"
+        + (f" {connections} connections" if engine == "async" else f" {workers} workers")
+    )
+    for patient_id in bundles:
+        store.create(
+            patient_id,
+            "bench",
+            {
+                "source_token": "token",
+                "fhir_source": f"{url}Patient/{patient_id}/$everything",
+                "target_token": "token",
+                "fhir_target": url,
+                "deid": True,
+            },
+        )
+    threads = ThreadCount()
+    threads.start()
+    start = time.perf_counter()
+    for patient_id in bundles:
+        submit(patient_id, "bench")
+    submitted = time.perf_counter() - start
+    while True:
+        stats = scheduler.stats()
+        if not stats["queued"] and not stats["running"]:
+            break
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    threads.stopped.set()
+    if engine == "async":
+        async_engine.stop()
+    server.terminate()
+
+    failed = sum(store.status(patient_id)["status"] != "done" for patient_id in bundles)
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"submitted   : {submitted:8.2f} s")
+    print(f"all done    : {elapsed:8.2f} s ({failed} not done)")
+    print(f"jobs        : {jobs / elapsed:8.2f} /s")
+    print(f"threads     : {threads.peak:8d} at most")
+    print(f"peak RSS    : {peak:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,67 @@
+"""Bulk Data NDJSON ingest throughput, in GB/hour.
+
+Writes a synthetic $export - the resources of ``patients`` $everything
+bundles, one NDJSON file per resourceType, Observations gzipped - to a
+temporary directory and clones it to another, serially and with
+``processes`` processes.
+
+Run from the project directory with ``python -m benchmarks.bench_bulk``;
+the arguments are patients, entries per patient and processes.
+"""
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from py_de_id import codec
+from py_de_id.bulk import BulkIngest, export_files
+from py_de_id.rules import load_config
+from benchmarks.bundles import everything
+
+
+def write_export(directory, patients, entries):
+    files = {}
+    for n in range(patients):
+        for entry in everything(f"p{n}", entries):
+            resource = entry["resource"]
+            resource_type = resource["resourceType"]
+            if resource_type not in files:
+                name = f"{resource_type}.ndjson"
+                if resource_type == "Observation":
+                    files[resource_type] = gzip.open(os.path.join(directory, name + ".gz"), "wb", compresslevel=1)
+                else:
+                    files[resource_type] = open(os.path.join(directory, name), "wb")
+            files[resource_type].write(codec.dumps(resource) + b"\n")
+    for file in files.values():
+        file.close()
+
+
+def main(patients=50, entries=1000, processes=os.cpu_count()):
+    config = load_config("./assets/config.yaml")
+    export_dir = tempfile.mkdtemp()
+    output_dir = tempfile.mkdtemp()
+    try:
+        write_export(export_dir, patients, entries)
+        paths = export_files(export_dir)
+        size = sum(os.path.getsize(path) for path in paths)
+        print(f"{patients} patients of {entries} entries: {len(paths)} files, {size / 1e6:.1f} MB on disk")
+        for n in sorted({0, processes}):
+            start = time.perf_counter()
+            BulkIngest(config, n).write(paths, output_dir)
+            elapsed = time.perf_counter() - start
+            written = sum(os.path.getsize(path) for path in export_files(output_dir))
+            label = f"{n} processes" if n else "serial"
+            print(
+                f"{label:<12}: {elapsed:6.2f}s, {size / 1e9 / elapsed * 3600:6.2f} GB/hour read,"
+                f" {written / 1e9 / elapsed * 3600:6.2f} GB/hour written"
+            )
+    finally:
+        shutil.rmtree(export_dir)
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
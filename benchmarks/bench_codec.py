@@ -0,0 +1,43 @@
+"""Decoding and encoding a bundle with each JSON codec.
+
+Run from the project directory with ``python -m benchmarks.bench_codec``.
+``json via str`` is what the service did before: requests' ``.json()``
+decoding the body to str first, and ``json.dumps`` encoding to str.
+Decoding a large bundle is dominated by building the Python objects (and
+the garbage collector walking them), so it gains much less than encoding.
+"""
+
+import json
+import time
+
+from py_de_id.codec import CODECS, get_codec
+from benchmarks.bench_parallel import entries
+
+
+def measure(function, data, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(count=20000):
+    bundle = {"resourceType": "Bundle", "type": "searchset", "entry": entries(count)}
+    data = json.dumps(bundle).encode("utf-8")
+    size = len(data) / 1e6
+    print(f"{count} entries, {size:.1f} MB")
+
+    codecs = [("json via str", lambda data: json.loads(data.decode("utf-8")), lambda obj: json.dumps(obj).encode("utf-8"))]
+    for name in CODECS:
+        codec = get_codec(name)
+        codecs.append((name, codec.loads, codec.dumps))
+    for name, loads, dumps in codecs:
+        decode = measure(loads, data)
+        encode = measure(dumps, bundle)
+        print(f"{name:13}: decode {size / decode:7.1f} MB/s, encode {size / encode:7.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Transaction batches per second delivered to a local stand-in FHIR server.
+
+Compares a new connection per batch (bare requests.post, one at a time) with
+pooled sessions at increasing numbers of batches in flight.
+
+Run from the project directory with ``python -m benchmarks.bench_delivery``.
+"""
+
+import sys
+import time
+
+import cherrypy
+import requests
+
+import py_de_id.pydeid
+from py_de_id import deliver_batches
+from py_de_id.scheduler import DeliveryScheduler
+from benchmarks.fhir_server import FhirServer
+
+
+def batches(count, size=15):
+    return [
+        [
+            {
+                "resource": {"resourceType": "Observation", "id": f"{n}-{i}", "status": "final"},
+                "request": {"method": "POST", "url": "Observation"},
+            }
+            for i in range(size)
+        ]
+        for n in range(count)
+    ]
+
+
+def unpooled(url, data, work):
+    for batch in work:
+        requests.post(
+            url[:-1],
+            json={"resourceType": "Bundle", "type": "transaction", "entry": batch},
+            headers={"Authorization": "Bearer token", "Content-Type": "application/fhir+json"},
+        ).json()
+
+
+def main(count=200, latency_ms=5):
+    cherrypy.log.screen = False
+    with FhirServer(latency=latency_ms / 1000) as server:
+        data = {"target_token": "token", "fhir_target": server.url}
+        print(f"{count} batches of 15, {latency_ms}ms server latency")
+
+        start = time.perf_counter()
+        unpooled(server.url, data, batches(count))
+        elapsed = time.perf_counter() - start
+        print(f"unpooled    : {count / elapsed:8.1f} batches/s")
+
+        for concurrency in [1, 2, 4, 8, 16]:
+            data["concurrency"] = concurrency
+            # a fixed batch size and no rate limit, to measure the transport alone
+            py_de_id.pydeid.delivery_scheduler = DeliveryScheduler(
+                rate=1e6, max_rate=1e6, max_batch=15
+            )
+            start = time.perf_counter()
+            deliver_batches("bench", data, iter(batches(count)))
+            elapsed = time.perf_counter() - start
+            print(f"pooled x{concurrency:<3} : {count / elapsed:8.1f} batches/s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
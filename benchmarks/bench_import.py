@@ -0,0 +1,60 @@
+"""Time to import py_de_id.pydeid in a fresh interpreter.
+
+Each run imports the module in a new process (in an empty working
+directory, with PYDEID_INPUT_DIR pointing nowhere) and reports the median
+wall time, the time of the interpreter alone and whether the import
+created anything.  The modules taking longest are listed from
+``python -X importtime``.
+
+Run from the project directory with ``python -m benchmarks.bench_import``;
+the argument is the number of runs.
+"""
+
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed(code, cwd, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def main(runs=10):
+    work_dir = tempfile.mkdtemp()
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR, PYDEID_INPUT_DIR=os.path.join(work_dir, "input"))
+    try:
+        bare = statistics.median(timed("pass", work_dir, env) for _ in range(runs))
+        imported = statistics.median(timed("import py_de_id.pydeid", work_dir, env) for _ in range(runs))
+        created = os.listdir(work_dir)
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import py_de_id.pydeid"],
+            cwd=work_dir, env=env, check=True, capture_output=True, text=True,
+        )
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(f"interpreter         : {bare * 1000:7.1f} ms")
+    print(f"import pydeid       : {imported * 1000:7.1f} ms ({(imported - bare) * 1000:.1f} ms for the import)")
+    print(f"created on import   : {created or 'nothing'}")
+    rows = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, self_us, cumulative_us, name = line.replace(":", "|", 1).split("|")
+        name = name.strip()
+        # top-level packages, and the project's modules
+        if "." not in name or name.startswith("py_de_id."):
+            rows[name] = (int(cumulative_us) / 1000, int(self_us) / 1000)
+    print("slowest imports (cumulative ms, self ms):")
+    for name, (cumulative, own) in sorted(rows.items(), key=lambda row: -row[1][0])[:10]:
+        print(f"  {name:<24} {cumulative:7.1f} {own:7.1f}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,94 @@
+"""Whole jobs per second against a local stand-in FHIR server.
+
+Each job fetches a synthetic Patient $everything bundle in pages, clones and
+de-identifies it and posts it back as transactions, through the same job
+scheduler, store and delivery scheduler as the service.  The server can be
+slowed down and can answer a share of the transactions with 429.  Reports
+jobs and resources per second, peak RSS and the time spent per stage.
+
+Run from the project directory with ``python -m benchmarks.bench_jobs``;
+the arguments are patients, entries per bundle, nesting depth, job workers,
+server latency in ms and the percentage of transactions throttled.
+"""
+
+import resource
+import sys
+import time
+
+import cherrypy
+
+import py_de_id.pydeid
+from py_de_id import process_request
+from py_de_id.jobs import JobScheduler
+from py_de_id.metrics import RESOURCES, STAGE_SECONDS
+from py_de_id.scheduler import DeliveryScheduler
+from py_de_id.store import JobStore
+from benchmarks.bundles import everything
+from benchmarks.fhir_server import FhirServer
+
+
+def total(counter):
+    return sum(counter.collect().values())
+
+
+def stages():
+    """stage -> [count, seconds]"""
+    return {key[0]: [cell[-1], cell[-2]] for key, cell in STAGE_SECONDS.collect().items()}
+
+
+def main(patients=20, entries=500, depth=2, workers=4, latency_ms=5, throttle_percent=5):
+    cherrypy.log.screen = False
+    bundles = {f"p{n}": everything(f"p{n}", entries, depth) for n in range(patients)}
+    store = JobStore(":memory:")
+    scheduler = JobScheduler(workers, max_queued=patients, max_per_tenant=patients, store=store)
+    py_de_id.pydeid.job_store = store
+    py_de_id.pydeid.job_scheduler = scheduler
+    py_de_id.pydeid.delivery_scheduler = DeliveryScheduler(rate=1000, max_rate=1000)
+
+    server = FhirServer(latency_ms / 1000, bundles=bundles, throttle=throttle_percent / 100)
+    with server:
+        print(
+            f"{patients} patients of {entries} entries, depth {depth}, {workers} workers,"
+            f" {latency_ms}ms server latency, {throttle_percent}% throttled"
+        )
+        resources_before = total(RESOURCES)
+        stages_before = stages()
+        start = time.perf_counter()
+        for patient_id in bundles:
+            job_id = f"bench-{patient_id}"
+            store.create(
+                job_id,
+                "bench",
+                {
+                    "source_token": "token",
+                    "fhir_source": f"{server.url}Patient/{patient_id}/$everything",
+                    "target_token": "token",
+                    "fhir_target": server.url,
+                    "deid": True,
+                },
+            )
+            scheduler.submit(job_id, "bench", process_request, job_id)
+        while True:
+            stats = scheduler.stats()
+            if not stats["queued"] and not stats["running"]:
+                break
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+    failed = sum(store.status(f"bench-{p}")["status"] != "done" for p in bundles)
+    cloned = total(RESOURCES) - resources_before
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"jobs        : {patients / elapsed:8.2f} /s ({failed} not done)")
+    print(f"resources   : {cloned / elapsed:8.0f} /s")
+    print(f"peak RSS    : {peak:8.1f} MB")
+    for stage, (count, seconds) in sorted(stages().items()):
+        count -= stages_before.get(stage, [0, 0])[0]
+        seconds -= stages_before.get(stage, [0, 0])[1]
+        if count:
+            print(f"{stage:<12}: {count:6d} x {seconds / count * 1000:8.2f}ms = {seconds:7.2f}s")
+    print("server      : " + ", ".join(f"{k} {v}" for k, v in sorted(server.counts.items())))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,61 @@
+"""Entries per second cloned serially and across a pool of clone processes.
+
+Run from the project directory with ``python -m benchmarks.bench_parallel``.
+The speed-up is bounded by the number of cores of the machine.
+"""
+
+import os
+import sys
+import time
+
+from py_de_id.clone import ReferenceMap, clone_entry
+from py_de_id.parallel import ClonePool
+from py_de_id.rules import RulePlan, load_config
+from benchmarks.bench_rules import CONFIG, patient
+
+
+def entries(count):
+    result = []
+    for i in range(count):
+        resource = patient() if i % 10 == 0 else {
+            "resourceType": "Observation",
+            "id": f"o{i}",
+            "meta": {"versionId": "1"},
+            "status": "final",
+            "subject": {"reference": "Patient/example"},
+            "performer": [{"reference": f"Practitioner/{i % 7}"}],
+            "component": [{"code": {"text": "x"}, "valueQuantity": {"value": i}}] * 4,
+        }
+        if i % 10 == 0:
+            resource["id"] = f"p{i}"
+        result.append({"fullUrl": "url", "resource": resource, "search": {"mode": "match"}})
+    return result
+
+
+def main(count=50000):
+    config = load_config(CONFIG)
+    plan = RulePlan(config)
+    print(f"{count} entries, {os.cpu_count()} cores")
+
+    work = entries(count)
+    start = time.perf_counter()
+    referenceMap = ReferenceMap()
+    for entry in work:
+        clone_entry(entry, referenceMap, plan)
+    elapsed = time.perf_counter() - start
+    print(f"serial      : {count / elapsed:10.0f} entries/s")
+
+    for processes in [1, 2, 4, 8]:
+        pool = ClonePool(processes, config)
+        list(pool.clone(entries(processes * pool.shard_size), ReferenceMap(), True))  # warm up
+        work = entries(count)
+        start = time.perf_counter()
+        for _ in pool.clone(work, ReferenceMap(), True):
+            pass
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+        print(f"processes {processes}: {count / elapsed:10.0f} entries/s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,72 @@
+"""Per-resource cost of the Patient extension and address rules: merge
+expressions, as config.yaml had them, vs the equivalent path rules.
+
+Both plans are applied to the same Patients (bench_rules.patient, with
+``addresses`` addresses) and must give the same result: truncate keeps
+two characters of postalCode and appends 000, as v[:2]+"000" did.
+
+Run from the project directory with ``python -m benchmarks.bench_paths``;
+the arguments are the number of resources and of addresses per resource.
+"""
+
+import sys
+import timeit
+
+from py_de_id.rules import RulePlan
+from benchmarks.bench_rules import patient
+
+MERGE = [
+    {
+        "field": "extension",
+        "action": "merge",
+        "params": [
+            '[x for x in %input% if "mother" not in x["url"]]',
+            '[x for x in %input% if "birthPlace" not in x["url"]]',
+        ],
+    },
+    {
+        "field": "address",
+        "action": "merge",
+        "params": [
+            '[{k: v for k,v in addr.items() if k != "extension"} for addr in %input%]',
+            '[{k: v if k != "line" else ["101 Pleasant Street"] for k,v in addr.items()} for addr in %input%]',
+            '[{k: v if k != "postalCode" else v[:2]+"000" for k,v in addr.items()} for addr in %input%]',
+        ],
+    },
+]
+
+PATHS = [
+    {"field": "extension[url~mother]", "action": "erase"},
+    {"field": "extension[url~birthPlace]", "action": "erase"},
+    {"field": "address[*].extension", "action": "erase"},
+    {"field": "address[*].line", "action": "replace", "params": ["101 Pleasant Street"]},
+    {"field": "address[*].postalCode", "action": "truncate", "params": {"length": 2, "fill": "000"}},
+]
+
+
+def resource(addresses):
+    resource = patient()
+    resource["address"] = [dict(resource["address"][0]) for _ in range(addresses)]
+    return resource
+
+
+def measure(plan, number, addresses):
+    resources = [resource(addresses) for _ in range(number)]
+    it = iter(resources)
+    seconds = timeit.timeit(lambda: plan.apply(next(it)), number=number)
+    return seconds / number * 1e6
+
+
+def main(number=20000, addresses=2):
+    merge = RulePlan({"Patient": MERGE})
+    paths = RulePlan({"Patient": PATHS})
+    assert merge.apply(resource(addresses)) == paths.apply(resource(addresses))
+    before = measure(merge, number, addresses)
+    after = measure(paths, number, addresses)
+    print(f"Patient resources: {number}, {addresses} addresses each")
+    print(f"merge: {before:8.2f} us/resource")
+    print(f"paths: {after:8.2f} us/resource  ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
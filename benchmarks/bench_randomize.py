@@ -0,0 +1,61 @@
+"""Randomize rules applied resource by resource vs a column at a time.
+
+Observations carrying a date, a float and an int, each randomized, with
+and without seeds (as cloning seeds them).
+
+Run from the project directory with ``python -m benchmarks.bench_randomize``.
+"""
+
+import copy
+import sys
+import time
+
+from py_de_id.rules import RulePlan
+
+CONFIG = {
+    "Observation": [
+        {"field": "effectiveDate", "action": "randomize", "params": {"min": 15, "max": 15}},
+        {"field": "value", "action": "randomize", "params": {"min": 5, "max": 5}},
+        {"field": "count", "action": "randomize", "params": {"min": 2, "max": 2}},
+    ]
+}
+
+
+def observations(count):
+    return [
+        {
+            "resourceType": "Observation",
+            "id": str(n),
+            "effectiveDate": f"2020-{n % 12 + 1:02d}-{n % 28 + 1:02d}",
+            "value": n / 7,
+            "count": n,
+        }
+        for n in range(count)
+    ]
+
+
+def timed(function, resources):
+    resources = copy.deepcopy(resources)
+    start = time.perf_counter()
+    function(resources)
+    return time.perf_counter() - start
+
+
+def main(count=20000):
+    plan = RulePlan(CONFIG)
+    resources = observations(count)
+    seeds = [f"namespace:Observation/{n}" for n in range(count)]
+    print(f"{count} Observations, 3 randomized fields")
+    for name, seeded in [("unseeded", None), ("seeded", seeds)]:
+        if seeded:
+            serial = lambda rs: [plan.apply(r, s) for r, s in zip(rs, seeded)]
+        else:
+            serial = lambda rs: [plan.apply(r) for r in rs]
+        elapsed = timed(serial, resources)
+        print(f"{name:<9} per resource : {elapsed / count * 1e6:6.2f} us/resource")
+        elapsed = timed(lambda rs: plan.apply_many(rs, seeded), resources)
+        print(f"{name:<9} columns      : {elapsed / count * 1e6:6.2f} us/resource")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,119 @@
+"""Reference rewriting on a deeply nested synthetic bundle.
+
+Compares the recursive replace_reference clone_bundle used to run over every
+entry (dicts only, forward and reverse map) with indexing the references
+while cloning and rewriting them in one pass.
+
+Run from the project directory with ``python -m benchmarks.bench_references``.
+"""
+
+import sys
+import time
+from uuid import uuid1
+
+from py_de_id.clone import ReferenceMap, clone_entry, rewrite_references
+from py_de_id.placeholders import PlaceholderCache
+
+
+def replace_reference(obj, referenceMap):
+    # as it was in clone_bundle, without the logging and placeholders
+    if "reference" in obj and "/" in obj["reference"]:
+        ref = obj["reference"]
+        if ref in referenceMap:
+            obj["reference"] = f"{referenceMap[ref]}"
+            if "display" in obj:
+                obj["display"] = f"{referenceMap[ref]}"
+    for _, value in obj.items():
+        if isinstance(value, dict):
+            replace_reference(value, referenceMap)
+
+
+def replace_reference_lists(obj, referenceMap):
+    # the same, descending into lists too
+    if "reference" in obj and "/" in obj["reference"]:
+        ref = obj["reference"]
+        if ref in referenceMap:
+            obj["reference"] = f"{referenceMap[ref]}"
+            if "display" in obj:
+                obj["display"] = f"{referenceMap[ref]}"
+    for _, value in obj.items():
+        if isinstance(value, dict):
+            replace_reference_lists(value, referenceMap)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    replace_reference_lists(item, referenceMap)
+
+
+def legacy(entries, replace=replace_reference):
+    referenceMap = {}
+    for entry in entries:
+        resource = entry["resource"]
+        newResourceId = str(uuid1())
+        referenceMap[f'{resource["resourceType"]}/{resource["id"]}'] = f'{resource["resourceType"]}/{newResourceId}'
+        referenceMap[f'{resource["resourceType"]}/{newResourceId}'] = f'{resource["resourceType"]}/{resource["id"]}'
+        resource["id"] = newResourceId
+        entry.pop("search", None)
+        entry.pop("fullUrl", None)
+        entry["request"] = {"method": "POST", "url": resource["resourceType"]}
+    for entry in entries:
+        replace(entry, referenceMap)
+
+
+def indexed(entries):
+    referenceMap = ReferenceMap()
+    index = []
+    for entry in entries:
+        clone_entry(entry, referenceMap, index=index)
+    rewrite_references(index, referenceMap, PlaceholderCache().resolver(None))
+    return len(index)
+
+
+def nested(depth, i):
+    node = {"reference": f"Observation/o{(i * 7) % 1000}", "display": "x"}
+    for level in range(depth):
+        node = {"linkId": str(level), "item": [node, {"answer": [{"valueReference": {"reference": f"Patient/p{i % 10}"}}]}]}
+    return node
+
+
+def bundle(count, depth):
+    entries = []
+    for i in range(count):
+        entries.append(
+            {
+                "fullUrl": "url",
+                "search": {"mode": "match"},
+                "resource": {
+                    "resourceType": "Observation" if i < 1000 else "QuestionnaireResponse",
+                    "id": f"o{i}",
+                    "subject": {"reference": f"Patient/p{i % 10}"},
+                    "encounter": {"reference": f"Encounter/e{i % 50}"},
+                    "performer": [{"reference": f"Practitioner/d{i % 5}"}],
+                    "item": [nested(depth, i)],
+                },
+            }
+        )
+    return entries
+
+
+def main(count=5000, depth=8):
+    print(f"{count} entries nested {depth} deep")
+    entries = bundle(count, depth)
+    start = time.perf_counter()
+    legacy(entries)
+    before = time.perf_counter() - start
+    entries = bundle(count, depth)
+    start = time.perf_counter()
+    legacy(entries, replace_reference_lists)
+    lists = time.perf_counter() - start
+    entries = bundle(count, depth)
+    start = time.perf_counter()
+    references = indexed(entries)
+    after = time.perf_counter() - start
+    print(f"recursive, dicts only (misses the refs in lists): {before * 1000:8.1f} ms")
+    print(f"recursive, dicts and lists:                       {lists * 1000:8.1f} ms")
+    print(f"indexed, one pass:                                {after * 1000:8.1f} ms  ({references} refs)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,92 @@
+"""Per-resource cost of applying config.yaml: interpreted rules vs the compiled RulePlan.
+
+Run from the project directory with ``python -m benchmarks.bench_rules``.
+"""
+
+import os
+import sys
+import timeit
+
+from py_de_id.paths import is_path
+from py_de_id.rules import RulePlan, load_config, randomize
+
+CONFIG = os.path.join(os.path.dirname(__file__), "..", "assets", "config.yaml")
+
+
+def interpreted(config, resource):
+    # The rule interpreter deidentify_fhir_resource used before the RulePlan (minus logging)
+    del resource["meta"]
+    if resource["resourceType"] in config:
+        for key in ["*", resource["resourceType"]]:
+            for rule in config[key]:
+                if rule["field"] in resource:
+                    if rule["action"] == "erase":
+                        del resource[rule["field"]]
+                    elif rule["action"] == "replace":
+                        resource[rule["field"]] = rule["params"]
+                    elif rule["action"] == "randomize":
+                        resource[rule["field"]] = randomize(
+                            rule["field"], resource[rule["field"]], rule["params"]
+                        )
+                    elif rule["action"] == "merge":
+                        input = resource[rule["field"]]
+                        for item in rule["params"]:
+                            try:
+                                input = eval(item.replace("%input%", "input"))
+                            except Exception:
+                                pass
+                        resource[rule["field"]] = input
+    return resource
+
+
+def patient():
+    address = {
+        "use": "home",
+        "line": ["1 Main Street", "Apt 2"],
+        "city": "Springfield",
+        "state": "MA",
+        "postalCode": "01101",
+        "extension": [{"url": "http://hl7.org/fhir/StructureDefinition/geolocation"}],
+    }
+    return {
+        "resourceType": "Patient",
+        "id": "example",
+        "meta": {"versionId": "1"},
+        "identifier": [{"system": "urn:mrn", "value": "12345"}],
+        "name": [{"family": "Doe", "given": ["Jane"]}],
+        "telecom": [{"system": "phone", "value": "555-0100"}],
+        "gender": "female",
+        "birthDate": "1970-06-15",
+        "address": [dict(address), dict(address)],
+        "extension": [
+            {"url": "http://hl7.org/fhir/StructureDefinition/patient-mothersMaidenName"},
+            {"url": "http://hl7.org/fhir/StructureDefinition/patient-birthPlace"},
+            {"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race"},
+        ],
+    }
+
+
+def measure(apply, number):
+    resources = [patient() for _ in range(number)]
+    it = iter(resources)
+    seconds = timeit.timeit(lambda: apply(next(it)), number=number)
+    return seconds / number * 1e6
+
+
+def main(number=20000):
+    from benchmarks.bench_paths import MERGE
+
+    config = load_config(CONFIG)
+    # the interpreter has no path rules, so both get the merge rules they replaced
+    config["Patient"] = [rule for rule in config["Patient"] if not is_path(rule["field"])] + MERGE
+    plan = RulePlan(config)
+    assert interpreted(config, patient()).keys() == plan.apply(patient()).keys()
+    before = measure(lambda r: interpreted(config, r), number)
+    after = measure(plan.apply, number)
+    print(f"Patient resources: {number}")
+    print(f"interpreted: {before:8.2f} us/resource")
+    print(f"compiled:    {after:8.2f} us/resource  ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
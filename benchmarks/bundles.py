@@ -0,0 +1,82 @@
+"""Synthetic Patient $everything bundles for benchmarks.
+
+Every bundle has a Patient, a few Encounters, Practitioners and a Location,
+and clinical resources referring to them.  ``depth`` nests components
+inside the clinical resources and ``density`` is the chance of each
+component (and resource) carrying an extra reference.  Some references
+point at an Organization and Practitioners that are not in the bundle, so
+placeholders are needed too.
+"""
+
+import random
+
+from benchmarks.bench_rules import patient
+
+CLINICAL_TYPES = ["Observation", "Condition", "Procedure", "MedicationRequest", "DiagnosticReport", "Immunization"]
+
+
+def nested(rng, depth, references, density):
+    node = {
+        "code": {"coding": [{"system": "http://loinc.org", "code": f"{rng.randint(1000, 99999)}-{rng.randint(0, 9)}"}]},
+        "valueQuantity": {"value": round(rng.uniform(0, 200), 1), "unit": "mg/dL"},
+    }
+    if rng.random() < density:
+        node["derivedFrom"] = [{"reference": rng.choice(references), "display": "source"}]
+    if depth > 1:
+        node["component"] = [nested(rng, depth - 1, references, density) for _ in range(2)]
+    return node
+
+
+def everything(patient_id, count=200, depth=2, density=0.5, seed=None):
+    """The entries of a $everything bundle of ``count`` resources"""
+    rng = random.Random(patient_id if seed is None else seed)
+
+    resource = patient()
+    resource["id"] = patient_id
+    resources = [resource]
+    for i in range(2):
+        resources.append({"resourceType": "Practitioner", "id": f"pr-{patient_id}-{i}", "name": [{"family": f"Doctor{i}"}]})
+    resources.append({"resourceType": "Location", "id": f"loc-{patient_id}", "name": "Ward 7"})
+    encounters = [f"enc-{patient_id}-{i}" for i in range(max(1, count // 20))]
+    for encounter in encounters:
+        resources.append(
+            {
+                "resourceType": "Encounter",
+                "id": encounter,
+                "status": "finished",
+                "subject": {"reference": f"Patient/{patient_id}"},
+                "participant": [{"individual": {"reference": f"Practitioner/pr-{patient_id}-{rng.randint(0, 1)}"}}],
+                "location": [{"location": {"reference": f"Location/loc-{patient_id}"}}],
+                "serviceProvider": {"reference": "Organization/hospital"},
+            }
+        )
+
+    performers = [f"Practitioner/pr-{patient_id}-0", f"Practitioner/pr-{patient_id}-1", "Practitioner/visiting", "Organization/hospital"]
+    clinical = []
+    recent = []
+    while len(resources) + len(clinical) < count:
+        resource_type = rng.choice(CLINICAL_TYPES)
+        resource = {
+            "resourceType": resource_type,
+            "id": f"{resource_type.lower()}-{patient_id}-{len(clinical)}",
+            "meta": {"versionId": "1", "lastUpdated": "2024-01-01T00:00:00Z"},
+            "status": "final",
+            "subject": {"reference": f"Patient/{patient_id}"},
+            "encounter": {"reference": f"Encounter/{rng.choice(encounters)}"},
+            "component": [nested(rng, depth, performers + recent[-5:], density)],
+        }
+        if rng.random() < density:
+            resource["performer"] = [{"reference": rng.choice(performers)}]
+        clinical.append(resource)
+        recent.append(f"{resource_type}/{resource['id']}")
+
+    entries = []
+    for resource in resources + clinical:
+        entries.append(
+            {
+                "fullUrl": f"http://source/fhir/{resource['resourceType']}/{resource['id']}",
+                "resource": resource,
+                "search": {"mode": "match"},
+            }
+        )
+    return entries
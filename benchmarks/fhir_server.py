@@ -0,0 +1,131 @@
+"""A stand-in FHIR server on localhost for benchmarks.
+
+It accepts transaction bundles on the base url and answers every entry with
+201 Created after an optional delay, over keep-alive HTTP/1.1 connections.
+Given a throttle fraction it answers that share of the transactions with
+429 and a Retry-After instead.  It serves Patient/:id/$everything, in
+pages, from the bundles it is given.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from uuid import uuid4
+
+
+class FhirHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = parts.path.strip("/").split("/")
+        entries = None
+        if len(path) == 4 and path[1] == "Patient" and path[3] == "$everything":
+            entries = self.server.bundles.get(path[2])
+        if entries is None:
+            self.send_json(404, {"resourceType": "OperationOutcome"})
+            return
+        time.sleep(self.server.latency)
+        page = int(parse_qs(parts.query).get("_page", ["0"])[0])
+        size = self.server.page_size
+        self.server.count("pages")
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(entries),
+            "link": [{"relation": "self", "url": self.server.base + self.path.lstrip("/")}],
+            "entry": entries[page * size : (page + 1) * size],
+        }
+        if (page + 1) * size < len(entries):
+            bundle["link"].append(
+                {"relation": "next", "url": f"{self.server.base}{parts.path.lstrip('/')}?_page={page + 1}"}
+            )
+        self.send_json(200, bundle)
+
+    def do_POST(self):
+        bundle = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.latency)
+        if self.server.throttled():
+            self.server.count("throttled")
+            self.send_response(429)
+            self.send_header("Retry-After", str(self.server.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.server.count("batches")
+        self.server.count("resources", len(bundle.get("entry", [])))
+        entries = []
+        for entry in bundle.get("entry", []):
+            resource_type = entry["request"]["url"]
+            entries.append(
+                {"response": {"status": 201, "location": f"{resource_type}/{uuid4()}"}}
+            )
+        self.send_json(
+            200,
+            {"resourceType": "Bundle", "type": "transaction-response", "entry": entries},
+        )
+
+
+class FhirServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        latency=0.0,
+        handler=FhirHandler,
+        bundles=None,
+        page_size=100,
+        throttle=0.0,
+        retry_after=0.05,
+    ):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.bundles = bundles or {}
+        self.page_size = page_size
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.counts = {}
+        self._posts = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def throttled(self):
+        """Whether to answer this transaction with 429 - spread evenly over the posts"""
+        with self._lock:
+            self._posts += 1
+            return int(self._posts * self.throttle) > int((self._posts - 1) * self.throttle)
+
+    @property
+    def base(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    @property
+    def url(self):
+        return f"{self.base}fhir/"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -1,10 +1,24 @@
 from .pydeid import (
-    randomize,
     base_dir,
-    config,
     deidentify_fhir_resource,
+    deliver_batches,
+    post_batch,
     deliver_clone,
     clone_bundle,
     process_request,
     Deidentifier,
+    stream_clone,
+    stream_deidentify,
 )
+from .rules import RulePlan, compile_rules, load_config, randomize
+from .sessions import SessionPool, session_pool
+from .scheduler import DeliveryScheduler, TargetLimiter, delivery_scheduler
+from .placeholders import PlaceholderCache, placeholder_cache
+from .store import JobStore
+
+
+def __getattr__(name):
+    # the rules are read the first time they are asked for, not on import
+    if name in ("config", "rule_plan"):
+        return getattr(pydeid, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,404 @@
+"""Run jobs as tasks on one asyncio event loop instead of a thread each.
+
+A job spends nearly all its time waiting on FHIR servers: for the pages of
+$everything, for every transaction it posts, and while its target is
+throttling it.  The AsyncEngine waits on all of them from a single event
+loop in its own thread, so a waiting job costs a few tasks rather than a
+worker thread plus the threads fetching and cloning ahead of it.  Parsing
+and cloning are CPU work and run on a few threads (or the clone
+processes), never on the loop.
+
+Chosen with PYDEID_ENGINE=async (see pydeid.submit_job).  Needs aiohttp
+(``pip install py-de-id[async]``).
+"""
+
+import asyncio
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from itertools import islice
+
+import aiohttp
+import cherrypy
+import requests
+
+from . import codec, pydeid
+from .jobs import DELIVERING, FETCHING, JobQueueFull
+from .logs import debug, redacted
+from .metrics import BYTES, THROTTLED
+from .placeholders import placeholder_cache
+from .planner import Planner, plan_levels
+from .sessions import base_url
+from .store import entry_key
+from .stream import CHUNK_SIZE
+from .tracing import observe_stage, tracer
+
+
+class AsyncEngine(object):
+    """Fetches, clones and delivers jobs from an event loop in a thread of its own.
+
+    At most ``max_jobs`` jobs run at once, and at most ``max_per_tenant``
+    of them for one tenant.  submit() raises JobQueueFull beyond either
+    limit; nothing is queued.  Whatever jobs they belong to, at most
+    ``connections`` requests are in flight to a server (a FHIR base url)
+    at once.  Delivery is paced by the target's TargetLimiter, the one the
+    worker threads use too, and waiting for it never blocks the loop.  A
+    job's pages are parsed and cloned on one of ``clone_threads`` threads.
+
+    Jobs are recorded with the JobScheduler, so their status is polled and
+    drain() waits for them just as it does for the workers' jobs.  A job's
+    clone is never stored: a job that was interrupted is cloned again when
+    it resumes, getting the same ids, and posts only what the target has
+    not acknowledged.  Delta and cohort jobs, and jobs resuming delivery of
+    a clone the workers stored, are run by process_request on a thread.
+    """
+
+    def __init__(
+        self, max_jobs=1000, max_per_tenant=1000, connections=32, clone_threads=2, max_idle=32
+    ):
+        self.max_jobs = max_jobs
+        self.max_per_tenant = max_per_tenant
+        self.connections = connections
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._running = set()
+        self._tenants = Counter()
+        self._loop = None
+        self._thread = None
+        self._clone = ThreadPoolExecutor(clone_threads, thread_name_prefix="async-clone")
+        # job store calls block on SQLite, so they are made from this one thread
+        self._store = ThreadPoolExecutor(1, thread_name_prefix="async-store")
+        # touched only on the loop
+        self._sessions = OrderedDict()
+        self._users = {}
+        self._limits = {}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="async-engine", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Close the sessions and stop the loop (drain the jobs first)"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def submit(self, job_id, tenant):
+        """Start a job stored in the job store"""
+        self.start()
+        with self._lock:
+            if len(self._running) >= self.max_jobs:
+                raise JobQueueFull(f"There are already {len(self._running)} jobs running")
+            if self._tenants[tenant] >= self.max_per_tenant:
+                raise JobQueueFull(
+                    f"{tenant} already has {self._tenants[tenant]} jobs running", tenant=True
+                )
+            pydeid.job_scheduler.begin(job_id, tenant)
+            self._running.add(job_id)
+            self._tenants[tenant] += 1
+            asyncio.run_coroutine_threadsafe(self._run(job_id, tenant), self._loop)
+
+    def saturation(self):
+        """How full the engine is, from 0 to 1"""
+        with self._lock:
+            return len(self._running) / self.max_jobs
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": len(self._running),
+                "max_jobs": self.max_jobs,
+                "tenants": dict(self._tenants),
+            }
+
+    def _io(self, function, *args):
+        """Call function on the job store's thread"""
+        return self._loop.run_in_executor(self._store, function, *args)
+
+    async def _run(self, job_id, tenant):
+        start = time.perf_counter()
+        error = None
+        try:
+            await self._process(job_id)
+        except (requests.exceptions.RequestException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            cherrypy.log(
+                f"{job_id}: An error occurred during the request for job {job_id}: {e}"
+            )
+            error = str(e) or type(e).__name__
+        except Exception as e:
+            cherrypy.log(f"{job_id}: Job failed: {e}", traceback=True)
+            error = str(e)
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+                self._tenants[tenant] -= 1
+                if not self._tenants[tenant]:
+                    del self._tenants[tenant]
+            await self._io(pydeid.job_scheduler.finish, job_id, start, error)
+
+    async def _process(self, job_id):
+        """Fetch, clone and deliver a job (see process_request), a task for each"""
+        job = await self._io(pydeid.job_store.job, job_id)
+        data = job["data"]
+        if job["cloned"] or data.get("delta") or data.get("patients"):
+            await self._loop.run_in_executor(None, pydeid.process_request, job_id)
+            return
+
+        await self._io(pydeid.job_scheduler.update, job_id, FETCHING)
+        plan = pydeid.plan_manager.plan
+        pydeid.job_scheduler.report(job_id, rules=plan.version)
+        debug("%s: loaded %s", job_id, redacted(data))
+        delivered = await self._io(pydeid.job_store.delivered, job_id)
+        if delivered:
+            cherrypy.log(f"{job_id}: {len(delivered)} resources were already delivered")
+        await self._io(pydeid.job_store.restart, job_id)
+        cloner = await self._loop.run_in_executor(
+            self._clone,
+            lambda: pydeid.Cloner(job_id, data, namespace=job["namespace"], plan=plan),
+        )
+
+        # page N+1 is fetched while page N is cloned and batches are posted
+        pages = asyncio.Queue(pydeid.PAGE_QUEUE_SIZE)
+        batches = asyncio.Queue(pydeid.BATCH_QUEUE_SIZE)
+        tasks = [
+            asyncio.create_task(self._fetch_pages(job_id, data, pages)),
+            asyncio.create_task(self._clone_pages(job_id, cloner, delivered, pages, batches)),
+            asyncio.create_task(self._deliver_batches(job_id, data, batches, delivered)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        cherrypy.log(f"{job_id}: The clone was delivered")
+        await self._io(pydeid.remove_job, job_id)
+
+    @asynccontextmanager
+    async def _session(self, url, token):
+        """A session shared per FHIR base url and token, as in SessionPool"""
+        key = (base_url(url), token)
+        if key not in self._sessions:
+            self._sessions[key] = aiohttp.ClientSession(
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=aiohttp.ClientTimeout(total=None),
+            )
+            self._users[key] = 0
+        self._users[key] += 1
+        try:
+            yield self._sessions[key]
+        finally:
+            self._users[key] -= 1
+            self._sessions.move_to_end(key)
+            idle = [key for key in self._sessions if not self._users[key]]
+            for key in idle[: max(0, len(idle) - self.max_idle)]:
+                del self._users[key]
+                await self._sessions.pop(key).close()
+
+    async def _close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+        self._users.clear()
+
+    def _limit(self, url):
+        """The semaphore bounding the requests in flight to url's server"""
+        key = base_url(url)
+        if key not in self._limits:
+            self._limits[key] = asyncio.Semaphore(self.connections)
+        return self._limits[key]
+
+    async def _fetch_pages(self, job_id, data, pages):
+        """Queue the parsed pages of $everything, following the next links"""
+        headers = {"Content-Type": "application/json"}
+        url = data["fhir_source"]
+        page_no = 0
+        async with self._session(url, data["source_token"]) as session:
+            while url:
+                page_no += 1
+                debug("%s: Getting page %d of $everything from %s", job_id, page_no, url)
+                start = time.perf_counter()
+                async with self._limit(url), session.get(url, headers=headers) as response:
+                    debug("%s: Got %s", job_id, response.status)
+                    if response.status != 200:
+                        cherrypy.log(
+                            f"{job_id}: Request failed with status code: {response.status}"
+                        )
+                        cherrypy.log(f"Response Text: {await response.text()}")
+                        raise requests.exceptions.HTTPError(f"{response.status} for page {page_no}")
+                    chunks = await self._read(job_id, response, page_no)
+                page, url = await self._loop.run_in_executor(
+                    self._clone, pydeid.read_page, job_id, chunks, page_no
+                )
+                observe_stage(job_id, "fetch", time.perf_counter() - start, page=page_no)
+                await pages.put(page)
+        await pages.put(None)
+
+    async def _read(self, job_id, response, page_no):
+        """The chunks of a response, kept in memory up to SPILL_BYTES and spooled
+        to a temporary file beyond that; read_page parses them"""
+        body = []
+        size = 0
+        spool = None
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            if spool is not None:
+                spool.write(chunk)
+                continue
+            body.append(chunk)
+            if size > pydeid.SPILL_BYTES:
+                spool = tempfile.TemporaryFile()
+                spool.writelines(body)
+                body = None
+        BYTES.inc(size, ("fetched",))
+        if spool is None:
+            chunks = iter(body)
+        else:
+            spool.seek(0)
+            chunks = pydeid.spooled(spool)
+        if pydeid.DEBUG_COPIES:
+            chunks = pydeid.teed(chunks, pydeid.debug_copy(job_id, f"page-{page_no}.json", "wb"))
+        return chunks
+
+    async def _clone_pages(self, job_id, cloner, delivered, pages, batches):
+        """Clone the queued pages on a clone thread, queueing the batches to deliver"""
+        while True:
+            page = await pages.get()
+            if page is None:
+                break
+            await self._hand_over(job_id, cloner.add(page), delivered, batches)
+        await self._hand_over(job_id, cloner.finish(), delivered, batches)
+        await batches.put(None)
+
+    async def _hand_over(self, job_id, cloned, delivered, batches):
+        done = False
+        while not done:
+            ready, done = await self._loop.run_in_executor(
+                self._clone, self._take, job_id, cloned, delivered
+            )
+            for batch in ready:
+                await batches.put(batch)
+
+    def _take(self, job_id, cloned, delivered):
+        """The next BATCH_QUEUE_SIZE batches of cloned (run on a clone thread),
+        without the entries already delivered, and whether that was the last"""
+        taken = list(islice(cloned, pydeid.BATCH_QUEUE_SIZE))
+        ready = []
+        for batch in taken:
+            batch = [entry for entry in batch if entry_key(entry) not in delivered]
+            if not batch:
+                continue
+            if pydeid.DEBUG_COPIES:
+                with pydeid.debug_copy(job_id, "clone.ndjson") as file:
+                    file.writelines(codec.dumps(entry) + b"\n" for entry in batch)
+            ready.append(batch)
+        return ready, len(taken) < pydeid.BATCH_QUEUE_SIZE
+
+    async def _deliver_batches(self, job_id, data, batches, delivered):
+        """POST the queued entries as deliver_batches does: planned into levels
+        as they become ready, the batches of a level up to data["concurrency"]
+        at once"""
+        url = data["fhir_target"][:-1]
+        concurrency = int(data.get("concurrency", pydeid.DELIVERY_CONCURRENCY))
+        limiter = pydeid.delivery_scheduler.target(url)
+        planner = Planner(delivered | placeholder_cache.references(url), pydeid.PLAN_PENDING)
+        ready = []
+        batch_no = 0
+        done = False
+        async with self._session(url, data["target_token"]) as session:
+            while not done:
+                batch = await batches.get()
+                done = batch is None
+                release = (planner.flush,) if done else (planner.add, batch)
+                ready.extend(await self._loop.run_in_executor(self._clone, *release))
+                if not ready or not (done or len(ready) >= concurrency * limiter.batch_size):
+                    continue
+                levels = await self._loop.run_in_executor(
+                    self._clone, plan_levels, ready, limiter.batch_size
+                )
+                ready = []
+                if not batch_no:
+                    await self._io(pydeid.job_scheduler.update, job_id, DELIVERING)
+                for level in levels:
+                    await self._post_level(job_id, session, url, limiter, batch_no, level, concurrency)
+                    batch_no += len(level)
+
+    async def _post_level(self, job_id, session, url, limiter, batch_no, level, concurrency):
+        """POST the batches of a level, up to concurrency at once"""
+        slots = asyncio.Semaphore(concurrency)
+
+        async def post(n, batch):
+            async with slots:
+                await self._post(job_id, session, url, limiter, batch_no + n, batch)
+
+        tasks = [asyncio.create_task(post(n, batch)) for n, batch in enumerate(level)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _post(self, job_id, session, url, limiter, batch_no, batch):
+        """POST a batch as deliver_batches does, waiting on the loop while the target is throttled"""
+        headers = {"Content-Type": "application/fhir+json"}
+        failures = throttles = 0
+        while True:
+            start = time.monotonic()
+            wait = limiter.reserve()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = limiter.reserve()
+            tracer.span(job_id, "pacing", time.monotonic() - start, batch=batch_no + 1)
+            debug(
+                "%s: Sending batch %d of %d resources to %s", job_id, batch_no + 1, len(batch), url
+            )
+            locations = []
+            async with self._limit(url):
+                start = time.monotonic()
+                async with session.post(
+                    url, data=pydeid.transaction_body(batch), headers=headers
+                ) as response:
+                    content = await response.read()
+                latency = time.monotonic() - start
+            status, delay = pydeid.batch_status(
+                job_id, response.status, response.headers, content, locations
+            )
+            observe_stage(
+                job_id, "deliver", latency, batch=batch_no + 1, entries=len(batch), status=status
+            )
+            if status == 200:
+                limiter.succeeded(latency)
+                await self._io(pydeid.job_store.acknowledge, job_id, batch)
+                placeholder_cache.acknowledge(url, batch)
+                return
+            if status == 429:
+                cherrypy.log(f"{job_id}: Too many requests. Throttling {delay}s")
+                THROTTLED.inc(labels=(url,))
+                limiter.throttled(delay)
+                throttles += 1
+                if throttles < pydeid.MAX_THROTTLED:
+                    continue
+                raise requests.exceptions.HTTPError(
+                    f"Batch {batch_no + 1} was throttled {throttles} times"
+                )
+            cherrypy.log(f"{job_id}: Batch {batch_no + 1} failed with {status}")
+            failures += 1
+            if failures == 2:
+                raise requests.exceptions.HTTPError(
+                    f"Batch {batch_no + 1} failed twice, last status {status}"
+                )
+            cherrypy.log(f"{job_id}: Retrying batch {batch_no + 1}")
@@ -0,0 +1,225 @@
+"""De-identify a FHIR Bulk Data $export: a directory of NDJSON files, one
+resourceType per file, possibly gzipped.
+
+    python -m py_de_id.bulk EXPORT_DIR OUTPUT_DIR [--processes N] [--no-deid]
+    python -m py_de_id.bulk EXPORT_DIR --fhir-target URL --target-token TOKEN
+"""
+
+import argparse
+import gzip
+import mmap
+import os
+import sys
+import time
+from uuid import uuid4
+
+import cherrypy
+
+from . import codec
+from .clone import ReferenceMap, clone_entry, deidentify_entries
+from .metrics import RESOURCES
+from .parallel import in_order, process_pool, worker_plan
+from .rules import RulePlan, load_config
+
+# Bytes of NDJSON de-identified at a time, by one process
+BULK_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def export_files(directory):
+    """The .ndjson and .ndjson.gz files of an export, in name order"""
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.endswith((".ndjson", ".ndjson.gz"))
+    ]
+
+
+def line_ranges(path, chunk_size=BULK_CHUNK_SIZE):
+    """(start, end) of the line-aligned chunks of an uncompressed file"""
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            ranges = []
+            start = 0
+            while start < len(data):
+                end = data.find(b"\n", start + chunk_size)
+                end = len(data) if end == -1 else end + 1
+                ranges.append((start, end))
+                start = end
+            return ranges
+
+
+def line_blocks(path, chunk_size=BULK_CHUNK_SIZE):
+    """Line-aligned blocks of a gzipped file"""
+    with gzip.open(path, "rb") as file:
+        while True:
+            block = file.read(chunk_size)
+            if not block:
+                return
+            yield block + file.readline()
+
+
+def clone_lines(data, referenceMap, plan=None):
+    """De-identify (given a rule plan) and re-key NDJSON resources.
+
+    Returns the clone as NDJSON and the number of resources per
+    resourceType.  Ids are minted from referenceMap's namespace, so chunks
+    cloned apart - in other processes - refer to each other correctly.
+    Resources without an id cannot be cloned and are left out.
+    """
+    entries = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        resource = codec.loads(line)
+        if "id" not in resource:
+            cherrypy.log(f"Dropped a {resource.get('resourceType')} without an id")
+            continue
+        entries.append({"resource": resource})
+    if plan:
+        deidentify_entries(entries, referenceMap, plan)
+    lines = []
+    counts = {}
+    for entry in entries:
+        clone_entry(entry, referenceMap)
+        resource = entry["resource"]
+        counts[resource["resourceType"]] = counts.get(resource["resourceType"], 0) + 1
+        lines.append(codec.dumps(resource))
+    lines.append(b"")
+    return b"\n".join(lines), counts
+
+
+def _clone_range(path, start, end, namespace, deid):
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return clone_lines(data[start:end], ReferenceMap(namespace), worker_plan() if deid else None)
+
+
+def _clone_block(block, namespace, deid):
+    return clone_lines(block, ReferenceMap(namespace), worker_plan() if deid else None)
+
+
+class BulkIngest(object):
+    """Clones the files of a Bulk Data export across ``processes`` processes.
+
+    Uncompressed files are memory-mapped and split into line-aligned chunks
+    that each worker maps and reads itself; gzipped files are decompressed
+    here and their blocks handed over.  Every chunk's clone ids are minted
+    from the same namespace, so references are re-keyed across the whole
+    export.  A reference to a resource that is not in the export points at
+    an id that does not exist.  With no processes everything is cloned on
+    the calling thread.
+    """
+
+    def __init__(self, config, processes=0, deid=True, namespace=None, chunk_size=BULK_CHUNK_SIZE):
+        self.config = config
+        self.processes = processes
+        self.deid = deid
+        self.namespace = namespace or uuid4()
+        self.chunk_size = chunk_size
+        self.plan = RulePlan(config) if deid else None
+
+    def _tasks(self, paths):
+        for path in paths:
+            if path.endswith(".gz"):
+                for block in line_blocks(path, self.chunk_size):
+                    yield path, _clone_block, (block, self.namespace, self.deid)
+            else:
+                for start, end in line_ranges(path, self.chunk_size):
+                    yield path, _clone_range, (path, start, end, self.namespace, self.deid)
+
+    def _serial(self, path):
+        referenceMap = ReferenceMap(self.namespace)
+        if path.endswith(".gz"):
+            for block in line_blocks(path, self.chunk_size):
+                yield clone_lines(block, referenceMap, self.plan)
+            return
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for start, end in line_ranges(path, self.chunk_size):
+                    yield clone_lines(data[start:end], referenceMap, self.plan)
+
+    def clone(self, paths):
+        """Yield (path, NDJSON) for every chunk of every file, in order"""
+        if not self.processes:
+            for path in paths:
+                for data, counts in self._serial(path):
+                    self._count(counts)
+                    yield path, data
+            return
+
+        with process_pool(self.processes, self.config) as executor:
+            for path, (data, counts) in in_order(executor, self._tasks(paths), 2 * self.processes):
+                self._count(counts)
+                yield path, data
+
+    def _count(self, counts):
+        for resource_type, count in counts.items():
+            RESOURCES.inc(count, (resource_type,))
+
+    def write(self, paths, output_dir):
+        """Write the clone of every file to output_dir, uncompressed, under the same name"""
+        os.makedirs(output_dir, exist_ok=True)
+        outputs = {}
+        try:
+            for path, data in self.clone(paths):
+                if path not in outputs:
+                    name = os.path.basename(path)
+                    if name.endswith(".gz"):
+                        name = name[:-3]
+                    outputs[path] = open(os.path.join(output_dir, name), "wb")
+                outputs[path].write(data)
+        finally:
+            for file in outputs.values():
+                file.close()
+
+    def batches(self, paths):
+        """Yield the clone as lists of transaction entries, for deliver_batches"""
+        for _, data in self.clone(paths):
+            batch = []
+            for line in data.splitlines():
+                resource = codec.loads(line)
+                batch.append(
+                    {"resource": resource, "request": {"method": "POST", "url": resource["resourceType"]}}
+                )
+            yield batch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("export_dir")
+    parser.add_argument("output_dir", nargs="?", help="write the clone here as NDJSON")
+    parser.add_argument("--fhir-target", help="deliver the clone to this FHIR server instead")
+    parser.add_argument("--target-token")
+    parser.add_argument("--config", default="./assets/config.yaml")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--no-deid", action="store_true", help="only re-key")
+    args = parser.parse_args(argv)
+    if not args.output_dir and not args.fhir_target:
+        parser.error("give an output directory or --fhir-target")
+
+    ingest = BulkIngest(load_config(args.config), args.processes, not args.no_deid)
+    paths = export_files(args.export_dir)
+    size = sum(os.path.getsize(path) for path in paths)
+    start = time.perf_counter()
+    if args.output_dir:
+        ingest.write(paths, args.output_dir)
+    else:
+        from .pydeid import deliver_batches
+
+        data = {"target_token": args.target_token, "fhir_target": args.fhir_target.rstrip("/") + "/"}
+        # not a job: nothing to resume, so nothing is recorded in the job store
+        deliver_batches(f"bulk-{uuid4()}", data, ingest.batches(paths), record=False)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{len(paths)} files, {size / 1e9:.3f} GB in {elapsed:.1f}s:"
+        f" {size / 1e9 / elapsed * 3600:.1f} GB/hour",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
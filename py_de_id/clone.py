@@ -0,0 +1,238 @@
+import re
+from collections import OrderedDict
+from uuid import uuid4, uuid5
+
+PLACEHOLDER_TYPES = ("Organization/", "Practitioner/", "Location/")
+RELATIVE_REFERENCE = re.compile(r"[A-Z][A-Za-z]+/[A-Za-z0-9\-.]{1,64}")
+
+
+class ReferenceMap(dict):
+    """Source reference -> the clone's reference.
+
+    A clone id is derived from the source reference and a secret namespace
+    minted for the job, so any process cloning part of the job mints the same
+    id for a reference without asking the others.
+    """
+
+    def __init__(self, namespace=None):
+        super().__init__()
+        self.namespace = namespace or uuid4()
+
+    def mint(self, ref):
+        new_ref = self.get(ref)
+        if new_ref is None:
+            new_ref = self[ref] = f"{ref.split('/')[0]}/{uuid5(self.namespace, ref)}"
+        return new_ref
+
+    def seed(self, ref):
+        """What to seed the randomized fields of ref with - the same every time
+        for the namespace, which is secret, so not derivable from the clone id"""
+        return f"{self.namespace}:{ref}"
+
+
+def index_references(obj, index):
+    """Append every dict below obj that holds a relative reference to index.
+
+    One traversal, through lists as well as dicts, without recursion so that
+    deeply nested resources are fine.
+    """
+    match = RELATIVE_REFERENCE.fullmatch
+    stack = [obj]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        node = pop()
+        if node.__class__ is list:
+            values = node
+        else:
+            if "reference" in node:
+                ref = node["reference"]
+                if ref.__class__ is str and match(ref):
+                    index.append(node)
+            values = node.values()
+        for value in values:
+            cls = value.__class__
+            if cls is dict:
+                push(value)
+            elif cls is list:
+                # the items of a list are looked at here rather than popped as one node
+                for item in value:
+                    cls = item.__class__
+                    if cls is dict or cls is list:
+                        push(item)
+    return index
+
+
+def rekey_references(obj, referenceMap, linked=None):
+    """Rewrite every relative reference below obj, minting ids for resources not seen yet.
+
+    The source references to Organizations, Practitioners and Locations are
+    appended to linked, if given.
+    """
+    for holder in index_references(obj, []):
+        ref = holder["reference"]
+        if linked is not None and ref.startswith(PLACEHOLDER_TYPES):
+            linked.append(ref)
+        holder["reference"] = referenceMap.mint(ref)
+        if "display" in holder:
+            holder["display"] = holder["reference"]
+
+
+def redirect_references(obj, old_ref, new_ref):
+    """Point the references below obj to old_ref at new_ref instead"""
+    for holder in index_references(obj, []):
+        if holder["reference"] == old_ref:
+            holder["reference"] = new_ref
+            if "display" in holder:
+                holder["display"] = new_ref
+
+
+def rewrite_references(index, referenceMap, placeholder):
+    """Rewrite the indexed references of a whole bundle in one pass.
+
+    References to resources that are not in referenceMap are left alone,
+    except for Organizations, Practitioners and Locations which are pointed
+    at the placeholder given by placeholder(ref) - see
+    PlaceholderCache.resolver, asked once per reference.  Returns the
+    placeholder entries to create by source reference and the references
+    that were not found.
+    """
+    placeholders = {}
+    missing = []
+    redirected = {}
+    for holder in index:
+        ref = holder["reference"]
+        new_ref = referenceMap.get(ref) or redirected.get(ref)
+        if new_ref is None:
+            if not ref.startswith(PLACEHOLDER_TYPES):
+                missing.append(ref)
+                continue
+            new_ref, entry = placeholder(ref)
+            redirected[ref] = new_ref
+            if entry is not None:
+                placeholders[ref] = entry
+        holder["reference"] = new_ref
+        if "display" in holder:
+            holder["display"] = new_ref
+    return placeholders, missing
+
+
+def clone_entry(entry, referenceMap, plan=None, index=None, linked=None):
+    """De-identify (when given a rule plan) and re-key an entry in place, making it a POST.
+
+    Randomized fields are seeded from referenceMap.seed, so cloning the
+    same resource with the same namespace gives the same result.
+
+    The references in the resource are rewritten straight away (appending
+    the Organizations, Practitioners and Locations it refers to to linked),
+    or, given an index, collected into it for rewrite_references.  Returns
+    the source reference of the entry's resource, or None when the entry
+    has no resource to clone.
+    """
+    if "resource" not in entry or "id" not in entry["resource"]:
+        return None
+    resource = entry["resource"]
+    ref = f'{resource["resourceType"]}/{resource["id"]}'
+    if plan:
+        resource = entry["resource"] = plan.apply(resource, referenceMap.seed(ref))
+    resource["id"] = referenceMap.mint(ref).split("/")[1]
+
+    entry.pop("search", None)
+    entry.pop("fullUrl", None)
+    entry["request"] = {"method": "POST", "url": resource["resourceType"]}
+    if index is None:
+        rekey_references(resource, referenceMap, linked)
+    else:
+        index_references(resource, index)
+    return ref
+
+
+def deidentify_entries(entries, referenceMap, plan):
+    """De-identify the resources of many entries at once (see RulePlan.apply_many),
+    seeded as clone_entry seeds them.  Clone them afterwards without a plan."""
+    resources = []
+    seeds = []
+    for entry in entries:
+        resource = entry.get("resource")
+        if resource is not None and "id" in resource:
+            resources.append(resource)
+            seeds.append(referenceMap.seed(f'{resource["resourceType"]}/{resource["id"]}'))
+    plan.apply_many(resources, seeds)
+
+
+class PendingEntries(object):
+    """Holds back cloned entries until the Organizations, Practitioners and
+    Locations they refer to have been cloned too.
+
+    References are re-keyed on sight, so until the end of the bundle it is
+    not known whether a referenced resource is in it.  An entry waiting for
+    a resource that never comes is pointed at the target's placeholder for
+    its type instead: when the bundle ends, or when more than ``max_pending``
+    entries are waiting (the oldest first).  Once a reference has gone to a
+    placeholder, later entries referring to it go there straight away.
+    """
+
+    def __init__(self, referenceMap, placeholder, max_pending=1000):
+        self.referenceMap = referenceMap
+        self.placeholder = placeholder
+        self.max_pending = max_pending
+        self.cloned = set()
+        self.redirected = {}
+        self._pending = OrderedDict()
+        self._waiting = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, entry, ref, linked):
+        """Add a cloned entry; returns the entries that are ready to deliver, in order"""
+        ready = []
+        self.cloned.add(ref)
+        waiting = set()
+        for linked_ref in linked:
+            if linked_ref in self.redirected:
+                self._redirect(entry, linked_ref, ready)
+            elif linked_ref not in self.cloned:
+                waiting.add(linked_ref)
+        if waiting:
+            self._pending[id(entry)] = (entry, waiting)
+            for linked_ref in waiting:
+                self._waiting.setdefault(linked_ref, set()).add(id(entry))
+        else:
+            ready.append(entry)
+
+        for key in self._waiting.pop(ref, ()):
+            pending, waiting = self._pending[key]
+            waiting.discard(ref)
+            if not waiting:
+                del self._pending[key]
+                ready.append(pending)
+        while len(self._pending) > self.max_pending:
+            self._release(next(iter(self._pending)), ready)
+        return ready
+
+    def flush(self):
+        """Release every entry still waiting, pointed at placeholders"""
+        ready = []
+        while self._pending:
+            self._release(next(iter(self._pending)), ready)
+        return ready
+
+    def _release(self, key, ready):
+        entry, waiting = self._pending.pop(key)
+        for linked_ref in waiting:
+            keys = self._waiting[linked_ref]
+            keys.discard(key)
+            if not keys:
+                del self._waiting[linked_ref]
+            self._redirect(entry, linked_ref, ready)
+        ready.append(entry)
+
+    def _redirect(self, entry, ref, ready):
+        new_ref = self.redirected.get(ref)
+        if new_ref is None:
+            new_ref, placeholder = self.placeholder(ref)
+            self.redirected[ref] = new_ref
+            if placeholder is not None:
+                ready.append(placeholder)
+        redirect_references(entry["resource"], self.referenceMap[ref], new_ref)
@@ -0,0 +1,54 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec(object):
+    """The standard library's json, on UTF-8 bytes"""
+
+    name = "json"
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(object):
+    """orjson, which reads and writes bytes natively"""
+
+    name = "orjson"
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+CODECS = {"json": JsonCodec}
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec
+
+
+def get_codec(name=None):
+    """The named codec, or the fastest one installed.
+
+    PYDEID_JSON chooses the codec when no name is given; a codec that is not
+    installed falls back to json.
+    """
+    name = name or os.environ.get("PYDEID_JSON") or ("orjson" if orjson else "json")
+    return CODECS.get(name, JsonCodec)()
+
+
+codec = get_codec()
+dumps = codec.dumps
+loads = codec.loads
@@ -0,0 +1,110 @@
+import hashlib
+
+from . import codec
+from .clone import ReferenceMap, index_references
+from .store import entry_key
+
+
+def digest(resource):
+    """A hash of a cloned resource, to tell whether it changed since it was delivered"""
+    return hashlib.blake2b(codec.dumps(resource), digest_size=16).hexdigest()
+
+
+def location_reference(location):
+    """Type/id of a transaction response location (which may be absolute and versioned)"""
+    parts = location.split("/_history")[0].rstrip("/").split("/")
+    return "/".join(parts[-2:])
+
+
+class DeltaMap(ReferenceMap):
+    """The reference map of a lineage cloned before, and the changes since.
+
+    ``previous`` is what was delivered for the lineage: source reference ->
+    (target reference, digest).  Resources delivered before keep their
+    target reference; new ones are minted from the lineage's namespace as
+    usual.  changes() drops the entries whose digest (see source_digest) has
+    not changed, turns those that have into PUTs of their target reference
+    and leaves new ones as POSTs.  acknowledge() returns what to record once the target has
+    accepted a batch.
+    """
+
+    def __init__(self, namespace, previous):
+        super().__init__(namespace)
+        self.previous = previous
+        self.sources = {}
+        self.counts = {"new": 0, "changed": 0, "unchanged": 0}
+        self._sent = {}
+        for ref, (target, _) in previous.items():
+            self[ref] = target
+            self.sources[target] = ref
+
+    def mint(self, ref):
+        new_ref = self.get(ref)
+        if new_ref is None:
+            new_ref = super().mint(ref)
+            self.sources[new_ref] = ref
+        return new_ref
+
+    def source_digest(self, ref, resource):
+        """The digest of a cloned resource with its id and references put back
+        to the source's, which do not change with the ids the target gives"""
+        new_id = resource["id"]
+        holders = index_references(resource, [])
+        rekeyed = [holder["reference"] for holder in holders]
+        resource["id"] = ref.split("/", 1)[1]
+        for holder in holders:
+            source = self.sources.get(holder["reference"], holder["reference"])
+            holder["reference"] = source
+            if "display" in holder:
+                holder["display"] = source
+        try:
+            return digest(resource)
+        finally:
+            resource["id"] = new_id
+            for holder, new_ref in zip(holders, rekeyed):
+                holder["reference"] = new_ref
+                if "display" in holder:
+                    holder["display"] = new_ref
+
+    def changes(self, batch):
+        """The entries of a cloned batch to deliver"""
+        changed = []
+        for entry in batch:
+            key = entry_key(entry)
+            ref = self.sources.get(key)
+            if ref is None:
+                # a placeholder, which is a conditional create anyway
+                changed.append(entry)
+                continue
+            new_digest = self.source_digest(ref, entry["resource"])
+            previous = self.previous.get(ref)
+            if previous is None:
+                self.counts["new"] += 1
+            elif previous[1] == new_digest:
+                self.counts["unchanged"] += 1
+                continue
+            else:
+                self.counts["changed"] += 1
+                entry["request"] = {"method": "PUT", "url": key}
+            self._sent[key] = (ref, new_digest)
+            changed.append(entry)
+        return changed
+
+    def acknowledge(self, batch, locations=()):
+        """(source reference, target reference, digest) of the entries of an accepted batch.
+
+        A POSTed resource is recorded under the location the target gave
+        it, if it said, so the next run updates the right resource.
+        """
+        locations = list(locations)
+        clones = []
+        for n, entry in enumerate(batch):
+            key = entry_key(entry)
+            sent = self._sent.pop(key, None)
+            if sent is None:
+                continue
+            target = key
+            if entry["request"]["method"] == "POST" and n < len(locations) and locations[n]:
+                target = location_reference(locations[n])
+            clones.append((sent[0], target, sent[1]))
+        return clones
@@ -0,0 +1,222 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+import cherrypy
+
+from .metrics import JOB_SECONDS
+from .tracing import tracer
+
+QUEUED = "queued"
+FETCHING = "fetching"
+CLONING = "cloning"
+DELIVERING = "delivering"
+DONE = "done"
+FAILED = "failed"
+STAGES = [QUEUED, FETCHING, CLONING, DELIVERING, DONE, FAILED]
+
+
+class JobQueueFull(Exception):
+    """The job can not be queued. ``tenant`` is True when only the tenant's share is full."""
+
+    def __init__(self, message, tenant=False):
+        super().__init__(message)
+        self.tenant = tenant
+
+
+class JobScheduler(object):
+    """A fixed pool of worker threads fed from a bounded queue of jobs.
+
+    Jobs are queued per tenant and the workers take one job from each
+    tenant in turn, so a tenant with a burst of jobs can not starve the
+    others.  A tenant may have at most ``max_per_tenant`` jobs queued, and
+    there are at most ``max_queued`` queued jobs in total.
+
+    The status of the last ``history`` finished jobs is kept for polling.
+    Given a JobStore, the status of every job is recorded there too, and
+    jobs this process has not seen are looked up in it.
+    """
+
+    def __init__(
+        self, workers=8, max_queued=100, max_per_tenant=25, history=1000, store=None
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_per_tenant = max_per_tenant
+        self.history = history
+        self.store = store
+        self._cond = threading.Condition()
+        self._tenants = OrderedDict()
+        self._queued = 0
+        self._running = 0
+        self._jobs = OrderedDict()
+        self._threads = []
+        self._draining = False
+
+    def start(self):
+        with self._cond:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work, name=f"job-worker-{len(self._threads)}"
+                )
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, job_id, tenant, target, *args):
+        with self._cond:
+            if self._queued >= self.max_queued:
+                raise JobQueueFull(f"There are already {self._queued} jobs queued")
+            queue = self._tenants.setdefault(tenant, deque())
+            if len(queue) >= self.max_per_tenant:
+                raise JobQueueFull(
+                    f"{tenant} already has {len(queue)} jobs queued", tenant=True
+                )
+            queue.append((job_id, target, args))
+            self._queued += 1
+            self._jobs[job_id] = {
+                "transaction": job_id,
+                "tenant": tenant,
+                "status": QUEUED,
+                "submitted": time.time(),
+            }
+            if self.store:
+                self.store.update(job_id, QUEUED)
+            self._cond.notify()
+        self.start()
+
+    def _next(self):
+        """Take the next job, rotating through the tenants"""
+        with self._cond:
+            while not self._queued or self._draining:
+                self._cond.wait()
+            tenant, queue = next(iter(self._tenants.items()))
+            job = queue.popleft()
+            del self._tenants[tenant]
+            if queue:
+                self._tenants[tenant] = queue
+            self._queued -= 1
+            self._running += 1
+            status = self._jobs[job[0]]
+            status["started"] = time.time()
+        if tracer.begin(job[0]):
+            tracer.span(job[0], "queued", status["started"] - status["submitted"])
+        return job
+
+    def _work(self):
+        while True:
+            job_id, target, args = self._next()
+            start = time.perf_counter()
+            error = None
+            try:
+                target(*args)
+            except Exception as e:
+                cherrypy.log(f"{job_id}: Job failed: {e}", traceback=True)
+                error = str(e)
+            finally:
+                self.finish(job_id, start, error)
+
+    def begin(self, job_id, tenant):
+        """Record a job that is run elsewhere (see aio.AsyncEngine) as running.
+
+        Its status is kept, and drain() waits for it, as for the workers'
+        jobs; finish() must be called when it ends.
+        """
+        with self._cond:
+            if self._draining:
+                raise JobQueueFull("The service is stopping")
+            now = time.time()
+            self._jobs[job_id] = {
+                "transaction": job_id,
+                "tenant": tenant,
+                "status": QUEUED,
+                "submitted": now,
+                "started": now,
+            }
+            self._running += 1
+            if self.store:
+                self.store.update(job_id, QUEUED)
+        tracer.begin(job_id)
+
+    def finish(self, job_id, start, error=None):
+        """Record the end of a running job started at perf_counter() start"""
+        if error is None:
+            self.update(job_id, DONE)
+        else:
+            self.update(job_id, FAILED, error=error)
+        status = self.status(job_id)["status"]
+        JOB_SECONDS.observe(time.perf_counter() - start, (status,))
+        tracer.end(job_id, status)
+        with self._cond:
+            self._running -= 1
+            self._forget()
+            self._cond.notify_all()
+
+    def update(self, job_id, status, error=None):
+        """Move a job on to a later stage (a job never goes back, and failed is final)"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] == FAILED:
+                return
+            if STAGES.index(status) > STAGES.index(job["status"]):
+                job["status"] = status
+                if status in (DONE, FAILED):
+                    job["finished"] = time.time()
+                if error:
+                    job["error"] = error
+                if self.store:
+                    self.store.update(job_id, status, error)
+
+    def drain(self, timeout=None):
+        """Start no more jobs and wait up to timeout seconds for the running ones.
+
+        Returns True if none is still running.  Queued jobs stay queued (in
+        the store, for the next process to resume).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._draining = True
+            while self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return not self._running
+
+    def report(self, job_id, **fields):
+        """Add fields (such as a cohort's progress per patient) to a job's status"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def _forget(self):
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job["status"] in (DONE, FAILED)
+        ]
+        for job_id in finished[: max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def status(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job:
+                return dict(job)
+        return self.store.status(job_id) if self.store else None
+
+    def saturation(self):
+        """How full the queue is, from 0 to 1"""
+        with self._cond:
+            return self._queued / self.max_queued
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self._queued,
+                "max_queued": self.max_queued,
+                "tenants": {tenant: len(queue) for tenant, queue in self._tenants.items()},
+            }
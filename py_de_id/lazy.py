@@ -0,0 +1,33 @@
+import threading
+
+_UNSET = object()
+
+
+class Lazy(object):
+    """A module-level object built by ``factory`` the first time it is used.
+
+    Attribute access is passed on to the object, so code using it does not
+    change, while importing the module that holds it opens no files,
+    creates no directories and logs nothing.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = _UNSET
+
+    def resolve(self):
+        value = self._value
+        if value is _UNSET:
+            with self._lock:
+                if self._value is _UNSET:
+                    self._value = self._factory()
+                value = self._value
+        return value
+
+    def resolved(self):
+        return self._value is not _UNSET
+
+    def __getattr__(self, name):
+        # only called for what Lazy itself does not have
+        return getattr(self.resolve(), name)
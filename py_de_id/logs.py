@@ -0,0 +1,22 @@
+import logging
+
+import cherrypy
+
+
+def debug_enabled():
+    return cherrypy.log.error_log.isEnabledFor(logging.DEBUG)
+
+
+def debug(message, *args):
+    """Log message % args at debug level.
+
+    The message is only formatted when debug logging is on (PYDEID_LOG_LEVEL=DEBUG),
+    so a debug message on a hot path costs a call and a level check.
+    """
+    if cherrypy.log.error_log.isEnabledFor(logging.DEBUG):
+        cherrypy.log(message % args, severity=logging.DEBUG)
+
+
+def redacted(data):
+    """A job's request without its tokens, to log"""
+    return {key: value for key, value in data.items() if not key.endswith("_token")}
@@ -0,0 +1,208 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Seconds, from a fast rule application to a slow $everything page
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """The metrics exposed at /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Sharded(object):
+    """A metric whose values are kept per thread, so recording takes no lock.
+
+    The values of every thread are added together when the metric is read;
+    those of threads that have ended are folded into one set.
+    """
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = {}
+        if registry is not None:
+            registry.register(self)
+
+    def shard(self):
+        """This thread's values: label values -> value"""
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def collect(self):
+        with self._lock:
+            live = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    live.append((thread, values))
+                else:
+                    self._merge(self._retired, values)
+            self._shards = live
+            total = {}
+            self._merge(total, self._retired)
+            for _, values in live:
+                self._merge(total, values)
+        return total
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        values = self.shard()
+        values[labels] = values.get(labels, 0) + amount
+
+    def _merge(self, total, values):
+        for key, value in list(values.items()):
+            total[key] = total.get(key, 0) + value
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield f"{self.name}{_labels(self.labels, key)} {_number(value)}"
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        values = self.shard()
+        cell = values.get(labels)
+        if cell is None:
+            # a count per bucket, then +Inf, the sum and the count
+            cell = values[labels] = [0] * (len(self.buckets) + 3)
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    @contextmanager
+    def time(self, labels=()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def _merge(self, total, values):
+        for key, cell in list(values.items()):
+            if key in total:
+                total[key] = [a + b for a, b in zip(total[key], cell)]
+            else:
+                total[key] = list(cell)
+
+    def samples(self):
+        for key, cell in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), cell):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, key)} {_number(cell[-2])}"
+            yield f"{self.name}_count{_labels(self.labels, key)} {cell[-1]}"
+
+
+class Gauge(object):
+    """A value read when the metrics are rendered"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = tuple(labels)
+        if registry is not None:
+            registry.register(self)
+
+    def samples(self):
+        value = self.function()
+        values = value if isinstance(value, dict) else {(): value}
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labels, key)} {_number(value)}"
+
+
+STAGE_SECONDS = Histogram(
+    "pydeid_stage_seconds",
+    "Time spent per $everything page fetched, batch cloned, batch posted and bundle re-keyed",
+    ("stage",),
+)
+JOB_SECONDS = Histogram(
+    "pydeid_job_seconds", "Time from a job starting to it finishing", ("status",)
+)
+BYTES = Counter(
+    "pydeid_bytes_total", "Bytes fetched from sources and posted to targets", ("direction",)
+)
+RESOURCES = Counter(
+    "pydeid_resources_total", "Resources cloned, per resourceType", ("resource_type",)
+)
+THROTTLED = Counter(
+    "pydeid_throttled_total", "Batches a target answered with 429", ("target",)
+)
+RULE_EXECUTIONS = Counter(
+    "pydeid_rule_executions_total",
+    "Rule actions applied, per resourceType, field and action",
+    ("resource_type", "field", "action"),
+)
+RULE_SECONDS = Counter(
+    "pydeid_rule_seconds_total",
+    "Time spent applying rule actions, per resourceType, field and action",
+    ("resource_type", "field", "action"),
+)
+PLAN_LEVELS = Histogram(
+    "pydeid_plan_levels",
+    "Levels of batches a delivery was planned into - its critical path, in round trips",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32, 64),
+)
@@ -0,0 +1,117 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from .clone import ReferenceMap, clone_entry, deidentify_entries
+from .rules import RulePlan
+
+_plan = None
+# Later versions of the rules, compiled by a worker when a shard first asks for them
+_plans = {}
+MAX_PLANS = 4
+
+
+def _init_worker(config):
+    global _plan
+    _plan = RulePlan(config)
+
+
+def process_pool(processes, config):
+    """A pool of ``processes`` worker processes, each compiling the rules in config once"""
+    return ProcessPoolExecutor(
+        processes,
+        # fork is not safe in a process that is already running threads
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(config,),
+    )
+
+
+def worker_plan(version=None, config=None):
+    """In a pool worker, the rules it started with - or, given them, a later version compiled once"""
+    if config is None:
+        return _plan
+    plan = _plans.get(version)
+    if plan is None:
+        plan = _plans[version] = RulePlan(config, version)
+        while len(_plans) > MAX_PLANS:
+            del _plans[next(iter(_plans))]
+    return plan
+
+
+def _clone_shard(entries, namespace, deid, version=None, config=None):
+    referenceMap = ReferenceMap(namespace)
+    if deid:
+        plan = worker_plan(version, config)
+        deidentify_entries(entries, referenceMap, plan)
+    cloned = []
+    for entry in entries:
+        linked = []
+        cloned.append((entry, clone_entry(entry, referenceMap, linked=linked), linked))
+    return cloned, dict(referenceMap)
+
+
+def in_order(executor, tasks, ahead):
+    """Run (tag, function, args) tasks on executor, yielding (tag, result) in the order given.
+
+    Up to ``ahead`` tasks are submitted past the one waited for, which keeps
+    every worker busy without reading the whole input ahead.
+    """
+    pending = deque()
+    for tag, function, args in tasks:
+        pending.append((tag, executor.submit(function, *args)))
+        if len(pending) > ahead:
+            tag, future = pending.popleft()
+            yield tag, future.result()
+    while pending:
+        tag, future = pending.popleft()
+        yield tag, future.result()
+
+
+class ClonePool(object):
+    """Worker processes that de-identify and re-key shards of a job's entries.
+
+    Every worker compiles the rules once when it starts.  Because clone ids
+    are derived from the job's namespace the workers mint the same ids as the
+    serial path, and the id maps they return are merged into the job's.  A
+    job de-identified with other rules than the pool started with (reloaded
+    since) sends them with every shard, and the workers compile them once.
+    """
+
+    def __init__(self, processes, config, shard_size=500):
+        self.processes = processes
+        self.config = config
+        self.shard_size = shard_size
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = process_pool(self.processes, self.config)
+            return self._executor
+
+    def clone(self, entries, referenceMap, deid, plan=None):
+        """Yield (entry, source reference or None, linked references) like clone_entry, in order"""
+        executor = self.executor()
+        rules = ()
+        if plan is not None and plan.config is not self.config:
+            rules = (plan.version, plan.config)
+        entries = iter(entries)
+        shards = iter(lambda: list(islice(entries, self.shard_size)), [])
+        tasks = ((None, _clone_shard, (shard, referenceMap.namespace, deid) + rules) for shard in shards)
+        for _, result in in_order(executor, tasks, 2 * self.processes):
+            yield from self._merge(result, referenceMap)
+
+    def _merge(self, result, referenceMap):
+        cloned, references = result
+        referenceMap.update(references)
+        return cloned
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
@@ -0,0 +1,161 @@
+import re
+
+# name, then optionally [*], [key=text] or [key~text] (text contained in the value of key)
+STEP = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)(?:\[(?:(\*)|([A-Za-z_][A-Za-z0-9_]*)([=~])([^\]]*))\])?")
+
+
+def is_path(field):
+    """Whether a rule's field is a path (``address[*].postalCode``) rather than a field name"""
+    return "." in field or "[" in field
+
+
+def parse_path(path):
+    """The steps of a path: (name, selector) pairs, the selector being None, "*" or (key, op, text).
+
+    Raises ValueError if path is not a path.
+    """
+    steps = []
+    for n, part in enumerate(_split(path)):
+        match = STEP.fullmatch(part)
+        if match is None:
+            raise ValueError(f"{path}: step {n + 1} ({part!r}) is not name, name[*] or name[key=text]")
+        name, star, key, op, text = match.groups()
+        steps.append((name, "*" if star else (key, op, text) if key else None))
+    return steps
+
+
+def _split(path):
+    # dots inside brackets (urls in filters) do not separate steps
+    parts, start, depth = [], 0, 0
+    for n, char in enumerate(path):
+        if char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+        elif char == "." and not depth:
+            parts.append(path[start:n])
+            start = n + 1
+    parts.append(path[start:])
+    return parts
+
+
+def _selects(selector):
+    if selector == "*":
+        return None
+    key, op, text = selector
+    if op == "=":
+        return lambda item: isinstance(item, dict) and key in item and str(item[key]) == text
+    return lambda item: isinstance(item, dict) and text in str(item.get(key, ""))
+
+
+class PathNode(object):
+    """A place in a resource that path rules reach: the value at container[key].
+
+    ``fields`` are the nodes of the keys of a dict value, ``items`` those of
+    the elements of a list value matching a selector, ``actions`` are run on
+    the value once its fields and items are done, and ``erase`` removes it.
+    """
+
+    __slots__ = ("fields", "items", "actions", "erase")
+
+    def __init__(self):
+        self.fields = {}
+        self.items = {}
+        self.actions = []
+        self.erase = False
+
+    def compile(self):
+        """A function of (container, key, seed) applying the rules of this node and below.
+
+        Each shape of node gets a function of its own, so nothing is looked
+        up while a resource is visited that could be decided here.
+        """
+        actions = tuple(self.actions)
+        if not self.fields and not self.items:
+            if len(actions) == 1:
+                return actions[0]
+
+            def leaf(container, key, seed=None):
+                for action in actions:
+                    action(container, key, seed)
+
+            return leaf
+
+        erased = tuple(name for name, child in self.fields.items() if child.erase)
+        fields = tuple((name, child.compile()) for name, child in self.fields.items() if not child.erase)
+        items = tuple(
+            (selects, child.erase, None if child.erase else child.compile())
+            for selects, child in self.items.values()
+        )
+        # [*] with nothing erased: every item is visited and the list kept as it is
+        each = items[0][2] if len(items) == 1 and items[0][0] is None and not items[0][1] else None
+
+        def visit(container, key, seed=None):
+            value = container[key]
+            if fields or erased:
+                if isinstance(value, dict):
+                    for name in erased:
+                        if name in value:
+                            del value[name]
+                    for name, visit_field in fields:
+                        if name in value:
+                            visit_field(value, name, seed)
+            if each is not None:
+                if isinstance(value, list):
+                    for n in range(len(value)):
+                        each(value, n, seed)
+            elif items and isinstance(value, list):
+                kept = []
+                for n, item in enumerate(value):
+                    for selects, erase, visit_item in items:
+                        # selects is None for [*]
+                        if selects is None or selects(item):
+                            if erase:
+                                break
+                            visit_item(value, n, seed)
+                    else:
+                        kept.append(value[n])
+                if len(kept) < len(value):
+                    # an empty list is not valid FHIR, so the field goes too
+                    if kept:
+                        value[:] = kept
+                    else:
+                        del container[key]
+                        return
+            for action in actions:
+                action(container, key, seed)
+
+        return visit
+
+
+class PathAction(object):
+    """The path rules starting at one field of a resource, compiled into a trie.
+
+    Rules sharing a prefix share its nodes, so applying them visits each
+    node of the resource they reach once, and changes it in place.  Called
+    like the other actions, with the resource and the field; the trie is
+    compiled into functions (see PathNode.compile) when it is first called.
+    """
+
+    def __init__(self):
+        self.root = PathNode()
+        self._visit = None
+
+    def add(self, steps, action, erase=False):
+        node = self.root
+        for n, (name, selector) in enumerate(steps):
+            if n:
+                node = node.fields.setdefault(name, PathNode())
+            if selector is not None:
+                node = node.items.setdefault(selector, (_selects(selector), PathNode()))[1]
+        if erase:
+            node.erase = True
+        else:
+            node.actions.append(action)
+        self._visit = None
+
+    def __call__(self, resource, field, seed=None):
+        visit = self._visit
+        if visit is None:
+            visit = self._visit = self.root.compile()
+        visit(resource, field, seed)
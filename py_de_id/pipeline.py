@@ -0,0 +1,52 @@
+import queue
+import threading
+
+POLL_SECONDS = 0.1
+
+
+class _Done(object):
+    def __init__(self, exception=None):
+        self.exception = exception
+
+
+def background(iterable, maxsize):
+    """Iterate over iterable in a thread, handing items over through a bounded queue.
+
+    The producer runs at most ``maxsize`` items ahead of the consumer.  An
+    exception raised by the producer is re-raised in the consumer, and the
+    producer stops once the consumer stops iterating.
+    """
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Done(e))
+        else:
+            put(_Done())
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if isinstance(item, _Done):
+                if item.exception:
+                    raise item.exception
+                return
+            yield item
+    finally:
+        stopped.set()
@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import OrderedDict
+from uuid import UUID, uuid5
+
+PLACEHOLDER_SYSTEM = "my-elixir"
+# Placeholder ids are derived from the target and the resource type, so every
+# process (and every restart) uses the same placeholder on a target
+PLACEHOLDER_NAMESPACE = UUID("5d1e3c7a-8f0b-4d52-9a56-3f6c0c1b7e21")
+
+
+def placeholder_identifier(resource_type):
+    return f"{PLACEHOLDER_SYSTEM}|unknown-{resource_type.lower()}"
+
+
+def placeholder_entry(resource_type, new_id):
+    """A stand-in for the Organizations/Practitioners/Locations that are not in a bundle.
+
+    It is a conditional create, so it is only created if the target does not
+    have it already.
+    """
+    return {
+        "resource": {
+            "resourceType": resource_type,
+            "id": new_id,
+            "name": f"unknown-{resource_type.lower()}",
+            "identifier": [
+                {
+                    "system": PLACEHOLDER_SYSTEM,
+                    "value": f"unknown-{resource_type.lower()}",
+                }
+            ],
+        },
+        "request": {
+            "method": "POST",
+            "url": resource_type,
+            "ifNoneExist": f"identifier={placeholder_identifier(resource_type)}",
+        },
+    }
+
+
+class PlaceholderCache(object):
+    """The placeholders known to exist on each target, shared by every job.
+
+    A placeholder is remembered once the batch that created it has been
+    accepted, for ``ttl`` seconds, and at most ``max_size`` are remembered
+    (least recently used are forgotten first).  A job that needs a
+    placeholder the cache does not know sends a conditional create for it.
+    """
+
+    def __init__(self, max_size=1024, ttl=24 * 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._known = OrderedDict()
+
+    def reference(self, target, resource_type):
+        return f"{resource_type}/{uuid5(PLACEHOLDER_NAMESPACE, f'{target}|{resource_type}')}"
+
+    def known(self, target, resource_type):
+        key = (target, resource_type)
+        with self._lock:
+            created = self._known.get(key)
+            if created is None:
+                return False
+            if time.monotonic() - created > self.ttl:
+                del self._known[key]
+                return False
+            self._known.move_to_end(key)
+            return True
+
+    def references(self, target):
+        """The references of the placeholders known to exist on a target"""
+        with self._lock:
+            types = [resource_type for known, resource_type in self._known if known == target]
+        return {self.reference(target, rt) for rt in types if self.known(target, rt)}
+
+    def resolver(self, target):
+        """A function giving a job the placeholder for a reference.
+
+        It returns the placeholder's reference, and the entry that creates it
+        the first time the job asks for a placeholder the target may not have.
+        """
+        resolved = {}
+
+        def placeholder(ref):
+            resource_type = ref.split("/")[0]
+            new_ref = self.reference(target, resource_type)
+            if resource_type in resolved or self.known(target, resource_type):
+                resolved[resource_type] = True
+                return new_ref, None
+            resolved[resource_type] = True
+            return new_ref, placeholder_entry(resource_type, new_ref.split("/")[1])
+
+        return placeholder
+
+    def acknowledge(self, target, entries):
+        """Remember the placeholders in a batch the target has accepted"""
+        for entry in entries:
+            condition = entry.get("request", {}).get("ifNoneExist", "")
+            if condition.startswith(f"identifier={PLACEHOLDER_SYSTEM}|"):
+                key = (target, entry["resource"]["resourceType"])
+                with self._lock:
+                    self._known[key] = time.monotonic()
+                    self._known.move_to_end(key)
+                    while len(self._known) > self.max_size:
+                        self._known.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"placeholders": len(self._known)}
+
+
+placeholder_cache = PlaceholderCache()
@@ -0,0 +1,252 @@
+"""Order cloned entries so every resource is created before those referring to it.
+
+The entries are packed into levels of batches.  An entry is in a later
+level than every entry it refers to, so posting the levels one after the
+other, the batches of a level at once, never sends a reference to a
+resource the target has not created yet.  A delivery is planned as it
+streams in: the Planner holds back the entries referring to resources that
+have not come yet, and the entries it releases are planned a few batches
+at a time.
+"""
+
+from .clone import index_references
+from .metrics import PLAN_LEVELS
+
+
+def entry_reference(entry):
+    """The reference of the resource an entry creates, or None"""
+    resource = entry.get("resource")
+    if resource is None or "id" not in resource or "resourceType" not in resource:
+        return None
+    return f'{resource["resourceType"]}/{resource["id"]}'
+
+
+def strongly_connected(edges):
+    """The strongly connected components of a graph (node -> nodes it has an edge to).
+
+    Tarjan's algorithm, without recursion.  Each component comes after
+    every component it has an edge to.
+    """
+    count = len(edges)
+    order = [None] * count
+    low = [0] * count
+    on_stack = [False] * count
+    stack = []
+    components = []
+    counter = 0
+    for root in range(count):
+        if order[root] is not None:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, iter(edges[root]))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if order[child] is None:
+                    order[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = True
+                    work.append((child, iter(edges[child])))
+                    break
+                if on_stack[child]:
+                    low[node] = min(low[node], order[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == order[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def plan_levels(entries, batch_size):
+    """Pack entries into levels of batches of up to batch_size entries.
+
+    References to resources that are not among the entries are ignored:
+    they were delivered before, or are not coming.  Entries that refer to
+    each other in a cycle (an Encounter and the Condition it was for) go
+    into the same batch, which may then be larger than batch_size, and the
+    target resolves them together.  Entries keep their order within a
+    level.  The number of levels is observed in PLAN_LEVELS.
+    """
+    position = {}
+    for n, entry in enumerate(entries):
+        ref = entry_reference(entry)
+        if ref is not None:
+            position[ref] = n
+    edges = []
+    for n, entry in enumerate(entries):
+        targets = set()
+        resource = entry.get("resource")
+        if resource is not None:
+            for holder in index_references(resource, []):
+                target = position.get(holder["reference"])
+                if target is not None and target != n:
+                    targets.add(target)
+        edges.append(targets)
+
+    # components come dependencies first, so each level is known when it is reached
+    components = strongly_connected(edges)
+    component_of = [0] * len(entries)
+    level_of = []
+    for number, component in enumerate(components):
+        level = 0
+        for node in component:
+            component_of[node] = number
+        for node in component:
+            for target in edges[node]:
+                if component_of[target] != number:
+                    level = max(level, level_of[component_of[target]] + 1)
+        level_of.append(level)
+
+    levels = [[] for _ in range(max(level_of, default=-1) + 1)]
+    placed = set()
+    for n in range(len(entries)):
+        number = component_of[n]
+        if number in placed:
+            continue
+        placed.add(number)
+        members = sorted(components[number])
+        batches = levels[level_of[number]]
+        if not batches or len(batches[-1]) + len(members) > batch_size:
+            batches.append([])
+        batches[-1].extend(entries[node] for node in members)
+    if levels:
+        PLAN_LEVELS.observe(len(levels))
+    return levels
+
+
+class Planner(object):
+    """Holds back the entries of a delivery until the resources they refer to
+    have come too, as PendingEntries does for placeholders.
+
+    References are re-keyed on sight, so until the delivery ends it is not
+    known whether a referenced resource is in it.  add() returns the entries
+    whose references are all ``resolved`` - to resources released before,
+    delivered before or among the entries released with them - and keeps
+    the others.  An entry waiting for a resource that never comes is
+    released when the delivery ends, or when more than ``max_pending``
+    entries are waiting (all of them then, their missing references given
+    up on).  Entries referring to each other in a cycle are released
+    together.
+    """
+
+    def __init__(self, resolved=(), max_pending=1000):
+        self.resolved = set(resolved)
+        self.max_pending = max_pending
+        # (entry, its reference, the references it waits for), in order
+        self._pending = []
+        self._missing = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, entries):
+        """Add a batch of entries; returns those that are ready to deliver, in order"""
+        start = len(self._pending)
+        wake = False
+        for entry in entries:
+            ref = entry_reference(entry)
+            refs = set()
+            resource = entry.get("resource")
+            if resource is not None:
+                for holder in index_references(resource, []):
+                    if holder["reference"] not in self.resolved:
+                        refs.add(holder["reference"])
+            refs.discard(ref)
+            self._pending.append((entry, ref, refs))
+            wake = wake or ref in self._missing
+        # the entries held before can only be released by a resource they wait for
+        ready = self._release(0 if wake else start)
+        if len(self._pending) > self.max_pending:
+            ready.extend(self.flush())
+        return ready
+
+    def flush(self):
+        """Release every entry still waiting"""
+        return self._release(0, final=True)
+
+    def _release(self, start, final=False):
+        scope = self._pending[start:]
+        held = {ref for _, ref, _ in self._pending[:start]}
+        position = {}
+        for n, (_, ref, _) in enumerate(scope):
+            if ref is not None:
+                position[ref] = n
+        edges = []
+        blocked = []
+        for _, _, refs in scope:
+            targets = set()
+            waiting = False
+            for ref in refs:
+                target = position.get(ref)
+                if target is not None:
+                    targets.add(target)
+                elif ref in held or not (final or ref in self.resolved):
+                    waiting = True
+            edges.append(targets)
+            blocked.append(waiting)
+
+        # components come dependencies first: one waits if a member or a dependency does
+        for component in strongly_connected(edges):
+            members = set(component)
+            waiting = any(blocked[node] for node in component) or any(
+                blocked[target]
+                for node in component
+                for target in edges[node]
+                if target not in members
+            )
+            for node in component:
+                blocked[node] = waiting
+
+        ready = []
+        waiting = []
+        for n, item in enumerate(scope):
+            if blocked[n]:
+                waiting.append(item)
+            else:
+                ready.append(item[0])
+                if item[1] is not None:
+                    self.resolved.add(item[1])
+        if final:
+            # resources that did not come are not waited for again
+            self.resolved.update(self._missing)
+        if not start:
+            self._missing = set()
+        self._pending = self._pending[:start] + waiting
+        for _, _, refs in waiting:
+            self._missing.update(ref for ref in refs if ref not in self.resolved)
+        return ready
+
+
+def planned(batches, limiter, concurrency=1, resolved=(), max_pending=1000):
+    """Plan a stream of batches into levels as their entries become ready (see Planner).
+
+    Ready entries are planned once there are enough to keep ``concurrency``
+    batches of the limiter's batch size (at the time) in flight, so the
+    first levels are posted while later pages are still being cloned.  An
+    entry's references to entries planned before are ignored: those levels
+    were all delivered before it.
+    """
+    planner = Planner(resolved, max_pending)
+    ready = []
+    for batch in batches:
+        ready.extend(planner.add(batch))
+        if len(ready) >= concurrency * limiter.batch_size:
+            yield from plan_levels(ready, limiter.batch_size)
+            ready = []
+    ready.extend(planner.flush())
+    if ready:
+        yield from plan_levels(ready, limiter.batch_size)
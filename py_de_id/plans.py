@@ -0,0 +1,117 @@
+import hashlib
+import os
+import threading
+import time
+
+import cherrypy
+import yaml
+
+from .rules import RulePlan, validate_config
+
+
+class PlanManager(object):
+    """The rule plan compiled from the rules file, reloaded when the file changes.
+
+    A thread started by start() looks at the file's modification time and
+    size every ``interval`` seconds.  A changed file is parsed, validated
+    and compiled on that thread and the new plan swapped in with a single
+    assignment; a file that does not validate is logged and ignored, and
+    the previous plan stays.  A job takes ``plan`` once when it starts and
+    keeps that version to the end, so de-identifying a resource never
+    looks at the manager.
+    """
+
+    def __init__(self, path, interval=2.0):
+        self.path = path
+        self.interval = interval
+        self.plan = None
+        self.digest = None
+        self.loaded = None
+        self.error = None
+        self._stamp = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.check()
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self):
+        """Load the rules file if it changed since it was last loaded.
+
+        Returns True when a new plan was swapped in.  The first load is
+        lenient: rules that do not compile are left out with a warning, as
+        RulePlan does, rather than keeping the service from starting.
+        """
+        with self._lock:
+            try:
+                stamp = self._stat()
+                if stamp == self._stamp:
+                    return False
+                with open(self.path, "rb") as file:
+                    text = file.read()
+            except OSError as e:
+                if self.plan is None:
+                    raise
+                self._reject(f"Can not read {self.path}: {e}")
+                return False
+            self._stamp = stamp
+            digest = hashlib.sha256(text).hexdigest()
+            if digest == self.digest:
+                return False
+            try:
+                config = yaml.safe_load(text)
+                if self.plan is not None:
+                    validate_config(config)
+            except (yaml.YAMLError, ValueError) as e:
+                if self.plan is None:
+                    raise
+                self._reject(f"Ignoring the rules in {self.path}: {e}")
+                return False
+            version = self.plan.version + 1 if self.plan else 1
+            plan = RulePlan(config, version)
+            self.digest = digest
+            self.loaded = time.time()
+            self.error = None
+            self.plan = plan
+        cherrypy.log(f"Loaded version {version} of the rules from {self.path} ({digest[:12]})")
+        return True
+
+    def _reject(self, message):
+        self.error = message
+        cherrypy.log(message)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                cherrypy.log(f"Failed to reload the rules: {e}", traceback=True)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._watch, name="rules-watcher")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+
+    def stats(self):
+        plan = self.plan
+        return {
+            "path": self.path,
+            "version": plan.version,
+            "digest": self.digest,
+            "loaded": self.loaded,
+            "resource_types": sorted(plan.actions),
+            "error": self.error,
+        }
@@ -1,357 +1,963 @@
 import os
-import sys
 import json
 import threading
 import time
-import random
-import string
-from datetime import date, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from uuid import uuid1
 
 import requests
-import yaml
 import cherrypy
 import shutil
+import tempfile
+
+from . import codec
+from .plans import PlanManager
+from .clone import (
+    PendingEntries,
+    ReferenceMap,
+    clone_entry,
+    deidentify_entries,
+    rewrite_references,
+)
+from .delta import DeltaMap
+from .metrics import BYTES, REGISTRY, RESOURCES, RULE_EXECUTIONS, RULE_SECONDS, THROTTLED, Gauge
+from .logs import debug, debug_enabled, redacted
+from .lazy import Lazy
+from .jobs import (
+    CLONING,
+    DELIVERING,
+    DONE,
+    FAILED,
+    FETCHING,
+    QUEUED,
+    JobQueueFull,
+    JobScheduler,
+)
+from .parallel import ClonePool
+from .pipeline import background
+from .placeholders import placeholder_cache
+from .planner import planned
+from .scheduler import delivery_scheduler, retry_after
+from .sessions import base_url, session_pool
+from .store import JobStore, entry_key
+from .tracing import observe_stage, tracer
+from .stream import CHUNK_SIZE, BundleReader, read_chunks, read_ndjson
 
 # this file's parent directory
 PROJECT_DIR = (
     Path(Path(__file__).parent.resolve().absolute()).parent.resolve().absolute()
 )
 
+# Importing this module only defines things: the rules, the job store and
+# the directories are set up when they are first used (see Lazy).
+
 is_healthy = False
-if os.path.isdir("/data"):
+if os.environ.get("PYDEID_INPUT_DIR"):
+    base_dir = os.environ["PYDEID_INPUT_DIR"]
+elif os.path.isdir("/data"):
     base_dir = os.path.join("/data", "input")
 else:
     base_dir = os.path.join(PROJECT_DIR, "input")
 
-os.makedirs(base_dir, exist_ok=True)
+# The rules, reloaded when the file changes (checked every PYDEID_CONFIG_POLL
+# seconds). A relative path is looked up in the working directory, then in
+# the project directory.
+CONFIG_PATH = os.environ.get("PYDEID_CONFIG", "./assets/config.yaml")
+CONFIG_POLL = float(os.environ.get("PYDEID_CONFIG_POLL", "2"))
 
-with open("./assets/config.yaml") as f:
-    config = yaml.safe_load(f)
 
-cherrypy.log(f"config is {config}")
+def load_plans():
+    path = CONFIG_PATH
+    if not os.path.isabs(path) and not os.path.exists(path):
+        path = os.path.normpath(os.path.join(PROJECT_DIR, path))
+    manager = PlanManager(path, CONFIG_POLL)
+    debug("config is %s", manager.plan.config)
+    return manager
 
 
-def randomize(field_name, old_value, params):
-    if "date" in field_name.lower():
-        seed = date.fromisoformat(old_value)
-        start_date = seed - timedelta(days=params["min"])
-        end_date = seed + timedelta(days=params["max"])
-        delta = (end_date - start_date).days
-        random_day = random.randint(0, delta)
+plan_manager = Lazy(load_plans)
 
-        return (start_date + timedelta(random_day)).isoformat()
-    if isinstance(old_value, float):
-        min_val = old_value - params["max"]
-        max_val = old_value + params["max"]
-        return round(random.uniform(min_val, max_val), 2)
-    if isinstance(old_value, int):
-        min_val = old_value - abs(params["min"])
-        max_val = old_value + params["max"]
-        return random.randint(min_val, max_val)
 
-    length = len(old_value)
-    if "length" in params and isinstance(params["length"], int):
-        length = params["length"]
-    new_str = "".join(random.choices(string.printable, k=length))
-    return new_str
+def __getattr__(name):
+    # rule_plan and config are the rules the service started with
+    if name in ("rule_plan", "config"):
+        plan = plan_manager.plan
+        globals().update(rule_plan=plan, config=plan.config)
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-def deidentify_fhir_resource(transaction_id, resource):
-    del resource["meta"]
-    if resource["resourceType"] in config:
-        cherrypy.log(
-            f"{transaction_id}: Processing rules for {resource['resourceType']}"
-        )
-        for key in ["*", resource["resourceType"]]:
-            for rule in config[key]:
-                if rule["field"] in resource:
-                    # erase the field
-                    if rule["action"] == "erase":
-                        del resource[rule["field"]]
-                    # replace the field
-                    elif rule["action"] == "replace":
-                        resource[rule["field"]] = rule["params"]
-                    # randomize - using the original as the seed
-                    elif rule["action"] == "randomize":
-                        old_value = resource[rule["field"]]
-                        resource[rule["field"]] = randomize(
-                            rule["field"], old_value, rule["params"]
-                        )
-                    # merge
-                    elif rule["action"] == "merge":
-                        cherrypy.log(f"{transaction_id}: Processing merge rule {rule}")
-                        input = resource[rule["field"]]
-                        for item in rule["params"]:
-                            try:
-                                cherrypy.log(
-                                    f"Processing param: {item}",
-                                )
-                                new_rule = item.replace("%input%", "input")
-                                input = eval(new_rule)
-                            except Exception as e:
-                                cherrypy.log(
-                                    f"{transaction_id}: Exception while processing: {e}"
-                                )
-                        resource[rule["field"]] = input
-                    else:
-                        cherrypy.log(
-                            f"{transaction_id}: Unknown rule.action {rule}",
-                            file=sys.stderr,
-                        )
-    return resource
-
-
-def deliver_clone(transaction_id):
-    cherrypy.log(
-        f"{transaction_id}: Delivering clone {base_dir}/{transaction_id}/clone.json"
-    )
+# How far fetching may run ahead of cloning (pages), and cloning ahead of delivery (batches)
+PAGE_QUEUE_SIZE = 2
+BATCH_QUEUE_SIZE = 4
+# Transaction batches posted to a target at once, unless the job asks for more
+DELIVERY_CONCURRENCY = 1
+# A batch the target throttles this many times fails its job; other failures are retried once
+MAX_THROTTLED = 20
+# Entries held back waiting for the resources they refer to, at most (see planner.Planner)
+PLAN_PENDING = 1000
 
-    # TODO: Almost anything but this
-    with open(f"{base_dir}/{transaction_id}.json", "r") as file:
-        content = file.read()
-        data = json.loads(content)
+# Jobs run on a fixed pool of workers; callers are asked to come back later
+# (Retry-After seconds) when the queue, or their tenant's share of it, is full
+JOB_WORKERS = 8
+JOB_QUEUE_SIZE = 100
+JOB_QUEUE_PER_TENANT = 25
+JOB_RETRY_AFTER = 30
 
-    headers = {
-        "Authorization": f"Bearer {data['target_token']}",
-        "Content-Type": "application/fhir+json",
-    }
 
-    cherrypy.log(f"{transaction_id}: Reading the clone")
-    with open(f"{base_dir}/{transaction_id}/clone.json", "r") as file:
-        content = file.read()
-        bundle = json.loads(content)
+def open_job_store():
+    os.makedirs(base_dir, exist_ok=True)
+    return JobStore(os.path.join(base_dir, "jobs.db"))
 
-    # Only create resources that are specific to this patient (i.e. hasattr 'request')
 
-    newBundleEntry = bundle["entry"]
+# Jobs, their cloned batches and what has been delivered survive a restart
+job_store = Lazy(open_job_store)
 
-    batch_size = 15
-    cherrypy.log(
-        f"{transaction_id}: There are {len(newBundleEntry)} resources to post.  ({len(newBundleEntry)} // {batch_size}) + {bool(len(newBundleEntry) % batch_size)}"
+job_scheduler = JobScheduler(
+    JOB_WORKERS, JOB_QUEUE_SIZE, JOB_QUEUE_PER_TENANT, store=job_store
+)
+
+# Jobs run on the job workers, a thread each - or with PYDEID_ENGINE=async as
+# tasks on one event loop, up to ASYNC_JOBS at once (see aio.AsyncEngine)
+ENGINE = os.environ.get("PYDEID_ENGINE", "threads")
+ASYNC_JOBS = int(os.environ.get("PYDEID_ASYNC_JOBS", "1000"))
+
+
+def start_async_engine():
+    from .aio import AsyncEngine
+
+    return AsyncEngine(ASYNC_JOBS, JOB_QUEUE_PER_TENANT * ASYNC_JOBS // JOB_QUEUE_SIZE)
+
+
+async_engine = Lazy(start_async_engine) if ENGINE == "async" else None
+
+
+def submit_job(transaction_id, tenant):
+    """Run a stored job on the engine in use"""
+    if async_engine is not None:
+        async_engine.submit(transaction_id, tenant)
+    else:
+        job_scheduler.submit(transaction_id, tenant, process_request, transaction_id)
+
+
+Gauge(
+    "pydeid_jobs",
+    "Jobs running and queued",
+    lambda: {(state,): job_scheduler.stats()[state] for state in ("running", "queued")},
+    ("state",),
+)
+
+Gauge("pydeid_rules_version", "Version of the rules in use", lambda: plan_manager.plan.version)
+
+# The $everything bundles of a cohort fetched at once, unless the job asks for more
+COHORT_CONCURRENCY = 4
+
+# Entries are de-identified this many at a time, a column per field (see RulePlan.apply_many)
+DEID_COLUMN_SIZE = 500
+
+# Clone large bundles across this many processes (0 clones on the job's thread)
+CLONE_PROCESSES = int(os.environ.get("PYDEID_CLONE_PROCESSES", "0"))
+
+clone_pool = (
+    Lazy(lambda: ClonePool(CLONE_PROCESSES, plan_manager.plan.config))
+    if CLONE_PROCESSES
+    else None
+)
+
+# Jobs are cloned in memory. A page larger than this is spooled to a
+# temporary file and parsed from there, and a job whose clone grows larger
+# has its batches kept in the job store so it can resume without fetching.
+SPILL_BYTES = int(os.environ.get("PYDEID_SPILL_BYTES", str(8 * 1024 * 1024)))
+# Keep the fetched pages and the cloned entries of every job in its directory
+DEBUG_COPIES = os.environ.get("PYDEID_DEBUG_COPIES", "").lower() in ("1", "true", "yes")
+
+
+def deidentify_fhir_resource(resource, plan=None):
+    return (plan or plan_manager.plan).apply(resource)
+
+
+def transaction_body(entries):
+    """The encoded transaction bundle of a batch of entries"""
+    body = codec.dumps({"resourceType": "Bundle", "type": "transaction", "entry": entries})
+    BYTES.inc(len(body), ("posted",))
+    return body
+
+
+def batch_status(transaction_id, status, headers, content, locations=None):
+    """Read the answer to a transaction bundle (see post_batch)"""
+    if status == 429:
+        return status, retry_after(headers)
+
+    try:
+        response = codec.loads(content)
+    except ValueError:
+        response = None
+    # cherrypy.log(f"{transaction_id}: response is {response}",  level=cherrypy.log.DEBUG)
+    if response:
+        verbose = debug_enabled()
+        for entry in response.get("entry", []):
+            if locations is not None:
+                locations.append(entry.get("response", {}).get("location"))
+            if "response" in entry:
+                entry_status = str(entry["response"]["status"])
+                if entry_status.startswith("201"):
+                    if verbose:
+                        debug("%s: Created %s", transaction_id, entry["response"]["location"])
+                elif entry_status.startswith("429"):
+                    issues = entry["response"].get("issue") or entry["response"].get(
+                        "outcome", {}
+                    ).get("issue", [{}])
+                    return 429, retry_after(headers, issues[0].get("diagnostics"))
+    else:
+        cherrypy.log(f"{transaction_id}: Unexpected null result")
+    return status, None
+
+
+def post_batch(transaction_id, session, url, entries, locations=None):
+    """POST one transaction bundle.
+
+    Returns the status code (429 when throttled) and, when throttled, the
+    number of seconds the server asked us to wait.  The location of every
+    entry in the response is appended to locations, if given.
+    """
+    result = session.post(
+        url,
+        data=transaction_body(entries),
+        headers={"Content-Type": "application/fhir+json"},
     )
-    num_of_batches = (len(newBundleEntry) // batch_size) + bool(
-        divmod(len(newBundleEntry), batch_size)
+    return batch_status(
+        transaction_id, result.status_code, result.headers, result.content, locations
     )
 
-    batch_no = 0
-    while len(newBundleEntry) > 0:
-        cherrypy.log(
-            f"{transaction_id}: Sending batch {batch_no+1} of {num_of_batches} resources to {data['fhir_target'][:-1]}",
-        )
 
-        request = {
-            "resourceType": "Bundle",
-            "type": "transaction",
-            "entry": newBundleEntry[:batch_size],
-        }
+def deliver_batches(transaction_id, data, batches, delta=None, record=True):
+    """POST batches of entries to the target at the pace its scheduler allows,
+    in levels of batches that reference only earlier levels (see planner.planned).
+    Without record (a delivery that is not a job) nothing is kept in the job store."""
+    url = data["fhir_target"][:-1]
+    concurrency = int(data.get("concurrency", DELIVERY_CONCURRENCY))
+    limiter = delivery_scheduler.target(url)
+
+    def deliver(batch_no, batch):
+        job_scheduler.update(transaction_id, DELIVERING)
+        failures = throttles = 0
+        while True:
+            start = time.monotonic()
+            limiter.acquire()
+            tracer.span(transaction_id, "pacing", time.monotonic() - start, batch=batch_no + 1)
+            debug(
+                "%s: Sending batch %d of %d resources to %s",
+                transaction_id, batch_no + 1, len(batch), url,
+            )
+            start = time.monotonic()
+            locations = []
+            status, delay = post_batch(transaction_id, session, url, batch, locations=locations)
+            latency = time.monotonic() - start
+            observe_stage(
+                transaction_id, "deliver", latency,
+                batch=batch_no + 1, entries=len(batch), status=status,
+            )
+            if status == 200:
+                limiter.succeeded(latency)
+                if record:
+                    job_store.acknowledge(transaction_id, batch)
+                    placeholder_cache.acknowledge(url, batch)
+                if delta is not None:
+                    job_store.record_clones(lineage(data), delta.acknowledge(batch, locations))
+                return
+            if status == 429:
+                cherrypy.log(
+                    f"{transaction_id}: Too many requests. Throttling {delay}s",
+                )
+                THROTTLED.inc(labels=(url,))
+                limiter.throttled(delay)
+                throttles += 1
+                if throttles < MAX_THROTTLED:
+                    # sent again once the limiter lets it, not counted as a failure
+                    continue
+                raise requests.exceptions.HTTPError(
+                    f"Batch {batch_no + 1} was throttled {throttles} times"
+                )
+            cherrypy.log(f"{transaction_id}: Batch {batch_no + 1} failed with {status}")
+            failures += 1
+            if failures == 2:
+                raise requests.exceptions.HTTPError(
+                    f"Batch {batch_no + 1} failed twice, last status {status}"
+                )
+            cherrypy.log(f"{transaction_id}: Retrying batch {batch_no + 1}")
 
-        result = requests.post(
-            f"{data['fhir_target'][:-1]}",
-            json=request,
-            headers=headers,
-        )
+    # what the target has already: nothing waits for it
+    resolved = placeholder_cache.references(url)
+    if record:
+        resolved |= job_store.delivered(transaction_id)
+    if delta is not None:
+        resolved.update(target for target, _ in delta.previous.values())
 
-        status = result.status_code
-
-        response = result.json()
-        # cherrypy.log(f"{transaction_id}: response is {response}",  level=cherrypy.log.DEBUG)
-        if response:
-            if "entry" in response:
-                for entry in response["entry"]:
-                    if "response" in entry:
-                        if entry["response"]["status"] == 201:
-                            cherrypy.log(
-                                f"{transaction_id}: Created {entry['response']['location']}"
-                            )
-                        elif entry["response"]["status"] == 429:
-                            diagnostics = json.loads(
-                                entry["response"]["issue"][0]["diagnostics"]
-                            )
-                            throttle_time = diagnostics._msBeforeNext
-                            cherrypy.log(
-                                f"{transaction_id}: Too many requests. Throttling {throttle_time}",
-                            )
-                            time.sleep(throttle_time / 1000)
-                            cherrypy.log(
-                                f"{transaction_id}: Retrying batch {batch_no + 1}"
-                            )
-                            status = 429
-        else:
-            cherrypy.log(f"{transaction_id}: Unexpected null result", file=sys.stderr)
+    with session_pool.session(url, data["target_token"]) as session:
+        levels = planned(batches, limiter, concurrency, resolved, PLAN_PENDING)
+        if concurrency <= 1:
+            batches = (batch for level in levels for batch in level)
+            for batch_no, batch in enumerate(batches):
+                deliver(batch_no, batch)
+            return
+
+        batch_no = 0
+        with ThreadPoolExecutor(concurrency) as executor:
+            for level in levels:
+                futures = [
+                    executor.submit(deliver, batch_no + n, batch) for n, batch in enumerate(level)
+                ]
+                batch_no += len(level)
+                for future in futures:
+                    future.result()
 
-        if status == 200:
-            del newBundleEntry[:15]
-            batch_no += 1
-        else:
-            newBundleEntry[:0] = request["entry"]
+
+def remove_job(transaction_id):
+    if not DEBUG_COPIES:
+        shutil.rmtree(f"{base_dir}/{transaction_id}", ignore_errors=True)
+
+
+def debug_copy(transaction_id, name, mode="ab"):
+    """Open a file for a debug copy in the job's directory"""
+    work_dir = f"{base_dir}/{transaction_id}"
+    os.makedirs(work_dir, exist_ok=True)
+    return open(f"{work_dir}/{name}", mode)
+
+
+def deliver_clone(transaction_id, bundle=None):
+    """Deliver a cloned bundle - by default the one saved in the job's directory"""
+    cherrypy.log(f"{transaction_id}: Delivering clone")
+
+    data = job_store.job(transaction_id)["data"]
+
+    if bundle is None:
+        cherrypy.log(f"{transaction_id}: Reading the clone")
+        with open(f"{base_dir}/{transaction_id}/clone.json", "rb") as file:
+            bundle = codec.loads(file.read())
+
+    # Only create resources that are specific to this patient (i.e. hasattr 'request')
+
+    newBundleEntry = bundle["entry"]
+
+    cherrypy.log(
+        f"{transaction_id}: There are {len(newBundleEntry)} resources to post"
+    )
+    deliver_batches(transaction_id, data, [newBundleEntry])
 
     cherrypy.log(f"{transaction_id}: The clone was delivered")
     # Clean up the transaction
-    shutil.rmtree(f"{base_dir}/{transaction_id}")
-    os.remove(f"{base_dir}/{transaction_id}.json")
-
-
-def clone_bundle(transaction_id, deid):
-    cherrypy.log(f"{transaction_id}: clone_bundle()")
-
-    def replace_reference(obj, referenceMap):
-        new_references = []
-        if "reference" in obj and "/" in obj["reference"]:
-            ref = obj["reference"]
-
-            if ref not in referenceMap:
-                # Add these references for data-integrity purposes
-                if (
-                    ref.startswith("Organization/")
-                    or ref.startswith("Practitioner/")
-                    or ref.startswith("Location/")
-                ):
-                    cherrypy.log(f"{transaction_id}: Creating dummy resource for {ref}")
-                    dummy_resource = {
-                        "resourceType": ref.split("/")[0],
-                        "id": str(uuid1()),
-                        "name": f"unknown-{ref.split('/')[0].lower()}",
-                        "identifier": [
-                            {
-                                "system": "my-elixir",
-                                "value": f"unknown-{ref.split('/')[0].lower()}",
-                            }
-                        ],
-                    }
-                    referenceMap[f"{ref}"] = (
-                        f'{dummy_resource["resourceType"]}/{dummy_resource["id"]}'
-                    )
-                    new_references.append(dummy_resource)
-                cherrypy.log(f"{transaction_id}: {ref} not found")
-            else:
-                obj["reference"] = f"{referenceMap[ref]}"
-                if "display" in obj:
-                    obj["display"] = f"{referenceMap[ref]}"
-        for _, value in obj.items():
-            if isinstance(value, dict):
-                child_references = replace_reference(value, referenceMap)
-                if child_references:
-                    new_references.extend(child_references)
-        return new_references
-
-    with open(f"{base_dir}/{transaction_id}/bundle.json", "r") as file:
-        bundleData = json.load(file)
-        bundleData["type"] = "transaction"
-        del bundleData["link"]
-
-        referenceMap = {}
-
-        for entry in bundleData["entry"]:
-            if "resource" not in entry or "id" not in entry["resource"]:
-                # log a warning
-                cherrypy.log(f"{transaction_id}: There is no resource in entry {entry}")
-            else:
-                if deid:
-                    entry["resource"] = deidentify_fhir_resource(
-                        transaction_id, entry["resource"]
-                    )
-
-                newResourceId = str(uuid1())
-
-                referenceMap[
-                    f'{entry["resource"]["resourceType"]}/{entry["resource"]["id"]}'
-                ] = f'{entry["resource"]["resourceType"]}/{newResourceId}'
-
-                referenceMap[f'{entry["resource"]["resourceType"]}/{newResourceId}'] = (
-                    f'{entry["resource"]["resourceType"]}/{entry["resource"]["id"]}'
-                )
+    remove_job(transaction_id)
 
-                entry["resource"]["id"] = newResourceId
 
-                if "search" in entry:
-                    del entry["search"]
-                if "fullUrl" in entry:
-                    del entry["fullUrl"]
-                # Entries without fullUrl are not specific to this patient
-                entry["request"] = {
-                    "method": "POST",
-                    "url": f"{entry['resource']['resourceType']}",
-                }
+def clone_bundle(transaction_id, deid, bundleData=None):
+    """Clone a bundle (by default the one saved in the job's directory), then deliver it.
 
-        for entry in bundleData["entry"]:
-            new_references = replace_reference(entry, referenceMap)
+    Every resource is cloned and its references indexed in one pass; the
+    references are then rewritten together, so a reference to a resource
+    that is not in the bundle is left as it is, or, for an Organization,
+    Practitioner or Location, pointed at the target's placeholder.
+    """
+    debug("%s: clone_bundle()", transaction_id)
 
-            if new_references:
-                bundleData["entry"].extend(new_references)
+    job = job_store.job(transaction_id)
+    target = job["data"]["fhir_target"][:-1] if job else None
 
-    with open(f"{base_dir}/{transaction_id}/clone.json", "w") as fileOut:
-        json.dump(bundleData, fileOut)
-    cherrypy.log(
-        f"{transaction_id}: Cloned bundle {base_dir}/{transaction_id}/clone.json"
+    if bundleData is None:
+        with open(f"{base_dir}/{transaction_id}/bundle.json", "rb") as file:
+            bundleData = codec.loads(file.read())
+    bundleData["type"] = "transaction"
+    bundleData.pop("link", None)
+
+    referenceMap = ReferenceMap()
+    plan = plan_manager.plan if deid else None
+    index = []
+
+    for entry in bundleData["entry"]:
+        if clone_entry(entry, referenceMap, plan, index) is None:
+            cherrypy.log(f"{transaction_id}: There is no resource in entry {entry}")
+
+    start = time.perf_counter()
+    placeholders, missing = rewrite_references(
+        index, referenceMap, placeholder_cache.resolver(target)
     )
-    deliver_clone(transaction_id)
+    observe_stage(transaction_id, "references", time.perf_counter() - start)
+    for ref in placeholders:
+        debug("%s: Creating dummy resource for %s", transaction_id, ref)
+    for ref in missing:
+        debug("%s: %s not found", transaction_id, ref)
+    bundleData["entry"].extend(placeholders.values())
+
+    if DEBUG_COPIES:
+        with open(f"{base_dir}/{transaction_id}/clone.json", "wb") as fileOut:
+            fileOut.write(codec.dumps(bundleData))
+        cherrypy.log(
+            f"{transaction_id}: Cloned bundle {base_dir}/{transaction_id}/clone.json"
+        )
+    deliver_clone(transaction_id, bundleData)
+
+
+class Cloner(object):
+    """The state of cloning one job's pages into batches to deliver.
+
+    add() clones a page, yielding each batch as it is filled, and finish()
+    releases what is left, so whoever drives it decides where the pages
+    come from and on which thread the work runs (see clone_batches).
+    """
+
+    def __init__(
+        self, transaction_id, data, batch_size=15, namespace=None, referenceMap=None, plan=None
+    ):
+        self.transaction_id = transaction_id
+        self.batch_size = batch_size
+        self.deid = data["deid"]
+        self.pool = clone_pool if referenceMap is None else None
+        self.referenceMap = ReferenceMap(namespace) if referenceMap is None else referenceMap
+        self.plan = (plan or plan_manager.plan) if data["deid"] else None
+        self.pending = PendingEntries(
+            self.referenceMap, placeholder_cache.resolver(data["fhir_target"][:-1])
+        )
+        self.batch = []
+        # time spent cloning the batch being filled, not waiting for pages
+        self.elapsed = 0.0
+
+    def _clone(self, page):
+        page = iter(page)
+        for entries in iter(lambda: list(islice(page, DEID_COLUMN_SIZE)), []):
+            if self.plan:
+                deidentify_entries(entries, self.referenceMap, self.plan)
+            for entry in entries:
+                linked = []
+                yield entry, clone_entry(entry, self.referenceMap, linked=linked), linked
+
+    def add(self, page):
+        """Clone the entries of a page, yielding every batch filled"""
+        job_scheduler.update(self.transaction_id, CLONING)
+        start = time.perf_counter()
+        if self.pool:
+            entries = self.pool.clone(page, self.referenceMap, self.deid, self.plan)
+        else:
+            entries = self._clone(page)
+        for entry, ref, linked in entries:
+            if ref is None:
+                cherrypy.log(f"{self.transaction_id}: There is no resource in entry {entry}")
+                continue
+            RESOURCES.inc(labels=(entry["resource"]["resourceType"],))
+            self.batch.extend(self.pending.add(entry, ref, linked))
+            if len(self.batch) >= self.batch_size:
+                observe_stage(
+                    self.transaction_id, "clone", self.elapsed + time.perf_counter() - start,
+                    entries=len(self.batch),
+                )
+                batch, self.batch = self.batch, []
+                yield batch
+                self.elapsed = 0.0
+                start = time.perf_counter()
+        self.elapsed += time.perf_counter() - start
+
+    def finish(self):
+        """Yield the last batch, with the entries still held back pointed at placeholders"""
+        self.batch.extend(self.pending.flush())
+        if debug_enabled():
+            for ref in self.pending.redirected:
+                debug("%s: Using the placeholder for %s", self.transaction_id, ref)
+            for ref in self.referenceMap:
+                if ref not in self.pending.cloned and ref not in self.pending.redirected:
+                    debug("%s: %s not found", self.transaction_id, ref)
+        if self.batch:
+            observe_stage(self.transaction_id, "clone", self.elapsed, entries=len(self.batch))
+            batch, self.batch = self.batch, []
+            yield batch
+
+
+def clone_batches(
+    transaction_id, data, pages, batch_size=15, namespace=None, referenceMap=None, plan=None
+):
+    """De-identify and re-key the entries of every page, yielding batches to deliver (see Cloner)"""
+    cloner = Cloner(transaction_id, data, batch_size, namespace, referenceMap, plan)
+    for page in pages:
+        yield from cloner.add(page)
+    yield from cloner.finish()
+
+
+def clone_pages(transaction_id, data, pages, batch_size=15, plan=None):
+    """Clone and deliver the pages of a bundle, storing its batches once it is larger than SPILL_BYTES"""
+    debug("%s: clone_pages()", transaction_id)
+    job = job_store.job(transaction_id)
+    delivered = job_store.delivered(transaction_id)
+    if delivered:
+        cherrypy.log(f"{transaction_id}: {len(delivered)} resources were already delivered")
+    job_store.restart(transaction_id)
+    delta = None
+    if data.get("delta"):
+        key = lineage(data)
+        delta = DeltaMap(job_store.lineage(key), job_store.clones(key))
+
+    def stored():
+        held = []
+        size = 0
+        for batch in clone_batches(
+            transaction_id, data, pages, batch_size, job["namespace"], delta, plan
+        ):
+            batch = [entry for entry in batch if entry_key(entry) not in delivered]
+            if delta is not None:
+                batch = delta.changes(batch)
+            if not batch:
+                continue
+            if delta is None and held is None:
+                job_store.add_batch(transaction_id, batch)
+            elif delta is None:
+                encoded = codec.dumps(batch)
+                held.append(encoded)
+                size += len(encoded)
+                if size > SPILL_BYTES:
+                    cherrypy.log(f"{transaction_id}: Storing the clone, it is over {SPILL_BYTES} bytes")
+                    for encoded in held:
+                        job_store.add_batch(transaction_id, encoded)
+                    held = None
+            if DEBUG_COPIES:
+                with debug_copy(transaction_id, "clone.ndjson") as file:
+                    file.writelines(codec.dumps(entry) + b"\n" for entry in batch)
+            yield batch
+        if held is None:
+            job_store.cloned(transaction_id)
+
+    batches = background(stored(), BATCH_QUEUE_SIZE)
+    deliver_batches(transaction_id, data, batches, delta)
+    if delta is not None:
+        cherrypy.log(
+            f"{transaction_id}: {delta.counts['new']} new, {delta.counts['changed']} changed"
+            f" and {delta.counts['unchanged']} unchanged resources"
+        )
+    cherrypy.log(f"{transaction_id}: The clone was delivered")
+    remove_job(transaction_id)
+
+
+def lineage(data):
+    """What a delta job clones again and again: its source (the patient's
+    $everything, or a cohort's patients) to its target"""
+    if data.get("patients"):
+        return f'{data["fhir_source"]}{",".join(data["patients"])}|{data["fhir_target"]}'
+    return f'{data["fhir_source"]}|{data["fhir_target"]}'
+
+
+def stream_clone(transaction_id, data, chunks, batch_size=15):
+    """Clone a bundle from a stream of bytes, delivering it as batches are filled.
+
+    Entries are de-identified and re-keyed as they are parsed, so only a few
+    batches are held in memory.
+    """
+    clone_pages(transaction_id, data, [BundleReader(chunks)], batch_size)
+
+
+def stream_deidentify(chunks, ndjson=False, deid=True, target=None, batch_size=15):
+    """De-identify and re-key a Bundle - or NDJSON resources - from a stream of
+    bytes, yielding the resources as NDJSON as they are cloned.
+
+    Nothing is fetched, delivered or written to disk.  Placeholders are
+    minted for target (if given) and yielded with the resources.
+    """
+    transaction_id = str(uuid1())
+    chunks = iter(chunks)
+    if ndjson:
+        entries = ({"resource": resource} for resource in read_ndjson(chunks))
+    else:
+        entries = BundleReader(chunks)
+    data = {"deid": deid, "fhir_target": (target or "").rstrip("/") + "/"}
+    for batch in clone_batches(transaction_id, data, [entries], batch_size):
+        yield b"".join([codec.dumps(entry["resource"]) + b"\n" for entry in batch])
+    # whatever follows the Bundle, so the connection can be reused
+    for _ in chunks:
+        pass
+
+
+def request_body(rfile, chunk_size=CHUNK_SIZE):
+    """Iterate over a request body in chunks, even once the answer has started.
+
+    cheroot throws away the unread part of a body with a Content-Length
+    when it sends the response headers, so such a body is read straight
+    from the connection instead.
+    """
+    remaining = getattr(rfile, "remaining", None)
+    source = getattr(rfile, "rfile", None)
+    if remaining is None or source is None:
+        yield from read_chunks(rfile, chunk_size)
+        return
+    rfile.remaining = 0
+    while remaining:
+        chunk = source.read(min(chunk_size, remaining))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def next_link(bundle):
+    for link in bundle.get("link", []):
+        if link.get("relation") == "next":
+            return link["url"]
+    return None
+
+
+def read_page(transaction_id, chunks, page_no):
+    """Read a page of $everything, returning it and its next link.
+
+    A page up to SPILL_BYTES is parsed in memory.  A larger one is spooled
+    to a temporary file and returned as a BundleReader over the file; it is
+    scanned for its links first, so the next page can be fetched while it
+    is cloned.
+    """
+    body = []
+    size = 0
+    for chunk in chunks:
+        body.append(chunk)
+        size += len(chunk)
+        if size > SPILL_BYTES:
+            break
+    else:
+        page = codec.loads(b"".join(body))
+        return page.get("entry", []), next_link(page)
+
+    cherrypy.log(f"{transaction_id}: Spooling page {page_no}, it is over {SPILL_BYTES} bytes")
+    spool = tempfile.TemporaryFile()
+    spool.writelines(body)
+    del body
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+    scan = BundleReader(read_chunks(spool))
+    for _ in scan:
+        if "link" in scan.fields:
+            break
+    spool.seek(0)
+    return BundleReader(spooled(spool)), next_link(scan.fields)
+
+
+def counted(chunks):
+    """Count the bytes fetched as the chunks are read"""
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        BYTES.inc(size, ("fetched",))
+
+
+def teed(chunks, file):
+    """Write the chunks to file as they are read"""
+    with file:
+        for chunk in chunks:
+            file.write(chunk)
+            yield chunk
+
+
+def spooled(spool):
+    """Read a spooled page, closing (and so deleting) the file at the end"""
+    with spool:
+        yield from read_chunks(spool)
+
+
+def fetch_pages(transaction_id, data):
+    """Yield the entries of each page of $everything, following the next links.
+
+    In stream mode each page is a BundleReader over the response, which must
+    be consumed before the next page is requested.
+    """
+    headers = {"Content-Type": "application/json"}
+    stream = data.get("stream", False)
+    url = data["fhir_source"]
+    page_no = 0
+    with session_pool.session(url, data["source_token"]) as session:
+        while url:
+            page_no += 1
+            debug("%s: Getting page %d of $everything from %s", transaction_id, page_no, url)
+            start = time.perf_counter()
+            response = session.get(url, headers=headers, stream=True)
+            debug("%s: Got %s", transaction_id, response)
+            if response.status_code != 200:
+                cherrypy.log(
+                    f"{transaction_id}: Request failed with status code: {response.status_code}",
+                )
+                cherrypy.log(f"Response Text: {response.text}")
+                raise requests.exceptions.HTTPError(
+                    f"{response.status_code} for page {page_no}", response=response
+                )
+            with response:
+                chunks = counted(response.iter_content(CHUNK_SIZE))
+                if DEBUG_COPIES:
+                    chunks = teed(chunks, debug_copy(transaction_id, f"page-{page_no}.json", "wb"))
+                if stream:
+                    # the page is read while it is cloned: only the wait for
+                    # the response counts as fetching
+                    observe_stage(transaction_id, "fetch", time.perf_counter() - start, page=page_no)
+                    page = BundleReader(chunks)
+                    yield page
+                    url = next_link(page.fields)
+                    continue
+                page, url = read_page(transaction_id, chunks, page_no)
+            observe_stage(transaction_id, "fetch", time.perf_counter() - start, page=page_no)
+            yield page
+
+
+_cohort_lock = threading.Lock()
+
+
+def report_patient(transaction_id, progress, patient_id, **fields):
+    """Update the progress of a patient of a cohort, and the job's status with it"""
+    with _cohort_lock:
+        progress[patient_id].update(fields)
+        patients = {key: dict(value) for key, value in progress.items()}
+    job_scheduler.report(transaction_id, patients=patients)
+
+
+def cohort_pages(transaction_id, data, progress):
+    """Yield the pages of the $everything of every patient of a cohort.
+
+    Up to data["cohort_concurrency"] (COHORT_CONCURRENCY by default) bundles
+    are fetched at once, over the session every job shares for the source,
+    and handed over in the order of data["patients"].  A resource that was
+    in an earlier patient's bundle (a Practitioner, Organization,
+    Medication...) is dropped, so it is cloned and delivered once.  A
+    patient whose bundle can not be fetched is marked failed in progress
+    and the others go on.
+    """
+    base = data["fhir_source"].rstrip("/")
+    concurrency = int(data.get("cohort_concurrency", COHORT_CONCURRENCY))
+    seen = set()
+
+    def fetch(patient_id):
+        report_patient(transaction_id, progress, patient_id, status=FETCHING)
+        source = dict(data, fhir_source=f"{base}/Patient/{patient_id}/$everything", stream=False)
+        return list(fetch_pages(transaction_id, source))
+
+    def unique(patient_id, page):
+        resources = shared = 0
+        for entry in page:
+            if "resource" in entry:
+                key = entry_key(entry)
+                if key in seen:
+                    shared += 1
+                    continue
+                seen.add(key)
+                resources += 1
+            yield entry
+        resources += progress[patient_id]["resources"]
+        shared += progress[patient_id]["shared"]
+        report_patient(transaction_id, progress, patient_id, resources=resources, shared=shared)
+
+    patients = iter(data["patients"])
+    with ThreadPoolExecutor(concurrency) as executor:
+        fetching = deque(
+            (patient_id, executor.submit(fetch, patient_id))
+            for patient_id in islice(patients, concurrency)
+        )
+        while fetching:
+            patient_id, future = fetching.popleft()
+            for next_id in islice(patients, 1):
+                fetching.append((next_id, executor.submit(fetch, next_id)))
+            try:
+                pages = future.result()
+            except requests.exceptions.RequestException as e:
+                cherrypy.log(f"{transaction_id}: Could not fetch patient {patient_id}: {e}")
+                report_patient(transaction_id, progress, patient_id, status=FAILED, error=str(e))
+                continue
+            report_patient(transaction_id, progress, patient_id, status=CLONING)
+            for page in pages:
+                yield unique(patient_id, page)
+            # the last page has been cloned: what is left is being delivered
+            report_patient(transaction_id, progress, patient_id, status=DELIVERING)
+
+
+def clone_cohort(transaction_id, data, plan=None):
+    """Clone and deliver the $everything of every patient of a cohort as one job.
+
+    The patients share the job's reference map, so a resource in several
+    of their bundles is cloned once and every reference to it gets the
+    same clone id; an entry referring to an Organization, Practitioner or
+    Location waits for it across the whole cohort before it goes to a
+    placeholder.  The job fails, once the others are delivered, if a
+    patient's bundle could not be fetched.
+    """
+    progress = {
+        patient_id: {"status": QUEUED, "resources": 0, "shared": 0}
+        for patient_id in data["patients"]
+    }
+    clone_pages(transaction_id, data, cohort_pages(transaction_id, data, progress), plan=plan)
+    failed = [patient_id for patient_id, patient in progress.items() if patient["status"] == FAILED]
+    for patient_id, patient in progress.items():
+        if patient["status"] != FAILED:
+            report_patient(transaction_id, progress, patient_id, status=DONE)
+    if failed:
+        raise requests.exceptions.RequestException(
+            f"Could not fetch {len(failed)} of {len(progress)} patients: {', '.join(failed)}"
+        )
 
 
 def process_request(transaction_id):
+    """Run a job: fetch, clone and deliver (a patient, or a cohort of them) -
+    or, when a previous run stored the whole clone, deliver what the target
+    has not acknowledged yet.
+
+    The job is de-identified with the version of the rules current when it
+    starts, even if they are reloaded meanwhile.
+    """
+    job_scheduler.update(transaction_id, FETCHING)
+    plan = plan_manager.plan
+    job_scheduler.report(transaction_id, rules=plan.version)
     try:
-        work_dir = f"{base_dir}/{transaction_id}"
-        filename = f"{base_dir}/{transaction_id}.json"
-
-        if not os.path.exists(work_dir):
-            cherrypy.log(f"{transaction_id}: Preparing {work_dir}")
-            os.makedirs(work_dir, exist_ok=True)
-
-        with open(filename, "r") as file:
-            content = file.read()
-            cherrypy.log(f"{transaction_id}: loaded {content}")
-            data = json.loads(content)
-            # Get the $everything bundle
-            headers = {
-                "Authorization": f"Bearer {data['source_token']}",
-                "Content-Type": "application/json",
-            }
-            cherrypy.log(
-                f"{transaction_id}: Getting $everything from {data['fhir_source']}",
-            )
-            response = requests.get(data["fhir_source"], headers=headers)
-            cherrypy.log(f"{transaction_id}: Got {response}")
-        # Check the response status code
-        if response.status_code == 200:
-            cherrypy.log("Request successful!")
-
-            # save the data
-            data_file = os.path.join(work_dir, "bundle.json")
-            with open(data_file, "w+", encoding="utf-8") as f:
-                f.write(f"{response.text}")
-
-            clone_bundle(transaction_id, data["deid"])
-        else:
-            cherrypy.log(
-                f"{transaction_id}: Request failed with status code: {response.status_code}",
-            )
-            cherrypy.log(f"Response Text: {response.text}")
+        job = job_store.job(transaction_id)
+        data = job["data"]
+        debug("%s: loaded %s", transaction_id, redacted(data))
+
+        if job["cloned"]:
+            cherrypy.log(f"{transaction_id}: Resuming delivery of the stored clone")
+            deliver_batches(transaction_id, data, job_store.batches(transaction_id))
+            cherrypy.log(f"{transaction_id}: The clone was delivered")
+            remove_job(transaction_id)
+            return
+
+        if data.get("patients"):
+            clone_cohort(transaction_id, data, plan)
+            return
+
+        # Page N+1 is fetched while page N is cloned and delivered. In stream
+        # mode the response is parsed as it arrives, so fetching and cloning
+        # happen together.
+        pages = fetch_pages(transaction_id, data)
+        if not data.get("stream", False):
+            pages = background(pages, PAGE_QUEUE_SIZE)
+        clone_pages(transaction_id, data, pages, plan=plan)
 
     except requests.exceptions.RequestException as e:
         cherrypy.log(
             f"{transaction_id}: An error occurred during the request for job {transaction_id}: {e}"
         )
+        job_scheduler.update(transaction_id, FAILED, error=str(e))
+
+
+def resume_jobs(owner=None):
+    """Queue again the jobs that were unfinished when the process (or the worker owner) stopped"""
+    for transaction_id, tenant in job_store.claim(owner):
+        cherrypy.log(f"{transaction_id}: Resuming")
+        try:
+            submit_job(transaction_id, tenant)
+        except JobQueueFull as e:
+            cherrypy.log(f"{transaction_id}: Can not resume: {e}")
+            job_store.update(transaction_id, FAILED, error=str(e))
+
+
+def job_tenant(data):
+    """Jobs are shared fairly between tenants - by default, the target servers"""
+    if data.get("tenant"):
+        return data["tenant"]
+    if data.get("fhir_target"):
+        return base_url(data["fhir_target"])
+    return "default"
+
+
+def rule_profile():
+    """Calls and time of every rule action applied, the most expensive first"""
+    calls = RULE_EXECUTIONS.collect()
+    seconds = RULE_SECONDS.collect()
+    rows = [
+        {
+            "resource_type": resource_type,
+            "field": field,
+            "action": action,
+            "calls": count,
+            "seconds": round(seconds.get((resource_type, field, action), 0.0), 6),
+            "us_per_call": round(
+                seconds.get((resource_type, field, action), 0.0) / count * 1e6, 3
+            ),
+        }
+        for (resource_type, field, action), count in calls.items()
+    ]
+    return sorted(rows, key=lambda row: -row["seconds"])
+
+
+class Debug(object):
+    """/debug: where the time goes"""
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def rules(self):
+        """Calls and cumulative time per resourceType, field and action.
+
+        Rules applied by clone processes are not included, nor (without
+        PYDEID_PROFILE_RULES) the time of rules applied a resource at a time.
+        """
+        return rule_profile()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def traces(self, transaction=None):
+        """The traced jobs (PYDEID_TRACE_SAMPLE), or the spans of one"""
+        if transaction is None:
+            return {"sample": tracer.sample, "traces": tracer.traces()}
+        trace = tracer.trace(transaction)
+        if trace is None:
+            raise cherrypy.HTTPError(404, f"{transaction} was not traced")
+        return trace
 
 
 class Deidentifier(object):
     """Deidentifier"""
 
+    debug = Debug()
+
     @cherrypy.expose()
     def health(self):
-        """Produce status code 200 or 500 depending on health state."""
-        if is_healthy:
-            cherrypy.response.status = 204
-        else:
+        """Produce status code 204, 500 or 503 (job queue full) depending on health state."""
+        if not is_healthy:
             cherrypy.response.status = 500
             return "There are some issues"
+        if (async_engine or job_scheduler).saturation() >= 1:
+            cherrypy.response.status = 503
+            return "The job queue is full"
+        cherrypy.response.status = 204
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def jobs(self, transaction=None):
+        """The status of a job, or of the job queue when no transaction is given"""
+        if transaction is None:
+            if async_engine is not None:
+                return dict(job_scheduler.stats(), engine=async_engine.stats())
+            return job_scheduler.stats()
+        job = job_scheduler.status(transaction)
+        if job is None:
+            raise cherrypy.HTTPError(404, f"Unknown transaction {transaction}")
+        return job
+
+    @cherrypy.expose
+    def metrics(self):
+        """Latencies, throughput and job counts in the Prometheus text format"""
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return REGISTRY.render()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def rules(self):
+        """The version of the rules in use, when it was loaded and why a later file was rejected"""
+        return plan_manager.stats()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def delivery(self):
+        """The current rate (batches/s) and batch size of each delivery target"""
+        return delivery_scheduler.stats()
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
     @cherrypy.tools.allow(methods=["POST"])
     @cherrypy.tools.json_out()
-    def deidentify(self, transaction_id=None):
+    def deidentify(self, transaction_id=None, **params):
         global is_healthy
+        if transaction_id == "stream":
+            return self.deidentify_stream(**params)
         data = cherrypy.request.json
         if not "transaction_id" in data:
             cherrypy.log.warning("Missing transaction id")
@@ -359,46 +965,97 @@ class Deidentifier(object):
             return json.dumps({"message": "missing transaction_id"})
 
         my_transaction_id = str(uuid1())
-        cherrypy.log(f"{transaction_id}: Create {base_dir}/{my_transaction_id}.json")
-        filepath = f"{base_dir}/{my_transaction_id}.json"
+        cherrypy.log(f"{transaction_id}: Create job {my_transaction_id}")
+        tenant = job_tenant(data)
         try:
-            with open(filepath, "w+", encoding="utf-8") as f:
-                json_str = json.dumps(data)
-                f.write(json_str)
-            cherrypy.log(f"{transaction_id}: wrote file {my_transaction_id}.json")
+            job_store.create(my_transaction_id, tenant, data)
+            cherrypy.log(f"{transaction_id}: stored job {my_transaction_id}")
 
-            fetch_thread = threading.Thread(
-                target=process_request, args=(my_transaction_id,)
-            )
-            fetch_thread.daemon = True  # Allows the main program to exit even if this thread is still running
-            fetch_thread.start()
+            submit_job(my_transaction_id, tenant)
+
+        except JobQueueFull as e:
+            job_store.remove(my_transaction_id)
+            cherrypy.log(f"{transaction_id}: Rejected: {e}")
+            cherrypy.response.status = 429 if e.tenant else 503
+            cherrypy.response.headers["Retry-After"] = str(JOB_RETRY_AFTER)
+            return json.dumps({"message": str(e)})
 
         except Exception as e:
             is_healthy = False
-            cherrypy.log("Failed to save the object to disk.")
+            cherrypy.log("Failed to store the job.")
 
         return json.dumps({"message": "OK", "transaction": my_transaction_id})
 
+    def deidentify_stream(self, deid="true", fhir_target=None):
+        """POST /deidentify/stream: de-identify the Bundle (or, as
+        application/fhir+ndjson, the resources) in the request body and
+        answer with the clone's resources as NDJSON, streamed as they are
+        cloned.  STREAM_CONFIG turns off reading the body up front and
+        encoding the answer as JSON for this path.
+        """
+        request = cherrypy.request
+        ndjson = "ndjson" in request.headers.get("Content-Type", "")
+        cherrypy.response.headers["Content-Type"] = "application/fhir+ndjson"
+        cherrypy.response.stream = True
+        chunks = request_body(request.rfile)
+        return stream_deidentify(
+            chunks, ndjson, deid.lower() not in ("false", "0", "no"), fhir_target
+        )
+
+
+# POST /deidentify/stream is handled by Deidentifier.deidentify, which
+# passes it on to deidentify_stream with the body unread
+STREAM_CONFIG = {
+    "tools.json_in.on": False,
+    "tools.json_out.on": False,
+    "request.process_request_body": False,
+    "response.stream": True,
+}
+
+
+# Messages at debug level (every page, batch and created resource) are only
+# formatted and logged with PYDEID_LOG_LEVEL=DEBUG
+LOG_LEVEL = os.environ.get("PYDEID_LOG_LEVEL", "INFO").upper()
+
+# Seconds a stopping process waits for its running jobs before leaving them to be resumed
+SHUTDOWN_GRACE = float(os.environ.get("PYDEID_SHUTDOWN_GRACE", "20"))
+
+
+def drain_jobs():
+    if not job_scheduler.drain(SHUTDOWN_GRACE):
+        cherrypy.log("Stopping with jobs still running; they resume on the next start")
 
-if __name__ == "__main__":
+
+def main(host="0.0.0.0", port=5000, thread_pool=10, resume=True, worker=None):
+    """Serve on this process until SIGTERM (or SIGINT).
+
+    Stopping lets the running requests and jobs finish, up to
+    SHUTDOWN_GRACE seconds.  With resume, the jobs that were unfinished
+    when the service last stopped are queued again.  worker names this
+    process among those of the pre-fork server, which own the jobs they
+    take; with resume a worker only queues again the jobs it owns.
+    """
+    global is_healthy
 
     try:
         os.makedirs(base_dir, exist_ok=True)
     except OSError as e:
         raise TypeError(f"Error creating directory '{base_dir}': {e}")
 
-    thread_pool = 10
-
+    cherrypy.log.error_log.setLevel(LOG_LEVEL)
     cherrypy.log(f"Setting thread pool to {thread_pool}")
 
     cherrypy.config.update(
         {
-            "server.socket_host": "0.0.0.0",
-            "server.socket_port": 5000,
+            "server.socket_host": host,
+            "server.socket_port": port,
             "server.thread_pool": thread_pool,
             "log.screen": True,
             "log.access_file": "",  # Disable access log file
             "log.error_file": "",  #  Disable error log file
+            # the rules are reloaded by plan_manager; reloading the code would
+            # re-execute a pre-forked worker as a second supervisor
+            "engine.autoreload.on": False,
         }
     )
 
@@ -412,6 +1069,7 @@ if __name__ == "__main__":
                 "tools.json_out.on": True,
                 "tools.allow.methods": ["POST"],
             },
+            "/deidentify/stream": STREAM_CONFIG,
             "/favicon.ico": {
                 "tools.staticfile.on": True,
                 "tools.staticdir.root": os.getcwd(),
@@ -420,8 +1078,22 @@ if __name__ == "__main__":
         },
     )
 
+    if worker is not None:
+        job_store.resolve().owner = str(worker)
+    if resume:
+        resume_jobs(None if worker is None else str(worker))
+    plan_manager.start()
+
+    cherrypy.engine.signal_handler.subscribe()
+    # after the HTTP server has stopped (priority 50)
+    cherrypy.engine.subscribe("stop", drain_jobs, priority=60)
+
     cherrypy.log("Starting the engine")
     is_healthy = True
     cherrypy.engine.start()
     cherrypy.engine.block()
     cherrypy.log("Engine stopped")
+
+
+if __name__ == "__main__":
+    main()
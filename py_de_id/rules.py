@@ -0,0 +1,407 @@
+import hashlib
+import logging
+import os
+import random
+import string
+import time
+from datetime import date, timedelta
+
+import cherrypy
+import yaml
+
+from .metrics import RULE_EXECUTIONS, RULE_SECONDS
+from .paths import PathAction, is_path, parse_path
+
+PRINTABLE = string.printable
+
+
+def randomize(field_name, old_value, params, rng=random):
+    """A random value near old_value, drawn from rng (the random module by default).
+
+    Only rng.random() is used - one draw, or one per character of a string.
+    """
+    if "date" in field_name.lower():
+        seed = date.fromisoformat(old_value)
+        start_date = seed - timedelta(days=params["min"])
+        delta = _span(params["min"] + params["max"] + 1)
+        random_day = int(rng.random() * delta)
+
+        return (start_date + timedelta(random_day)).isoformat()
+    if isinstance(old_value, float):
+        min_val = old_value - params["max"]
+        max_val = old_value + params["max"]
+        return round(min_val + (max_val - min_val) * rng.random(), 2)
+    if isinstance(old_value, int):
+        min_val = old_value - abs(params["min"])
+        max_val = old_value + params["max"]
+        return min_val + int(rng.random() * _span(max_val - min_val + 1))
+
+    length = len(old_value)
+    if "length" in params and isinstance(params["length"], int):
+        length = params["length"]
+    new_str = "".join([PRINTABLE[int(rng.random() * len(PRINTABLE))] for _ in range(length)])
+    return new_str
+
+
+def _span(width):
+    if width < 1:
+        raise ValueError(f"empty range for randomize ({width})")
+    return width
+
+
+class HashRandom(object):
+    """Random numbers drawn from a hash of a seed, for randomize.
+
+    Much cheaper to create than a seeded random.Random, and every
+    randomized field of every resource has a seed of its own.
+    """
+
+    def __init__(self, seed):
+        self._seed = seed.encode()
+        self._data = hashlib.shake_128(self._seed).digest(32)
+        self._offset = 0
+
+    def random(self):
+        if self._offset == len(self._data):
+            self._data = hashlib.shake_128(self._seed).digest(2 * len(self._data))
+        value = int.from_bytes(self._data[self._offset : self._offset + 8], "big")
+        self._offset += 8
+        return (value >> 11) * 2.0**-53
+
+
+def randomize_many(field_name, values, params, seeds=None):
+    """randomize every value of a field at once.
+
+    Dates, floats and ints take one draw each - from their seed, as
+    randomize_action does, or from the random module - and are computed
+    together, so each result is the one randomize would give.  Strings,
+    which take a draw per character, are randomized one at a time.
+    """
+    results = list(values)
+    if "date" in field_name.lower():
+        groups = {"date": list(range(len(values)))}
+    else:
+        groups = {}
+        for n, value in enumerate(values):
+            kind = "float" if isinstance(value, float) else "int" if isinstance(value, int) else "str"
+            groups.setdefault(kind, []).append(n)
+
+    for kind, indexes in groups.items():
+        if kind == "str":
+            for n in indexes:
+                rng = random if seeds is None else HashRandom(f"{seeds[n]}:{field_name}")
+                results[n] = randomize(field_name, values[n], params, rng)
+            continue
+        if seeds is None:
+            draws = [random.random() for _ in indexes]
+        else:
+            # the first draw of HashRandom, without making one
+            shake = hashlib.shake_128
+            draws = [
+                (int.from_bytes(shake(f"{seeds[n]}:{field_name}".encode()).digest(8), "big") >> 11) * 2.0**-53
+                for n in indexes
+            ]
+        old = [values[n] for n in indexes]
+        if kind == "date":
+            width = _span(params["min"] + params["max"] + 1)
+            new = [
+                date.fromordinal(
+                    date.fromisoformat(value).toordinal() - params["min"] + int(draw * width)
+                ).isoformat()
+                for value, draw in zip(old, draws)
+            ]
+        elif kind == "float":
+            spread = params["max"]
+            # the arithmetic of randomize, so the results are identical
+            new = [
+                round((value - spread) + ((value + spread) - (value - spread)) * draw, 2)
+                for value, draw in zip(old, draws)
+            ]
+        else:
+            low = abs(params["min"])
+            width = _span(low + params["max"] + 1)
+            new = [value - low + int(draw * width) for value, draw in zip(old, draws)]
+        for n, value in zip(indexes, new):
+            results[n] = value
+    return results
+
+
+def load_config(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+ACTIONS = ("erase", "replace", "randomize", "merge", "truncate")
+
+
+def validate_config(config):
+    """Raise ValueError, naming every problem, unless each rule in config compiles as written"""
+    if not isinstance(config, dict):
+        raise ValueError("the rules must map resourceTypes to lists of rules")
+    problems = []
+    for resource_type, rules in config.items():
+        if rules is not None and not isinstance(rules, list):
+            problems.append(f"{resource_type}: not a list of rules")
+            continue
+        for n, rule in enumerate(rules or []):
+            where = f"{resource_type}[{n}]"
+            if not isinstance(rule, dict) or not isinstance(rule.get("field"), str):
+                problems.append(f"{where}: a rule needs a field")
+                continue
+            action = rule.get("action")
+            params = rule.get("params")
+            if is_path(rule["field"]):
+                try:
+                    path_steps(rule)
+                except ValueError as e:
+                    problems.append(f"{where}: {e}")
+                    continue
+            if action not in ACTIONS:
+                problems.append(f"{where}: unknown action {action!r}")
+            elif action == "truncate":
+                length = params.get("length") if isinstance(params, dict) else params
+                if not isinstance(length, int) or isinstance(length, bool) or length < 0:
+                    problems.append(f"{where}: truncate params need a length of 0 or more")
+                elif isinstance(params, dict) and not isinstance(params.get("fill", ""), str):
+                    problems.append(f"{where}: truncate fill must be a string")
+            elif action == "randomize" and params is not None:
+                if not isinstance(params, dict) or not all(
+                    isinstance(params.get(key, 0), (int, float)) for key in ("min", "max")
+                ):
+                    problems.append(f"{where}: randomize params need numeric min and max")
+            elif action == "merge":
+                if not isinstance(params or [], list):
+                    problems.append(f"{where}: merge params must be a list of expressions")
+                    continue
+                for expression in params or []:
+                    try:
+                        compile(str(expression).replace("%input%", "input"), "<merge>", "eval")
+                    except SyntaxError as e:
+                        problems.append(f"{where}: {expression}: {e}")
+    if problems:
+        raise ValueError("; ".join(problems))
+
+
+def erase_action(resource, field, seed=None):
+    del resource[field]
+
+
+def _copy(value):
+    # the values in config.yaml are plain JSON, which copies faster than copy.deepcopy does
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def replace_action(value):
+    if isinstance(value, (dict, list)):
+        # each resource gets a copy of its own, as later rules and re-keying change it in place
+        def action(resource, field, seed=None):
+            resource[field] = _copy(value)
+
+        return action
+
+    def action(resource, field, seed=None):
+        resource[field] = value
+
+    return action
+
+
+def randomize_action(params):
+    def action(resource, field, seed=None):
+        rng = random if seed is None else HashRandom(f"{seed}:{field}")
+        resource[field] = randomize(field, resource[field], params, rng)
+
+    def batch(field, values, seeds=None):
+        return randomize_many(field, values, params, seeds)
+
+    # RulePlan.apply_many randomizes a whole column at once
+    action.batch = batch
+    return action
+
+
+def merge_action(expressions):
+    # %input% is the value of the field; each expression sees the result of the previous one
+    codes = []
+    for expression in expressions:
+        try:
+            codes.append(
+                compile(expression.replace("%input%", "input"), "<merge>", "eval")
+            )
+        except SyntaxError as e:
+            cherrypy.log(
+                f"Ignoring merge param {expression}: {e}", severity=logging.WARNING
+            )
+
+    def action(resource, field, seed=None):
+        value = resource[field]
+        for code in codes:
+            try:
+                value = eval(code, {"input": value})
+            except Exception as e:
+                cherrypy.log(f"Exception while processing merge on {field}: {e}")
+        resource[field] = value
+
+    return action
+
+
+def truncate_action(params):
+    # params is the length kept, or {length, fill}: fill is appended to what is kept,
+    # so every value comes out as wide (12345-6789 and 1234 both give 12000 with fill 000)
+    length, fill = (params.get("length", 0), params.get("fill", "")) if isinstance(params, dict) else (params, "")
+
+    def action(resource, field, seed=None):
+        value = resource[field]
+        if isinstance(value, str):
+            resource[field] = value[:length] + fill
+
+    return action
+
+
+def path_steps(rule):
+    """The steps of a path rule's field, raising ValueError if they can not be followed"""
+    steps = parse_path(rule["field"])
+    if steps[-1][1] is not None and rule.get("action") == "randomize":
+        # randomize draws on the field's name (a date or not), which list items do not have
+        raise ValueError(f"{rule['field']}: randomize a field, not list items")
+    return steps
+
+
+def compile_rule(rule):
+    """Return (field, callable) for a config rule, or None if it can not be used."""
+    action = rule.get("action")
+    if action == "erase":
+        return rule["field"], erase_action
+    if action == "replace":
+        return rule["field"], replace_action(rule.get("params"))
+    if action == "randomize":
+        return rule["field"], randomize_action(rule.get("params") or {})
+    if action == "merge":
+        return rule["field"], merge_action(rule.get("params") or [])
+    if action == "truncate":
+        return rule["field"], truncate_action(rule.get("params") or 0)
+    cherrypy.log(f"Unknown rule.action {rule}", severity=logging.WARNING)
+    return None
+
+
+def compile_rules(rules):
+    compiled = []
+    for rule in rules or []:
+        step = compile_rule(rule)
+        if step:
+            compiled.append(step)
+    return compiled
+
+
+# Time every action RulePlan.apply runs, not only the columns of apply_many
+PROFILE_RULES = os.environ.get("PYDEID_PROFILE_RULES", "").lower() in ("1", "true", "yes")
+
+
+class RulePlan(object):
+    """The rules in config.yaml compiled into a list of actions per resourceType.
+
+    Rules whose field is a path (``address[*].postalCode``) are compiled
+    into one PathAction per top-level field, applied in place; they are
+    counted and timed together, as the action ``paths`` of that field.
+
+    Every action applied is counted in RULE_EXECUTIONS and timed in
+    RULE_SECONDS: a column at a time by apply_many, and by apply only with
+    ``profile`` (PYDEID_PROFILE_RULES), as timing each call of each action
+    adds a tenth to it.  Given a seed, randomized fields are drawn from it
+    (and the field name), so a resource seeded the same way is
+    de-identified the same way every time.
+    ``version`` tells the plans compiled from successive rule files apart.
+    """
+
+    profile = PROFILE_RULES
+
+    def __init__(self, config, version=0):
+        self.config = config
+        self.version = version
+        self.actions = {}
+        global_rules = config.get("*") or []
+        for resource_type, rules in config.items():
+            if resource_type == "*":
+                continue
+            actions = self.actions[resource_type] = []
+            paths = {}
+            for rule in global_rules + (rules or []):
+                step = compile_rule(rule)
+                if not step:
+                    continue
+                field, action = step
+                if not is_path(field):
+                    actions.append((field, action, (resource_type, field, rule["action"])))
+                    continue
+                try:
+                    steps = path_steps(rule)
+                except ValueError as e:
+                    cherrypy.log(f"Ignoring rule {rule}: {e}", severity=logging.WARNING)
+                    continue
+                # the path rules of a field run together, where the first of them is
+                field = steps[0][0]
+                if field not in paths:
+                    paths[field] = PathAction()
+                    actions.append((field, paths[field], (resource_type, field, "paths")))
+                paths[field].add(steps, action, erase=rule["action"] == "erase")
+
+    def apply(self, resource, seed=None):
+        resource.pop("meta", None)
+        actions = self.actions.get(resource["resourceType"])
+        if actions and self.profile:
+            executions = RULE_EXECUTIONS.shard()
+            seconds = RULE_SECONDS.shard()
+            clock = time.perf_counter
+            for field, action, key in actions:
+                if field in resource:
+                    start = clock()
+                    action(resource, field, seed)
+                    seconds[key] = seconds.get(key, 0) + clock() - start
+                    executions[key] = executions.get(key, 0) + 1
+        elif actions:
+            executions = RULE_EXECUTIONS.shard()
+            for field, action, key in actions:
+                if field in resource:
+                    action(resource, field, seed)
+                    executions[key] = executions.get(key, 0) + 1
+        return resource
+
+    def apply_many(self, resources, seeds=None):
+        """apply to many resources at once, with the same result.
+
+        The resources are grouped by resourceType and each action is run
+        down the column of its field; randomize actions take the whole
+        column in one call (see randomize_many).  seeds, if given, has the
+        seed of each resource.
+        """
+        columns = {}
+        for n, resource in enumerate(resources):
+            resource.pop("meta", None)
+            if resource["resourceType"] in self.actions:
+                columns.setdefault(resource["resourceType"], []).append(n)
+        executions = RULE_EXECUTIONS.shard()
+        seconds = RULE_SECONDS.shard()
+        clock = time.perf_counter
+        for resource_type, indexes in columns.items():
+            for field, action, key in self.actions[resource_type]:
+                column = [n for n in indexes if field in resources[n]]
+                if not column:
+                    continue
+                start = clock()
+                batch = getattr(action, "batch", None)
+                if batch is not None:
+                    values = batch(
+                        field,
+                        [resources[n][field] for n in column],
+                        None if seeds is None else [seeds[n] for n in column],
+                    )
+                    for n, value in zip(column, values):
+                        resources[n][field] = value
+                else:
+                    for n in column:
+                        action(resources[n], field, None if seeds is None else seeds[n])
+                seconds[key] = seconds.get(key, 0) + clock() - start
+                executions[key] = executions.get(key, 0) + len(column)
+        return resources
@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+DEFAULT_RETRY_SECONDS = 1.0
+
+
+def retry_after(headers=None, diagnostics=None):
+    """Seconds to wait from a Retry-After header or a rate limiter's _msBeforeNext"""
+    value = (headers or {}).get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    if diagnostics:
+        try:
+            return max(0.0, float(json.loads(diagnostics)["_msBeforeNext"]) / 1000)
+        except (ValueError, TypeError, KeyError):
+            pass
+    return DEFAULT_RETRY_SECONDS
+
+
+class TargetLimiter(object):
+    """Token bucket and AIMD batch size for one FHIR target.
+
+    Every batch takes a token; tokens refill at ``rate`` per second.  A
+    throttled batch halves the rate and the batch size and stops all
+    requests until the server's retry time has passed.  A batch answered
+    within ``target_latency`` grows the batch size by one and the rate by
+    ``rate_step``; a slower one shrinks the batch size by a quarter.
+    """
+
+    def __init__(
+        self,
+        rate=10.0,
+        min_rate=0.1,
+        max_rate=100.0,
+        rate_step=1.0,
+        batch_size=15,
+        min_batch=1,
+        max_batch=100,
+        target_latency=2.0,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.batch_size = batch_size
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.target_latency = target_latency
+        self.throttled_count = 0
+        self.latency = None
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        burst = max(1.0, self.rate)
+        self._tokens = min(burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Take a token if a batch may be sent now; otherwise return the seconds to wait"""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._blocked_until - now
+            if wait > 0:
+                return wait
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Wait until a batch may be sent"""
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            with self._cond:
+                self._cond.wait(wait)
+
+    def succeeded(self, latency):
+        with self._cond:
+            self.latency = (
+                latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            )
+            if latency <= self.target_latency:
+                self.batch_size = min(self.max_batch, self.batch_size + 1)
+                self.rate = min(self.max_rate, self.rate + self.rate_step)
+            else:
+                self.batch_size = max(self.min_batch, int(self.batch_size * 0.75))
+
+    def throttled(self, delay):
+        with self._cond:
+            self.throttled_count += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self.batch_size = max(self.min_batch, self.batch_size // 2)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "rate": round(self.rate, 3),
+                "batch_size": self.batch_size,
+                "throttled": self.throttled_count,
+                "latency": None if self.latency is None else round(self.latency, 3),
+                "blocked_for": round(max(0.0, self._blocked_until - time.monotonic()), 3),
+            }
+
+
+class DeliveryScheduler(object):
+    """One TargetLimiter per FHIR target, shared by every job delivering to it"""
+
+    def __init__(self, **limits):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._targets = {}
+
+    def target(self, url):
+        with self._lock:
+            if url not in self._targets:
+                self._targets[url] = TargetLimiter(**self.limits)
+            return self._targets[url]
+
+    def stats(self):
+        with self._lock:
+            targets = dict(self._targets)
+        return {url: limiter.stats() for url, limiter in targets.items()}
+
+
+delivery_scheduler = DeliveryScheduler()
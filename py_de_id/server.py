@@ -0,0 +1,167 @@
+"""Serve the de-identifier from several processes sharing one listening socket.
+
+    python -m py_de_id.server [--workers N] [--host 0.0.0.0] [--port 5000] [--threads 10]
+
+The supervisor binds the socket, then forks the workers, each a complete
+CherryPy server (py_de_id.pydeid.main) accepting from the shared socket.
+The jobs left unfinished when the service last stopped are given to worker 0
+before any worker can take a request.  A worker that dies is started again
+and resumes the jobs it had.  SIGTERM or SIGINT stops the workers
+gracefully - each finishes its requests and running jobs, up to the grace
+period - and then the supervisor; a worker still running after the grace
+period is killed.
+"""
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+
+import cherrypy
+
+from . import pydeid
+
+SIGNALS = {signal.SIGCHLD, signal.SIGTERM, signal.SIGINT}
+# A worker dying sooner than this after it started is not restarted straight away
+MIN_UPTIME = 1.0
+# The file descriptor the server takes a listening socket from (as with systemd socket activation)
+LISTEN_FD = 3
+
+
+def listen(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def adopt_jobs(worker=0):
+    """Make the unfinished jobs in the job store a worker's, returning how many there were.
+
+    This is done once, before the workers are forked: a worker claiming
+    them itself could take a job another worker has just been sent.
+    """
+    store = pydeid.open_job_store()
+    try:
+        store.owner = str(worker)
+        return len(store.claim())
+    finally:
+        store.close()
+
+
+class Supervisor(object):
+    """Forks ``workers`` processes running ``target(index, first)`` on a shared socket.
+
+    ``first`` is True the first time each worker starts, and False when it
+    is started again in place of a worker that died.  Signals are blocked
+    in the supervisor and waited for, so it sleeps until a worker exits or
+    it is asked to stop.
+    """
+
+    def __init__(self, sock, workers, target, grace=30.0):
+        self.sock = sock
+        self.workers = workers
+        self.target = target
+        self.grace = grace
+        self.pids = {}
+        self.started = {}
+        self.stopping = False
+
+    def spawn(self, index, first=False):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = index
+            self.started[index] = time.monotonic()
+            return pid
+        code = 1
+        try:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+            if self.sock.fileno() != LISTEN_FD:
+                os.dup2(self.sock.fileno(), LISTEN_FD)
+                self.sock.close()
+            os.environ["LISTEN_PID"] = str(os.getpid())
+            self.target(index, first)
+            code = 0
+        except BaseException:
+            cherrypy.log(f"Worker {index} failed", traceback=True)
+        finally:
+            os._exit(code)
+
+    def run(self):
+        signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+        for index in range(self.workers):
+            self.spawn(index, first=True)
+        cherrypy.log(f"Started {self.workers} workers: {sorted(self.pids)}")
+        while not self.stopping:
+            info = signal.sigwaitinfo(SIGNALS)
+            if info.si_signo == signal.SIGCHLD:
+                self.reap(restart=True)
+            else:
+                self.stop()
+        return 0
+
+    def reap(self, restart):
+        while self.pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            index = self.pids.pop(pid, None)
+            if index is None or not restart:
+                continue
+            cherrypy.log(f"Worker {index} ({pid}) exited with {os.waitstatus_to_exitcode(status)}, restarting it")
+            uptime = time.monotonic() - self.started[index]
+            if uptime < MIN_UPTIME:
+                time.sleep(MIN_UPTIME - uptime)
+            self.spawn(index)
+
+    def stop(self):
+        """Ask every worker to stop, and kill those still running after the grace period"""
+        self.stopping = True
+        cherrypy.log(f"Stopping {len(self.pids)} workers")
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.grace
+        while self.pids:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            signal.sigtimedwait({signal.SIGCHLD}, remaining)
+            self.reap(restart=False)
+        for pid, index in self.pids.items():
+            cherrypy.log(f"Killing worker {index} ({pid})")
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.pids.clear()
+        self.sock.close()
+        cherrypy.log("Workers stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("PYDEID_WORKERS", os.cpu_count())))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=10, help="request threads per worker")
+    parser.add_argument(
+        "--grace", type=float, default=pydeid.SHUTDOWN_GRACE + 10,
+        help="seconds to wait for the workers to stop before killing them",
+    )
+    args = parser.parse_args(argv)
+
+    def worker(index, first):
+        # worker 0 resumes the jobs adopted below, and a restarted worker the
+        # jobs of the one it replaces
+        pydeid.main(args.host, args.port, args.threads, resume=index == 0 or not first, worker=index)
+
+    jobs = adopt_jobs()
+    if jobs:
+        cherrypy.log(f"Worker 0 resumes {jobs} unfinished jobs")
+    supervisor = Supervisor(listen(args.host, args.port), args.workers, worker, args.grace)
+    return supervisor.run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
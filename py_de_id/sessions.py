@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def base_url(url):
+    """scheme://host:port of a FHIR url - the part a connection can be reused for"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class SessionPool(object):
+    """Shared requests sessions keyed by FHIR base url and bearer token.
+
+    Each session keeps up to ``pool_size`` connections alive so batches are
+    not paying for a new TCP/TLS handshake.  Sessions nobody is using are
+    closed, least recently used first, once there are more than ``max_idle``.
+    """
+
+    def __init__(self, max_idle=32, pool_size=10):
+        self.max_idle = max_idle
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._users = {}
+
+    def _create(self, token):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Authorization"] = f"Bearer {token}"
+        return session
+
+    @contextmanager
+    def session(self, url, token):
+        key = (base_url(url), token)
+        with self._lock:
+            if key not in self._sessions:
+                self._sessions[key] = self._create(token)
+                self._users[key] = 0
+            self._users[key] += 1
+            session = self._sessions[key]
+        try:
+            yield session
+        finally:
+            with self._lock:
+                self._users[key] -= 1
+                self._sessions.move_to_end(key)
+                self._evict()
+
+    def _evict(self):
+        idle = [key for key in self._sessions if not self._users[key]]
+        for key in idle[: max(0, len(idle) - self.max_idle)]:
+            self._sessions.pop(key).close()
+            del self._users[key]
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._users.clear()
+
+
+session_pool = SessionPool()
@@ -0,0 +1,267 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from uuid import UUID, uuid4
+
+from . import codec
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    tenant TEXT NOT NULL,
+    data TEXT,
+    namespace TEXT NOT NULL,
+    status TEXT NOT NULL,
+    cloned INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    submitted REAL NOT NULL,
+    finished REAL,
+    owner TEXT
+);
+CREATE TABLE IF NOT EXISTS batches (
+    job_id TEXT NOT NULL,
+    batch_no INTEGER NOT NULL,
+    entries TEXT NOT NULL,
+    PRIMARY KEY (job_id, batch_no)
+);
+CREATE TABLE IF NOT EXISTS delivered (
+    job_id TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    PRIMARY KEY (job_id, ref)
+);
+CREATE TABLE IF NOT EXISTS lineages (
+    lineage TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS clones (
+    lineage TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    target TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (lineage, ref)
+);
+"""
+
+FINISHED = ("done", "failed")
+
+
+def entry_key(entry):
+    """What identifies a cloned entry within its job"""
+    resource = entry.get("resource", {})
+    return f'{resource.get("resourceType")}/{resource.get("id")}'
+
+
+class JobStore(object):
+    """Jobs, their cloned batches and what has been delivered, in SQLite.
+
+    A job keeps the namespace its clone ids are minted from, so cloning it
+    again gives the same ids.  Batches are stored as they are cloned and
+    every delivered entry is recorded, so after a restart a job only posts
+    what the target has not acknowledged.  The request (and its tokens)
+    and the batches are dropped once the job is done or has failed; the
+    last ``history`` finished jobs are kept for polling.
+
+    Each job records the process that runs it, ``owner`` (a worker of the
+    pre-fork server), so a worker started in place of one that died can
+    take over its jobs.
+
+    A lineage - the same patient cloned from a source to a target again and
+    again - keeps its namespace, and the target reference and digest of
+    every resource delivered for it, across jobs.
+    """
+
+    def __init__(self, path, history=1000, owner=None):
+        self.path = path
+        self.history = history
+        self.owner = owner
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            # a jobs.db written before jobs had owners
+            self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def create(self, job_id, tenant, data):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (job_id, tenant, data, namespace, status, submitted, owner)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, tenant, codec.dumps(data), str(uuid4()), time.time(), self.owner),
+            )
+
+    def remove(self, job_id):
+        with self._transaction():
+            self._purge(job_id)
+            self._db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def job(self, job_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT tenant, data, namespace, status, cloned, error FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        tenant, data, namespace, status, cloned, error = row
+        return {
+            "transaction": job_id,
+            "tenant": tenant,
+            "data": codec.loads(data) if data else None,
+            "namespace": UUID(namespace),
+            "status": status,
+            "cloned": bool(cloned),
+            "error": error,
+        }
+
+    def status(self, job_id):
+        job = self.job(job_id)
+        if job is None:
+            return None
+        del job["data"], job["namespace"], job["cloned"]
+        return job
+
+    def update(self, job_id, status, error=None):
+        with self._transaction():
+            self._db.execute(
+                "UPDATE jobs SET status = ?, error = coalesce(?, error) WHERE job_id = ?",
+                (status, error, job_id),
+            )
+            if status in FINISHED:
+                self._db.execute(
+                    "UPDATE jobs SET data = NULL, finished = ? WHERE job_id = ?",
+                    (time.time(), job_id),
+                )
+                self._purge(job_id)
+                self._db.execute(
+                    "DELETE FROM jobs WHERE job_id IN (SELECT job_id FROM jobs"
+                    " WHERE finished IS NOT NULL ORDER BY finished DESC LIMIT -1 OFFSET ?)",
+                    (self.history,),
+                )
+
+    def _purge(self, job_id):
+        self._db.execute("DELETE FROM batches WHERE job_id = ?", (job_id,))
+        self._db.execute("DELETE FROM delivered WHERE job_id = ?", (job_id,))
+
+    def unfinished(self):
+        """(job id, tenant) of every job that was not done or failed, oldest first"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT job_id, tenant FROM jobs WHERE status NOT IN (?, ?) ORDER BY submitted",
+                FINISHED,
+            ).fetchall()
+
+    def claim(self, owner=None):
+        """Make the unfinished jobs - all of them, or those of owner - this process's own,
+        returning their (job id, tenant), oldest first"""
+        with self._transaction():
+            jobs = self._db.execute(
+                "SELECT job_id, tenant FROM jobs WHERE status NOT IN (?, ?)"
+                " AND (? IS NULL OR owner = ?) ORDER BY submitted",
+                FINISHED + (owner, owner),
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET owner = ? WHERE job_id = ?", [(self.owner, job_id) for job_id, _ in jobs]
+            )
+        return jobs
+
+    def restart(self, job_id):
+        """Forget the batches of a job that is cloned again"""
+        with self._transaction():
+            self._db.execute("DELETE FROM batches WHERE job_id = ?", (job_id,))
+            self._db.execute("UPDATE jobs SET cloned = 0 WHERE job_id = ?", (job_id,))
+
+    def add_batch(self, job_id, entries):
+        """Store a batch of cloned entries (or their encoded JSON)"""
+        if not isinstance(entries, bytes):
+            entries = codec.dumps(entries)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO batches (job_id, batch_no, entries) VALUES (?,"
+                " (SELECT coalesce(max(batch_no), -1) + 1 FROM batches WHERE job_id = ?), ?)",
+                (job_id, job_id, entries),
+            )
+
+    def cloned(self, job_id):
+        """Every batch of the job has been stored"""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET cloned = 1 WHERE job_id = ?", (job_id,))
+
+    def acknowledge(self, job_id, entries):
+        """Record entries the target has accepted"""
+        with self._transaction():
+            self._db.executemany(
+                "INSERT OR IGNORE INTO delivered (job_id, ref) VALUES (?, ?)",
+                [(job_id, entry_key(entry)) for entry in entries],
+            )
+
+    def delivered(self, job_id):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT ref FROM delivered WHERE job_id = ?", (job_id,)
+            ).fetchall()
+        return {ref for ref, in rows}
+
+    def batches(self, job_id):
+        """Yield the stored batches of a job, without the entries already delivered"""
+        delivered = self.delivered(job_id)
+        batch_no = -1
+        while True:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT batch_no, entries FROM batches WHERE job_id = ? AND batch_no > ?"
+                    " ORDER BY batch_no LIMIT 1",
+                    (job_id, batch_no),
+                ).fetchone()
+            if row is None:
+                return
+            batch_no, entries = row
+            batch = [entry for entry in codec.loads(entries) if entry_key(entry) not in delivered]
+            if batch:
+                yield batch
+
+    def lineage(self, lineage):
+        """The namespace clone ids are minted from for a lineage, created on first use"""
+        with self._transaction():
+            self._db.execute(
+                "INSERT OR IGNORE INTO lineages (lineage, namespace) VALUES (?, ?)",
+                (lineage, str(uuid4())),
+            )
+            (namespace,) = self._db.execute(
+                "SELECT namespace FROM lineages WHERE lineage = ?", (lineage,)
+            ).fetchone()
+        return UUID(namespace)
+
+    def clones(self, lineage):
+        """source reference -> (target reference, digest) of what was delivered for a lineage"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT ref, target, digest FROM clones WHERE lineage = ?", (lineage,)
+            ).fetchall()
+        return {ref: (target, digest) for ref, target, digest in rows}
+
+    def record_clones(self, lineage, clones):
+        """Record (source reference, target reference, digest) of delivered resources"""
+        with self._transaction():
+            self._db.executemany(
+                "INSERT OR REPLACE INTO clones (lineage, ref, target, digest) VALUES (?, ?, ?, ?)",
+                [(lineage,) + tuple(clone) for clone in clones],
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,133 @@
+import codecs
+import json
+import re
+
+from . import codec
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+FOLLOW = re.compile(r"[ \t\n\r]*(.)", re.S)
+
+
+def read_chunks(file, chunk_size=CHUNK_SIZE):
+    """Iterate over an open (binary) file in chunks"""
+    return iter(lambda: file.read(chunk_size), b"")
+
+
+def read_ndjson(chunks):
+    """Parse newline-delimited JSON from an iterable of byte chunks, a value per line"""
+    parts = []
+    for chunk in chunks:
+        start = 0
+        end = chunk.find(b"\n")
+        while end != -1:
+            parts.append(chunk[start:end])
+            line = b"".join(parts)
+            parts = []
+            if line.strip():
+                yield codec.loads(line)
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        parts.append(chunk[start:])
+    line = b"".join(parts)
+    if line.strip():
+        yield codec.loads(line)
+
+
+class BundleReader(object):
+    """Incrementally parse a FHIR Bundle from an iterable of byte chunks.
+
+    Iterating yields the items of ``entry`` one at a time as soon as each one
+    is complete.  Every other top-level member (``type``, ``link``, ``total``,
+    ...) is collected into ``fields`` and is complete once iteration ends.
+    Only the entry being parsed (plus one chunk) is held in memory.
+    """
+
+    def __init__(self, chunks):
+        self.fields = {}
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _read(self):
+        """Return the next piece of decoded text ("" at the end of input)"""
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                return text
+        self._eof = True
+        return self._decoder.decode(b"", final=True)
+
+    def _fill(self, wanted=0):
+        """Read until at least ``wanted`` characters are unconsumed, or one more chunk"""
+        parts = [self._buffer[self._pos :]]
+        size = available = len(parts[0])
+        while not self._eof:
+            text = self._read()
+            parts.append(text)
+            size += len(text)
+            if text and size >= wanted:
+                break
+        self._buffer = "".join(parts)
+        self._pos = 0
+        return size > available
+
+    def _peek(self):
+        """Skip whitespace and return the next character ("" at the end of input)"""
+        while True:
+            while self._pos < len(self._buffer):
+                char = self._buffer[self._pos]
+                if char not in WHITESPACE:
+                    return char
+                self._pos += 1
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars or not char:
+            raise ValueError(f"Expected one of {chars!r} at {self._pos}, got {char!r}")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+                # a scalar may continue in the next chunk
+                follow = FOLLOW.match(self._buffer, end)
+                if self._eof or (follow and follow.group(1) in ",:]}"):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Wait for twice the pending text before decoding again so a
+            # very large entry is only re-scanned a few times
+            self._fill(2 * (len(self._buffer) - self._pos))
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "entry" and self._peek() == "[":
+                self._pos += 1
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.fields[key] = self._value()
+            if self._expect(",}") == "}":
+                return
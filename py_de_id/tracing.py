@@ -0,0 +1,103 @@
+"""Spans of the stages of a sample of the jobs, for /debug/traces.
+
+PYDEID_TRACE_SAMPLE is the share of jobs traced, from 0 (the default: none)
+to 1 (every job).
+"""
+
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import STAGE_SECONDS
+
+
+class Tracer(object):
+    """Records where a sample of the jobs spent their time.
+
+    A traced job has a span for every stage it went through: waiting in
+    the queue, each page fetched, each batch cloned, waiting for its
+    target's limiter and each batch posted.  A span has its offset from
+    the start of the job, its length and attributes such as the page or
+    batch number.  The last ``history`` traces are kept, each with up to
+    ``max_spans`` spans.  For a job that is not traced, span() costs a
+    dictionary lookup.
+    """
+
+    def __init__(self, sample=0.0, history=100, max_spans=10000):
+        self.sample = sample
+        self.history = history
+        self.max_spans = max_spans
+        self._lock = threading.Lock()
+        self._active = {}
+        self._finished = OrderedDict()
+
+    def begin(self, job_id):
+        """Start tracing a job, if it is one of the sample; returns whether it is"""
+        if not self.sample or random.random() >= self.sample:
+            return False
+        trace = {"transaction": job_id, "started": time.time(), "spans": [], "dropped": 0}
+        with self._lock:
+            self._active[job_id] = (time.perf_counter(), trace)
+        return True
+
+    def span(self, job_id, name, seconds, **attributes):
+        """Record that a job has just spent seconds on name"""
+        active = self._active.get(job_id)
+        if active is None:
+            return
+        origin, trace = active
+        spans = trace["spans"]
+        if len(spans) >= self.max_spans:
+            trace["dropped"] += 1
+            return
+        end = time.perf_counter() - origin
+        spans.append(
+            dict(attributes, name=name, start=round(end - seconds, 6), seconds=round(seconds, 6))
+        )
+
+    def end(self, job_id, status):
+        with self._lock:
+            active = self._active.pop(job_id, None)
+            if active is None:
+                return
+            origin, trace = active
+            trace["status"] = status
+            trace["seconds"] = round(time.perf_counter() - origin, 6)
+            self._finished[job_id] = trace
+            while len(self._finished) > self.history:
+                self._finished.popitem(last=False)
+
+    def trace(self, job_id):
+        """The spans of a job traced so far, or None"""
+        with self._lock:
+            if job_id in self._active:
+                trace = self._active[job_id][1]
+                return dict(trace, spans=list(trace["spans"]))
+            return self._finished.get(job_id)
+
+    def traces(self):
+        """A summary of every trace kept, the running ones first"""
+        with self._lock:
+            traces = [trace for _, trace in self._active.values()]
+            traces.extend(reversed(self._finished.values()))
+            return [
+                {
+                    "transaction": trace["transaction"],
+                    "started": trace["started"],
+                    "status": trace.get("status", "running"),
+                    "seconds": trace.get("seconds"),
+                    "spans": len(trace["spans"]),
+                }
+                for trace in traces
+            ]
+
+
+tracer = Tracer(float(os.environ.get("PYDEID_TRACE_SAMPLE", "0")))
+
+
+def observe_stage(job_id, stage, seconds, **attributes):
+    """Observe the time of a stage in STAGE_SECONDS, and as a span if the job is traced"""
+    STAGE_SECONDS.observe(seconds, (stage,))
+    tracer.span(job_id, stage, seconds, **attributes)
@@ -0,0 +1,147 @@
+import unittest
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.jobs import JobScheduler
+from py_de_id.scheduler import DeliveryScheduler
+from py_de_id.store import JobStore
+
+try:
+    from py_de_id.aio import AsyncEngine
+except ImportError:  # aiohttp is not installed
+    AsyncEngine = None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        patient_id = self.path.split("/Patient/")[1].split("/")[0]
+        if patient_id == "missing":
+            self.send_json(404, {"resourceType": "OperationOutcome"})
+            return
+        page = 1 if self.path.endswith("page=1") else 0
+        entries = [
+            {"resource": {"resourceType": "Patient", "id": patient_id}},
+            {
+                "resource": {
+                    "resourceType": "Encounter",
+                    "id": f"e-{patient_id}-{page}",
+                    "subject": {"reference": f"Patient/{patient_id}"},
+                }
+            },
+        ][page:page + 1]
+        link = [] if page else [{"relation": "next", "url": f"{self.server.url}{self.path.lstrip('/')}?page=1"}]
+        self.send_json(200, {"resourceType": "Bundle", "link": link, "entry": entries})
+
+    def do_POST(self):
+        bundle = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.posts += 1
+            throttled = server.posts <= 2
+            if not throttled:
+                server.posted.extend(bundle["entry"])
+        if throttled:
+            self.send_json(429, {}, [("Retry-After", "0.05")])
+            return
+        entries = [
+            {"response": {"status": "201 Created", "location": entry["request"]["url"]}}
+            for entry in bundle["entry"]
+        ]
+        self.send_json(200, {"resourceType": "Bundle", "entry": entries})
+
+
+@unittest.skipIf(AsyncEngine is None, "aiohttp is not installed")
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.server.lock = threading.Lock()
+        self.server.posts = 0
+        self.server.posted = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.store = JobStore(":memory:")
+        self.scheduler = JobScheduler(workers=0, store=self.store)
+        self.engine = AsyncEngine(max_jobs=3)
+        self.patches = [
+            patch("py_de_id.pydeid.job_store", self.store),
+            patch("py_de_id.pydeid.job_scheduler", self.scheduler),
+            patch("py_de_id.pydeid.cherrypy"),
+            patch("py_de_id.aio.cherrypy"),
+            patch("py_de_id.pydeid.delivery_scheduler", DeliveryScheduler(rate=1000, batch_size=1)),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        self.engine.stop()
+        for patcher in self.patches:
+            patcher.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def submit(self, patient_id):
+        data = {
+            "source_token": "token",
+            "fhir_source": f"{self.server.url}fhir/Patient/{patient_id}/$everything",
+            "target_token": "token",
+            "fhir_target": f"{self.server.url}fhir/",
+            "deid": True,
+        }
+        self.store.create(patient_id, "default", data)
+        self.engine.submit(patient_id, "default")
+
+    def test_jobs_run_on_the_loop(self):
+        for patient_id in ("p1", "p2", "missing"):
+            self.submit(patient_id)
+        self.assertTrue(self.scheduler.drain(10))
+        self.assertEqual(self.engine.stats()["running"], 0)
+
+        self.assertEqual(self.scheduler.status("p1")["status"], "done")
+        self.assertEqual(self.scheduler.status("p2")["status"], "done")
+        failed = self.scheduler.status("missing")
+        self.assertEqual(failed["status"], "failed")
+        self.assertIn("404", failed["error"])
+        # every resource of both pages is delivered once, despite two 429s in a row
+        self.assertEqual(len(self.server.posted), 4)
+        types = sorted(entry["resource"]["resourceType"] for entry in self.server.posted)
+        self.assertEqual(types, ["Encounter", "Encounter", "Patient", "Patient"])
+        self.assertEqual(self.store.status("p1")["status"], "done")
+
+    def test_full(self):
+        from py_de_id.jobs import JobQueueFull
+
+        self.engine = AsyncEngine(max_jobs=1, max_per_tenant=1)
+        gate = threading.Event()
+        with patch("py_de_id.pydeid.process_request", side_effect=lambda job_id: gate.wait(5)):
+            self.store.create("cohort", "default", {"patients": ["p1"]})
+            self.engine.submit("cohort", "default")
+            with self.assertRaises(JobQueueFull):
+                self.submit("p1")
+            self.assertEqual(self.engine.saturation(), 1)
+            gate.set()
+            self.assertTrue(self.scheduler.drain(5))
+        self.assertEqual(self.scheduler.status("cohort")["status"], "done")
+
+
+if __name__ == "__main__":
+    unittest.main()
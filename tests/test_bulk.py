@@ -0,0 +1,115 @@
+import unittest
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.bulk import BulkIngest, export_files, line_blocks, line_ranges, main
+
+CONFIG = {"Patient": [{"field": "gender", "action": "replace", "params": "unknown"}]}
+
+
+class TestBulkIngest(unittest.TestCase):
+    def setUp(self):
+        self.export_dir = tempfile.mkdtemp()
+        self.patients = [{"resourceType": "Patient", "id": f"p{i}", "gender": "male"} for i in range(10)]
+        self.observations = [
+            {"resourceType": "Observation", "id": f"o{i}", "subject": {"reference": f"Patient/p{i % 10}"}}
+            for i in range(40)
+        ]
+        self.write("Patient.ndjson", self.patients)
+        self.write("Observation.ndjson.gz", self.observations)
+        with open(os.path.join(self.export_dir, "manifest.json"), "w") as file:
+            file.write("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir)
+
+    def write(self, name, resources):
+        data = "".join(json.dumps(resource) + "\n" for resource in resources).encode()
+        path = os.path.join(self.export_dir, name)
+        with (gzip.open if name.endswith(".gz") else open)(path, "wb") as file:
+            file.write(data)
+
+    def read(self, directory, name):
+        with open(os.path.join(directory, name)) as file:
+            return [json.loads(line) for line in file]
+
+    def test_line_aligned_chunks(self):
+        path, = [p for p in export_files(self.export_dir) if p.endswith("Patient.ndjson")]
+        ranges = line_ranges(path, chunk_size=100)
+        self.assertGreater(len(ranges), 1)
+        with open(path, "rb") as file:
+            data = file.read()
+        self.assertEqual(b"".join(data[start:end] for start, end in ranges), data)
+        self.assertTrue(all(data[end - 1 : end] == b"\n" for _, end in ranges))
+
+        path, = [p for p in export_files(self.export_dir) if p.endswith(".gz")]
+        blocks = list(line_blocks(path, chunk_size=100))
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual(sum(len(block.splitlines()) for block in blocks), 40)
+
+    def test_write(self):
+        output_dir = os.path.join(self.export_dir, "out")
+        ingest = BulkIngest(CONFIG, chunk_size=100)
+        ingest.write(export_files(self.export_dir), output_dir)
+        self.assertEqual(sorted(os.listdir(output_dir)), ["Observation.ndjson", "Patient.ndjson"])
+
+        patients = self.read(output_dir, "Patient.ndjson")
+        observations = self.read(output_dir, "Observation.ndjson")
+        self.assertEqual(len(patients), 10)
+        self.assertEqual(len(observations), 40)
+        self.assertEqual({patient["gender"] for patient in patients}, {"unknown"})
+        ids = {f'Patient/{patient["id"]}' for patient in patients}
+        self.assertNotIn("Patient/p0", ids)
+        # references across files, cloned in separate chunks, are re-keyed alike
+        self.assertEqual({o["subject"]["reference"] for o in observations}, ids)
+
+    @patch("py_de_id.bulk.cherrypy")
+    def test_resources_without_an_id_are_dropped(self, mock_cherrypy):
+        self.write("Patient.ndjson", self.patients[:2] + [{"resourceType": "Patient", "gender": "male"}])
+        output_dir = os.path.join(self.export_dir, "out")
+        for processes in (0, 2):
+            BulkIngest(CONFIG, processes=processes).write(export_files(self.export_dir), output_dir)
+            patients = self.read(output_dir, "Patient.ndjson")
+            self.assertEqual(len(patients), 2)
+            self.assertTrue(all("id" in patient for patient in patients))
+        mock_cherrypy.log.assert_called_with("Dropped a Patient without an id")
+
+    def test_processes_identical_to_serial(self):
+        paths = export_files(self.export_dir)
+        serial = BulkIngest(CONFIG, chunk_size=200)
+        parallel = BulkIngest(CONFIG, processes=2, namespace=serial.namespace, chunk_size=200)
+        self.assertEqual(list(parallel.clone(paths)), list(serial.clone(paths)))
+
+    def test_batches(self):
+        ingest = BulkIngest(CONFIG, deid=False)
+        batches = list(ingest.batches(export_files(self.export_dir)))
+        self.assertEqual([len(batch) for batch in batches], [40, 10])
+        self.assertEqual(batches[1][0]["request"], {"method": "POST", "url": "Patient"})
+        self.assertEqual(batches[1][0]["resource"]["gender"], "male")
+
+    def test_main_delivers(self):
+        with patch("py_de_id.pydeid.deliver_batches") as mock_deliver, patch("sys.stderr"):
+            main([self.export_dir, "--fhir-target", "http://target/fhir", "--processes", "0"])
+        _, data, batches = mock_deliver.call_args.args
+        self.assertEqual(data["fhir_target"], "http://target/fhir/")
+        self.assertEqual(sum(len(batch) for batch in batches), 50)
+        self.assertEqual(mock_deliver.call_args.kwargs, {"record": False})
+
+    def test_main_keeps_no_job(self):
+        with patch("py_de_id.pydeid.post_batch", return_value=(200, None)) as mock_post, patch(
+            "py_de_id.pydeid.job_store"
+        ) as mock_store, patch("py_de_id.pydeid.cherrypy"), patch("sys.stderr"):
+            main([self.export_dir, "--fhir-target", "http://target/fhir", "--processes", "0"])
+        self.assertEqual(sum(len(call.args[3]) for call in mock_post.call_args_list), 50)
+        self.assertEqual(mock_store.mock_calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.clone import (
+    ReferenceMap,
+    clone_entry,
+    index_references,
+    rekey_references,
+    rewrite_references,
+)
+from py_de_id.placeholders import PlaceholderCache
+
+
+class TestReferences(unittest.TestCase):
+    def setUp(self):
+        self.resource = {
+            "resourceType": "DiagnosticReport",
+            "id": "r1",
+            "subject": {"reference": "Patient/p1", "display": "Jane Doe"},
+            "performer": [{"reference": "Practitioner/dr"}, {"reference": "Organization/o"}],
+            "result": [{"reference": "Observation/o1"}, {"reference": "Observation/gone"}],
+            "basedOn": [{"reference": "http://elsewhere/fhir/ServiceRequest/1"}],
+        }
+
+    def test_index_includes_lists(self):
+        refs = sorted(holder["reference"] for holder in index_references(self.resource, []))
+        self.assertEqual(
+            refs,
+            ["Observation/gone", "Observation/o1", "Organization/o", "Patient/p1", "Practitioner/dr"],
+        )
+
+    def test_deep_nesting(self):
+        node = leaf = {"reference": "Patient/p1"}
+        for _ in range(5000):
+            node = {"item": [node]}
+        self.assertEqual(index_references(node, []), [leaf])
+
+    def test_rewrite_references(self):
+        referenceMap = ReferenceMap()
+        index = []
+        entries = [
+            {"fullUrl": "x", "resource": self.resource},
+            {"resource": {"resourceType": "Patient", "id": "p1"}},
+            {"resource": {"resourceType": "Observation", "id": "o1"}},
+        ]
+        for entry in entries:
+            clone_entry(entry, referenceMap, index=index)
+        self.assertEqual(self.resource["subject"]["reference"], "Patient/p1")
+
+        placeholders, missing = rewrite_references(
+            index, referenceMap, PlaceholderCache().resolver("http://target/fhir")
+        )
+        patient = entries[1]["resource"]
+        self.assertEqual(self.resource["subject"], {"reference": f"Patient/{patient['id']}", "display": f"Patient/{patient['id']}"})
+        self.assertEqual(self.resource["result"][0]["reference"], f"Observation/{entries[2]['resource']['id']}")
+        self.assertEqual(self.resource["result"][1]["reference"], "Observation/gone")
+        self.assertEqual(missing, ["Observation/gone"])
+        self.assertEqual(sorted(placeholders), ["Organization/o", "Practitioner/dr"])
+        dr = placeholders["Practitioner/dr"]["resource"]
+        self.assertEqual(self.resource["performer"][0]["reference"], f"Practitioner/{dr['id']}")
+        self.assertEqual(len(referenceMap), 3)
+
+    def test_minted_ids_are_stable_per_namespace(self):
+        first = ReferenceMap()
+        second = ReferenceMap(first.namespace)
+        self.assertEqual(first.mint("Patient/1"), second.mint("Patient/1"))
+        self.assertNotEqual(first.mint("Patient/1"), ReferenceMap().mint("Patient/1"))
+
+    def test_rekey_references(self):
+        referenceMap = ReferenceMap()
+        rekey_references(self.resource, referenceMap)
+        self.assertEqual(self.resource["result"][1]["reference"], referenceMap["Observation/gone"])
+        self.assertEqual(self.resource["basedOn"][0]["reference"], "http://elsewhere/fhir/ServiceRequest/1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.codec import CODECS, JsonCodec, get_codec
+
+
+class TestCodecs(unittest.TestCase):
+    def setUp(self):
+        self.bundle = {
+            "resourceType": "Bundle",
+            "entry": [{"resource": {"resourceType": "Patient", "id": "1", "name": [{"family": "Müller"}], "multipleBirthBoolean": False, "weight": 70.5, "age": None}}],
+        }
+
+    def test_round_trip(self):
+        for name in CODECS:
+            codec = get_codec(name)
+            encoded = codec.dumps(self.bundle)
+            self.assertIsInstance(encoded, bytes)
+            self.assertIn("Müller".encode("utf-8"), encoded)
+            self.assertEqual(codec.loads(encoded), self.bundle)
+            self.assertEqual(codec.loads(encoded.decode("utf-8")), self.bundle)
+
+    def test_invalid(self):
+        for name in CODECS:
+            with self.assertRaises(ValueError):
+                get_codec(name).loads(b'{"entry": [')
+
+    def test_choice(self):
+        self.assertIsInstance(get_codec("json"), JsonCodec)
+        self.assertIsInstance(get_codec("missing"), JsonCodec)
+        with patch.dict(os.environ, {"PYDEID_JSON": "json"}):
+            self.assertIsInstance(get_codec(), JsonCodec)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+import json
+import os
+import sys
+import shutil
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import process_request
+from py_de_id.jobs import JobScheduler
+from py_de_id.scheduler import DeliveryScheduler
+from py_de_id.store import JobStore
+
+
+def everything(patient_id):
+    return [
+        {"resource": {"resourceType": "Patient", "id": patient_id}},
+        {
+            "resource": {
+                "resourceType": "Encounter",
+                "id": f"e-{patient_id}",
+                "subject": {"reference": f"Patient/{patient_id}"},
+                "participant": [{"individual": {"reference": "Practitioner/shared"}}],
+                "serviceProvider": {"reference": "Organization/shared"},
+            }
+        },
+        {"resource": {"resourceType": "Practitioner", "id": "shared"}},
+        {"resource": {"resourceType": "Organization", "id": "shared"}},
+    ]
+
+
+class TestCohortJobs(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "./input"
+        os.makedirs(self.test_dir, exist_ok=True)
+        self.store = JobStore(":memory:")
+        self.scheduler = JobScheduler(workers=0, store=self.store)
+        self.fetched = []
+        self.patches = [
+            patch("py_de_id.pydeid.job_store", self.store),
+            patch("py_de_id.pydeid.job_scheduler", self.scheduler),
+            patch("py_de_id.pydeid.cherrypy"),
+            patch("py_de_id.pydeid.delivery_scheduler", DeliveryScheduler(rate=1000)),
+            patch("py_de_id.sessions.requests.Session.get", side_effect=self.get),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        shutil.rmtree(self.test_dir)
+
+    def get(self, url, **kwargs):
+        patient_id = url.split("/Patient/")[1].split("/")[0]
+        self.fetched.append(url)
+        response = MagicMock()
+        response.status_code = 404 if patient_id == "missing" else 200
+        response.iter_content.return_value = [json.dumps({"entry": everything(patient_id)}).encode()]
+        return response
+
+    def run_job(self, patients):
+        self.store.create(
+            "cohort",
+            "default",
+            {
+                "source_token": "token",
+                "fhir_source": "http://source/fhir/",
+                "target_token": "token",
+                "fhir_target": "http://target/fhir/",
+                "deid": True,
+                "patients": patients,
+                "cohort_concurrency": 2,
+            },
+        )
+        self.scheduler.submit("cohort", "default", process_request, "cohort")
+        with patch("py_de_id.pydeid.post_batch", return_value=(200, None)) as mock_post:
+            process_request("cohort")
+        return [entry for call in mock_post.call_args_list for entry in call.args[3]]
+
+    def test_shared_resources_are_cloned_once(self):
+        delivered = self.run_job(["a", "b", "c"])
+        self.assertEqual(
+            sorted(self.fetched),
+            [f"http://source/fhir/Patient/{p}/$everything" for p in ("a", "b", "c")],
+        )
+        types = [entry["resource"]["resourceType"] for entry in delivered]
+        self.assertEqual(types.count("Patient"), 3)
+        self.assertEqual(types.count("Practitioner"), 1)
+        self.assertEqual(types.count("Organization"), 1)
+        practitioner = [e for e in delivered if e["resource"]["resourceType"] == "Practitioner"][0]
+        references = {
+            entry["resource"]["participant"][0]["individual"]["reference"]
+            for entry in delivered
+            if entry["resource"]["resourceType"] == "Encounter"
+        }
+        self.assertEqual(references, {f'Practitioner/{practitioner["resource"]["id"]}'})
+
+        patients = self.scheduler.status("cohort")["patients"]
+        self.assertEqual(patients["a"], {"status": "done", "resources": 4, "shared": 0})
+        self.assertEqual(patients["b"], {"status": "done", "resources": 2, "shared": 2})
+
+    def test_failed_patient(self):
+        delivered = self.run_job(["a", "missing", "b"])
+        self.assertEqual(len(delivered), 6)
+        status = self.scheduler.status("cohort")
+        self.assertEqual(status["status"], "failed")
+        self.assertIn("missing", status["error"])
+        self.assertEqual(status["patients"]["missing"]["status"], "failed")
+        self.assertEqual(status["patients"]["b"]["status"], "done")
+
+
+if __name__ == "__main__":
+    unittest.main()
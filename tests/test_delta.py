@@ -0,0 +1,153 @@
+import unittest
+import json
+import os
+import sys
+import shutil
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import process_request
+from py_de_id.clone import ReferenceMap, clone_entry
+from py_de_id.delta import DeltaMap, location_reference
+from py_de_id.rules import RulePlan
+from py_de_id.scheduler import DeliveryScheduler
+from py_de_id.store import JobStore
+
+
+def observation(id, value):
+    return {
+        "resource": {
+            "resourceType": "Observation",
+            "id": id,
+            "subject": {"reference": "Patient/p"},
+            "valueQuantity": {"value": value},
+        }
+    }
+
+
+class TestDeltaMap(unittest.TestCase):
+    def test_seeded_randomize(self):
+        plan = RulePlan({"Patient": [{"field": "birthDate", "action": "randomize", "params": {"min": 300, "max": 300}}]})
+        referenceMap = ReferenceMap()
+        dates = set()
+        for _ in range(5):
+            entry = {"resource": {"resourceType": "Patient", "id": "p", "birthDate": "2000-06-15"}}
+            clone_entry(entry, referenceMap, plan)
+            dates.add(entry["resource"]["birthDate"])
+        self.assertEqual(len(dates), 1)
+
+    def test_changes(self):
+        first = DeltaMap(ReferenceMap().namespace, {})
+        entries = [observation("1", 1), observation("2", 2)]
+        for entry in entries:
+            clone_entry(entry, first)
+        self.assertEqual(first.changes(entries), entries)
+        clones = first.acknowledge(entries, [None, "http://t/fhir/Observation/server-2/_history/1"])
+        self.assertEqual(clones[0], ("Observation/1", first["Observation/1"], first.source_digest("Observation/1", entries[0]["resource"])))
+        self.assertEqual(clones[1][1], "Observation/server-2")
+
+        previous = {ref: (target, hash) for ref, target, hash in clones}
+        second = DeltaMap(first.namespace, previous)
+        entries = [observation("1", 1), observation("2", 20), observation("3", 3)]
+        for entry in entries:
+            clone_entry(entry, second)
+        changed = second.changes(entries)
+        self.assertEqual([entry["resource"]["id"] for entry in changed], ["server-2", entries[2]["resource"]["id"]])
+        self.assertEqual(changed[0]["request"], {"method": "PUT", "url": "Observation/server-2"})
+        self.assertEqual(changed[1]["request"]["method"], "POST")
+        self.assertEqual(second.counts, {"new": 1, "changed": 1, "unchanged": 1})
+
+    def test_location_reference(self):
+        self.assertEqual(location_reference("Observation/1/_history/2"), "Observation/1")
+        self.assertEqual(location_reference("http://t/fhir/Observation/1"), "Observation/1")
+
+
+class TestDeltaJobs(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "./input"
+        os.makedirs(self.test_dir, exist_ok=True)
+        self.store = JobStore(":memory:")
+        self.page = [observation(str(i), i) for i in range(4)] + [
+            {"resource": {"resourceType": "Patient", "id": "p", "birthDate": "2000-01-01"}}
+        ]
+        self.patches = [
+            patch("py_de_id.pydeid.job_store", self.store),
+            patch("py_de_id.pydeid.cherrypy"),
+            patch("py_de_id.pydeid.delivery_scheduler", DeliveryScheduler(rate=1000)),
+            patch("py_de_id.sessions.requests.Session.get", side_effect=self.get),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        shutil.rmtree(self.test_dir)
+
+    def get(self, url, **kwargs):
+        response = MagicMock()
+        response.status_code = 200
+        response.iter_content.return_value = [json.dumps({"entry": self.page}).encode()]
+        return response
+
+    def run_job(self, job_id, assign_ids=False):
+        self.store.create(
+            job_id,
+            "default",
+            {
+                "source_token": "token",
+                "fhir_source": "http://source/fhir/Patient/p/$everything",
+                "target_token": "token",
+                "fhir_target": "http://target/fhir/",
+                "deid": True,
+                "delta": True,
+            },
+        )
+        with patch("py_de_id.pydeid.post_batch", return_value=(200, None)) as mock_post:
+            if assign_ids:
+                mock_post.side_effect = self.assign_ids
+            process_request(job_id)
+        return [entry for call in mock_post.call_args_list for entry in call.args[3]]
+
+    def assign_ids(self, transaction_id, session, url, entries, locations=None):
+        """A target that gives POSTed resources ids of its own, as FHIR servers do"""
+        for entry in entries:
+            resource = entry["resource"]
+            if entry["request"]["method"] == "POST":
+                location = f'{url}/{resource["resourceType"]}/server-{resource["id"]}/_history/1'
+            else:
+                location = f'{url}/{entry["request"]["url"]}/_history/2'
+            locations.append(location)
+        return 200, None
+
+    def test_only_changes_are_delivered(self):
+        first = self.run_job("a")
+        self.assertEqual(len(first), 5)
+        self.assertEqual(self.run_job("b"), [])
+
+        self.page[1] = observation("1", 100)
+        self.page.append(observation("4", 4))
+        third = self.run_job("c")
+        self.assertEqual(
+            [entry["request"]["method"] for entry in third], ["PUT", "POST"]
+        )
+        ids = {entry["resource"]["id"]: entry for entry in first}
+        self.assertIn(third[0]["resource"]["id"], ids)
+        self.assertEqual(third[0]["request"]["url"], f'Observation/{third[0]["resource"]["id"]}')
+        self.assertNotIn(third[1]["resource"]["id"], ids)
+
+    def test_ids_given_by_the_target(self):
+        first = self.run_job("a", assign_ids=True)
+        self.assertEqual([entry["request"]["method"] for entry in first], ["POST"] * 5)
+        self.assertEqual(self.run_job("b", assign_ids=True), [])
+
+        self.page[1] = observation("1", 100)
+        third = self.run_job("c", assign_ids=True)
+        self.assertEqual([entry["request"]["method"] for entry in third], ["PUT"])
+        self.assertTrue(third[0]["resource"]["id"].startswith("server-"))
+        self.assertTrue(third[0]["resource"]["subject"]["reference"].startswith("Patient/server-"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.jobs import JobQueueFull, JobScheduler
+from py_de_id.store import JobStore
+
+
+class TestJobScheduler(unittest.TestCase):
+    def test_tenants_take_turns(self):
+        scheduler = JobScheduler(workers=1)
+        gate = threading.Event()
+        started = threading.Event()
+        ran = []
+        finished = threading.Semaphore(0)
+
+        def job(name):
+            started.set()
+            gate.wait()
+            ran.append(name)
+            finished.release()
+
+        scheduler.submit("blocker", "a", job, "blocker")
+        started.wait(5)
+        for i in range(3):
+            scheduler.submit(f"a{i}", "a", job, f"a{i}")
+        scheduler.submit("b0", "b", job, "b0")
+        scheduler.submit("c0", "c", job, "c0")
+        gate.set()
+        for _ in range(6):
+            finished.acquire(timeout=5)
+        self.assertEqual(ran, ["blocker", "a0", "b0", "c0", "a1", "a2"])
+        self.assertEqual(scheduler.status("a2")["status"], "done")
+
+    def test_queue_limits(self):
+        scheduler = JobScheduler(workers=0, max_queued=3, max_per_tenant=2)
+        scheduler.submit("a0", "a", print)
+        scheduler.submit("a1", "a", print)
+        with self.assertRaises(JobQueueFull) as tenant_full:
+            scheduler.submit("a2", "a", print)
+        self.assertTrue(tenant_full.exception.tenant)
+        scheduler.submit("b0", "b", print)
+        with self.assertRaises(JobQueueFull) as queue_full:
+            scheduler.submit("c0", "c", print)
+        self.assertFalse(queue_full.exception.tenant)
+        self.assertEqual(scheduler.saturation(), 1)
+        self.assertEqual(scheduler.status("b0")["status"], "queued")
+
+    @patch("py_de_id.jobs.cherrypy")
+    def test_failed_is_final(self, mock_cherrypy):
+        scheduler = JobScheduler(workers=1)
+        done = threading.Event()
+
+        def job():
+            scheduler.update("x", "fetching")
+            try:
+                raise ValueError("no")
+            finally:
+                done.set()
+
+        scheduler.submit("x", "a", job)
+        done.wait(5)
+        for _ in range(50):
+            if scheduler.status("x")["status"] == "failed":
+                break
+            threading.Event().wait(0.01)
+        scheduler.update("x", "done")
+        self.assertEqual(scheduler.status("x")["status"], "failed")
+        self.assertEqual(scheduler.status("x")["error"], "no")
+
+    def test_status_is_stored(self):
+        store = JobStore(":memory:")
+        store.create("x", "a", {})
+        scheduler = JobScheduler(workers=0, store=store)
+        scheduler.submit("x", "a", print)
+        scheduler.update("x", "cloning")
+        self.assertEqual(store.status("x")["status"], "cloning")
+        # as seen by a process started later
+        self.assertEqual(JobScheduler(workers=0, store=store).status("x")["status"], "cloning")
+        self.assertIsNone(JobScheduler(workers=0, store=store).status("y"))
+
+    def test_drain(self):
+        scheduler = JobScheduler(workers=1)
+        started = threading.Event()
+        gate = threading.Event()
+
+        def job():
+            started.set()
+            gate.wait(5)
+
+        scheduler.submit("running", "a", job)
+        started.wait(5)
+        scheduler.submit("queued", "a", job)
+        self.assertFalse(scheduler.drain(0.05))
+        gate.set()
+        self.assertTrue(scheduler.drain(5))
+        self.assertEqual(scheduler.status("running")["status"], "done")
+        self.assertEqual(scheduler.status("queued")["status"], "queued")
+
+
+if __name__ == "__main__":
+    unittest.main()
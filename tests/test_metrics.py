@@ -0,0 +1,88 @@
+import unittest
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import Deidentifier, RulePlan
+from py_de_id.metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_across_threads(self):
+        counter = Counter("things_total", "Things", ("kind",), registry=self.registry)
+
+        def count():
+            for _ in range(1000):
+                counter.inc(labels=("a",))
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(2, ("b\"",))
+        self.assertEqual(counter.collect(), {("a",): 4000, ('b"',): 2})
+        # the shards of the threads that ended are folded together
+        self.assertEqual(len(counter._shards), 1)
+        self.assertEqual(counter.collect(), {("a",): 4000, ('b"',): 2})
+        self.assertEqual(
+            self.registry.render(),
+            '# HELP things_total Things\n# TYPE things_total counter\n'
+            'things_total{kind="a"} 4000\nthings_total{kind="b\\""} 2\n',
+        )
+
+    def test_histogram(self):
+        histogram = Histogram("took_seconds", "Took", ("stage",), buckets=(0.1, 1), registry=self.registry)
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value, ("fetch",))
+        with histogram.time(("clone",)):
+            pass
+        lines = self.registry.render().splitlines()
+        self.assertIn('took_seconds_bucket{stage="fetch",le="0.1"} 2', lines)
+        self.assertIn('took_seconds_bucket{stage="fetch",le="1"} 3', lines)
+        self.assertIn('took_seconds_bucket{stage="fetch",le="+Inf"} 4', lines)
+        self.assertIn('took_seconds_sum{stage="fetch"} 5.65', lines)
+        self.assertIn('took_seconds_count{stage="fetch"} 4', lines)
+        self.assertIn('took_seconds_count{stage="clone"} 1', lines)
+
+    def test_gauge(self):
+        Gauge("queued", "Queued", lambda: 3, registry=self.registry)
+        self.assertIn("queued 3", self.registry.render().splitlines())
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_metrics(self, mock_cherrypy):
+        plan = RulePlan({"*": [{"field": "meta", "action": "erase"}], "Patient": [{"field": "gender", "action": "erase"}]})
+        plan.apply({"resourceType": "Patient", "gender": "male"})
+        text = Deidentifier().metrics()
+        self.assertIn("# TYPE pydeid_stage_seconds histogram", text)
+        self.assertIn('pydeid_jobs{state="running"} 0', text)
+        self.assertRegex(
+            text, r'pydeid_rule_executions_total\{resource_type="Patient",field="gender",action="erase"\} \d+'
+        )
+        self.assertTrue(mock_cherrypy.response.headers.__setitem__.called)
+
+    def test_rule_profile(self):
+        plan = RulePlan({"Observation": [{"field": "status", "action": "replace", "params": "final"}]})
+        before = {(row["resource_type"], row["field"]): row for row in Deidentifier.debug.rules()}
+        plan.apply_many([{"resourceType": "Observation", "status": "draft"} for _ in range(3)])
+        with patch.object(RulePlan, "profile", True):
+            plan.apply({"resourceType": "Observation", "status": "draft"})
+        rows = Deidentifier.debug.rules()
+        row = next(row for row in rows if (row["resource_type"], row["field"]) == ("Observation", "status"))
+        calls = before.get(("Observation", "status"), {"calls": 0})["calls"]
+        self.assertEqual(row["action"], "replace")
+        self.assertEqual(row["calls"], calls + 4)
+        self.assertGreater(row["seconds"], 0)
+        self.assertEqual(rows, sorted(rows, key=lambda row: -row["seconds"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.clone import ReferenceMap, clone_entry
+from py_de_id.parallel import ClonePool
+from py_de_id.rules import RulePlan
+
+CONFIG = {
+    "*": [{"field": "meta", "action": "erase"}],
+    "Patient": [{"field": "gender", "action": "replace", "params": "unknown"}],
+    "Observation": [
+        {"field": "note", "action": "merge", "params": ["[n for n in %input% if 'secret' not in n['text']]"]}
+    ],
+}
+
+
+def bundle_entries():
+    entries = [{"fullUrl": "p", "resource": {"resourceType": "Patient", "id": "p", "gender": "male", "meta": {}}}]
+    for i in range(50):
+        entries.append(
+            {
+                "resource": {
+                    "resourceType": "Observation",
+                    "id": f"o{i}",
+                    "subject": {"reference": "Patient/p"},
+                    "performer": [{"reference": f"Practitioner/{i % 3}"}],
+                    "note": [{"text": "secret"}, {"text": "ok"}],
+                },
+                "search": {"mode": "match"},
+            }
+        )
+    entries.append({"search": {}})
+    return entries
+
+
+class TestClonePool(unittest.TestCase):
+    def test_identical_to_serial(self):
+        plan = RulePlan(CONFIG)
+        serialMap = ReferenceMap()
+        serial = []
+        for entry in bundle_entries():
+            linked = []
+            serial.append((entry, clone_entry(entry, serialMap, plan, linked=linked), linked))
+
+        pool = ClonePool(2, CONFIG, shard_size=7)
+        try:
+            parallelMap = ReferenceMap(serialMap.namespace)
+            parallel = list(pool.clone(iter(bundle_entries()), parallelMap, True))
+        finally:
+            pool.shutdown()
+
+        self.assertEqual(parallel, serial)
+        self.assertEqual(parallelMap, serialMap)
+        self.assertIn("Practitioner/2", parallelMap)
+        self.assertEqual(parallel[3][2], ["Practitioner/2"])
+        self.assertEqual(serial[1][0]["resource"]["note"], [{"text": "ok"}])
+
+    def test_reloaded_rules(self):
+        reloaded = RulePlan({"Patient": [{"field": "gender", "action": "replace", "params": "other"}]}, 2)
+        serialMap = ReferenceMap()
+        serial = []
+        for entry in bundle_entries():
+            linked = []
+            serial.append((entry, clone_entry(entry, serialMap, reloaded, linked=linked), linked))
+
+        pool = ClonePool(1, CONFIG, shard_size=7)
+        try:
+            parallel = list(pool.clone(iter(bundle_entries()), ReferenceMap(serialMap.namespace), True, reloaded))
+        finally:
+            pool.shutdown()
+
+        self.assertEqual(parallel, serial)
+        self.assertEqual(parallel[0][0]["resource"]["gender"], "other")
+
+
+if __name__ == "__main__":
+    unittest.main()
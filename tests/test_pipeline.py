@@ -0,0 +1,41 @@
+import unittest
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.pipeline import background
+
+
+class TestBackground(unittest.TestCase):
+    def test_items(self):
+        self.assertEqual(list(background(iter(range(10)), 2)), list(range(10)))
+
+    def test_producer_exception(self):
+        def produce():
+            yield 1
+            raise KeyError("boom")
+
+        items = background(produce(), 1)
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(KeyError):
+            next(items)
+
+    def test_bounded(self):
+        produced = []
+        def produce():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        items = background(produce(), 2)
+        self.assertEqual(next(items), 0)
+        time.sleep(0.3)
+        # one item handed over, two queued and one waiting to be queued
+        self.assertLessEqual(len(produced), 4)
+        items.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
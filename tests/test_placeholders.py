@@ -0,0 +1,124 @@
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.clone import PendingEntries, ReferenceMap, clone_entry
+from py_de_id.placeholders import PlaceholderCache
+from py_de_id.pydeid import clone_batches
+
+TARGET = "http://localhost/fhir"
+
+
+class TestPlaceholderCache(unittest.TestCase):
+    def test_created_once_per_job(self):
+        placeholder = PlaceholderCache().resolver(TARGET)
+        ref, entry = placeholder("Practitioner/a")
+        self.assertEqual(entry["resource"]["id"], ref.split("/")[1])
+        self.assertEqual(
+            entry["request"]["ifNoneExist"], "identifier=my-elixir|unknown-practitioner"
+        )
+        self.assertEqual(placeholder("Practitioner/b"), (ref, None))
+        self.assertNotEqual(placeholder("Location/a")[0].split("/")[1], ref.split("/")[1])
+
+    def test_stable_per_target(self):
+        self.assertEqual(
+            PlaceholderCache().resolver(TARGET)("Organization/1")[0],
+            PlaceholderCache().resolver(TARGET)("Organization/2")[0],
+        )
+        self.assertNotEqual(
+            PlaceholderCache().resolver(TARGET)("Organization/1")[0],
+            PlaceholderCache().resolver("http://other/fhir")("Organization/1")[0],
+        )
+
+    def test_reused_once_acknowledged(self):
+        cache = PlaceholderCache()
+        ref, entry = cache.resolver(TARGET)("Organization/1")
+        self.assertIsNotNone(cache.resolver(TARGET)("Organization/1")[1])
+        cache.acknowledge(TARGET, [{"resource": {"resourceType": "Patient"}}, entry])
+        self.assertEqual(cache.resolver(TARGET)("Organization/9"), (ref, None))
+        self.assertIsNotNone(cache.resolver("http://other/fhir")("Organization/1")[1])
+        self.assertEqual(cache.stats(), {"placeholders": 1})
+
+    def test_eviction(self):
+        cache = PlaceholderCache(max_size=2)
+        for resource_type in ["Organization", "Practitioner", "Location"]:
+            _, entry = cache.resolver(TARGET)(f"{resource_type}/1")
+            cache.acknowledge(TARGET, [entry])
+        self.assertFalse(cache.known(TARGET, "Organization"))
+        self.assertTrue(cache.known(TARGET, "Location"))
+
+        cache = PlaceholderCache(ttl=10)
+        cache.acknowledge(TARGET, [cache.resolver(TARGET)("Location/1")[1]])
+        with patch("py_de_id.placeholders.time.monotonic", return_value=1e12):
+            self.assertFalse(cache.known(TARGET, "Location"))
+
+
+class TestPendingEntries(unittest.TestCase):
+    def clone(self, pending, referenceMap, resource):
+        entry = {"resource": resource}
+        linked = []
+        ref = clone_entry(entry, referenceMap, linked=linked)
+        return [entry["resource"]["resourceType"] for entry in pending.add(entry, ref, linked)]
+
+    def test_held_until_cloned(self):
+        referenceMap = ReferenceMap()
+        pending = PendingEntries(referenceMap, PlaceholderCache().resolver(TARGET))
+        encounter = {"resourceType": "Encounter", "id": "e", "serviceProvider": {"reference": "Organization/o"}}
+        self.assertEqual(self.clone(pending, referenceMap, encounter), [])
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(
+            self.clone(pending, referenceMap, {"resourceType": "Organization", "id": "o"}),
+            ["Organization", "Encounter"],
+        )
+        self.assertEqual(encounter["serviceProvider"]["reference"], referenceMap["Organization/o"])
+        self.assertEqual(pending.flush(), [])
+
+    def test_placeholder_when_missing(self):
+        referenceMap = ReferenceMap()
+        placeholder = PlaceholderCache().resolver(TARGET)
+        pending = PendingEntries(referenceMap, placeholder, max_pending=1)
+        first = {"resourceType": "Encounter", "id": "1", "location": [{"location": {"reference": "Location/l"}}]}
+        second = {"resourceType": "Encounter", "id": "2", "location": [{"location": {"reference": "Location/l"}}]}
+        third = {"resourceType": "Encounter", "id": "3", "location": [{"location": {"reference": "Location/l"}}]}
+        self.assertEqual(self.clone(pending, referenceMap, first), [])
+        self.assertEqual(self.clone(pending, referenceMap, second), ["Location", "Encounter"])
+        # the location has gone to the placeholder, so the rest go there too
+        self.assertEqual(self.clone(pending, referenceMap, third), ["Encounter"])
+        self.assertEqual(len(pending), 1)
+        self.assertEqual([entry["resource"] for entry in pending.flush()], [second])
+
+        location = placeholder("Location/l")[0]
+        for encounter in [first, second, third]:
+            self.assertEqual(encounter["location"][0]["location"]["reference"], location)
+        self.assertEqual(pending.redirected, {"Location/l": location})
+
+
+class TestCloneBatches(unittest.TestCase):
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_reused_across_jobs(self, mock_cherrypy):
+        data = {"fhir_target": f"{TARGET}/", "deid": False}
+        cache = PlaceholderCache()
+
+        def job(transaction_id):
+            page = [
+                {"resource": {"resourceType": "Encounter", "id": "e", "participant": [{"individual": {"reference": "Practitioner/x"}}]}}
+            ]
+            batches = list(clone_batches(transaction_id, data, [page]))
+            return [entry for batch in batches for entry in batch]
+
+        with patch("py_de_id.pydeid.placeholder_cache", cache):
+            placeholder, encounter = job("first")
+            cache.acknowledge(TARGET, [placeholder, encounter])
+            (second,) = job("second")
+        self.assertEqual(placeholder["resource"]["name"], "unknown-practitioner")
+        self.assertEqual(
+            second["resource"]["participant"][0]["individual"]["reference"],
+            f"Practitioner/{placeholder['resource']['id']}",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
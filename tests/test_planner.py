@@ -0,0 +1,152 @@
+import unittest
+import os
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import deliver_batches
+from py_de_id.metrics import PLAN_LEVELS
+from py_de_id.placeholders import placeholder_entry
+from py_de_id.planner import Planner, plan_levels, planned, strongly_connected
+from py_de_id.scheduler import DeliveryScheduler, TargetLimiter
+
+
+def entry(resource_type, id, *refs):
+    resource = {"resourceType": resource_type, "id": id}
+    if refs:
+        resource["ref"] = [{"reference": ref} for ref in refs]
+    return {"resource": resource}
+
+
+def ids(levels):
+    return [[[e["resource"]["id"] for e in batch] for batch in level] for level in levels]
+
+
+class TestPlanner(unittest.TestCase):
+    def test_referenced_resources_come_first(self):
+        entries = [
+            entry("Observation", "o1", "Encounter/e1", "Patient/p"),
+            entry("Encounter", "e1", "Patient/p", "Organization/unknown"),
+            entry("Patient", "p"),
+            entry("Observation", "o2", "Patient/elsewhere"),
+            placeholder_entry("Organization", "unknown"),
+        ]
+        self.assertEqual(
+            ids(plan_levels(entries, 2)),
+            [[["p", "o2"], ["unknown"]], [["e1"]], [["o1"]]],
+        )
+
+    def test_cycles_share_a_batch(self):
+        entries = [
+            entry("Encounter", "e", "Condition/c", "Patient/p"),
+            entry("Condition", "c", "Encounter/e"),
+            entry("Patient", "p"),
+            entry("Observation", "o", "Condition/c"),
+        ]
+        self.assertEqual(ids(plan_levels(entries, 1)), [[["p"]], [["e", "c"]], [["o"]]])
+
+    def test_long_chains(self):
+        count = 5000
+        entries = [entry("Observation", str(n), f"Observation/{n + 1}") for n in range(count)]
+        levels = plan_levels(entries, 15)
+        self.assertEqual(len(levels), count)
+        self.assertEqual(levels[0][0][0]["resource"]["id"], str(count - 1))
+        self.assertEqual(len(strongly_connected([{1}, {0}] + [set()] * count)), count + 1)
+
+    def test_critical_path_is_observed(self):
+        before = PLAN_LEVELS.collect().get((), [0] * 13)
+        plan_levels([entry("Patient", "p"), entry("Encounter", "e", "Patient/p")], 15)
+        after = PLAN_LEVELS.collect()[()]
+        self.assertEqual(after[-1] - before[-1], 1)
+        self.assertEqual(after[-2] - before[-2], 2)
+
+    def test_entries_wait_for_what_they_refer_to(self):
+        planner = Planner(resolved={"Patient/p"})
+        self.assertEqual(
+            ids([[planner.add([entry("Encounter", "e", "Patient/p", "Location/l")])]]), [[[]]]
+        )
+        self.assertEqual(ids([[planner.add([entry("Observation", "o", "Patient/p")])]]), [[["o"]]])
+        # the Encounter is released with the Location it waited for
+        self.assertEqual(ids([[planner.add([entry("Location", "l")])]]), [[["e", "l"]]])
+        self.assertEqual(len(planner), 0)
+
+    def test_cycles_are_released_together(self):
+        planner = Planner()
+        self.assertEqual(planner.add([entry("Encounter", "e", "Condition/c")]), [])
+        released = planner.add([entry("Condition", "c", "Encounter/e")])
+        self.assertEqual(ids([[released]]), [[["e", "c"]]])
+
+    def test_missing_resources_are_given_up_on(self):
+        planner = Planner(max_pending=2)
+        planner.add([entry("Observation", "o1", "Medication/elsewhere")])
+        self.assertEqual(planner.add([entry("Observation", "o2", "Medication/elsewhere")]), [])
+        released = planner.add([entry("Observation", "o3", "Medication/elsewhere")])
+        self.assertEqual(ids([[released]]), [[["o1", "o2", "o3"]]])
+        released = planner.add([entry("Observation", "o4", "Medication/elsewhere")])
+        self.assertEqual(ids([[released]]), [[["o4"]]])
+        planner.add([entry("Observation", "o5", "Patient/elsewhere")])
+        self.assertEqual(ids([[planner.flush()]]), [[["o5"]]])
+
+    def test_a_reference_far_ahead(self):
+        limiter = TargetLimiter(batch_size=15)
+        batches = [[entry("Encounter", "e", "Patient/p")]]
+        batches += [[entry("Observation", f"o{n}")] for n in range(1500)]
+        batches += [[entry("Patient", "p")], [entry("Observation", "last", "Encounter/e")]]
+        order = [e["resource"]["id"] for level in planned(batches, limiter) for b in level for e in b]
+        self.assertEqual(len(order), 1503)
+        # the Observations were not held back with the Encounter
+        self.assertEqual(order[0], "o0")
+        self.assertEqual(order[-3:], ["p", "e", "last"])
+
+    def test_ready_entries_are_planned_as_they_come(self):
+        limiter = TargetLimiter(batch_size=2)
+        taken = []
+
+        def batches():
+            for n in range(5):
+                taken.append(n)
+                yield [entry("Patient", str(n))]
+
+        levels = planned(batches(), limiter)
+        self.assertEqual(ids([next(levels)]), [[["0", "1"]]])
+        self.assertEqual(taken, [0, 1])
+        self.assertEqual([len(batch) for level in levels for batch in level], [2, 1])
+
+        levels = planned([[entry("Patient", str(n))] for n in range(5)], limiter, concurrency=2)
+        self.assertEqual([len(batch) for level in levels for batch in level], [2, 2, 1])
+
+
+class TestPlannedDelivery(unittest.TestCase):
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_levels_are_posted_in_turn(self, mock_cherrypy):
+        lock = threading.Lock()
+        events = []
+
+        def post(transaction_id, session, url, entries, locations=None):
+            names = [e["resource"]["id"] for e in entries]
+            with lock:
+                events.append(("start", names))
+            time.sleep(0.02)
+            with lock:
+                events.append(("end", names))
+            return 200, None
+
+        data = {"target_token": "token", "fhir_target": "http://localhost/fhir/", "concurrency": 4}
+        batches = [
+            [entry("Observation", f"o{n}", "Patient/p") for n in range(3)] + [entry("Patient", "p")]
+        ]
+        scheduler = DeliveryScheduler(rate=1000, batch_size=1, max_batch=1)
+        with patch("py_de_id.pydeid.delivery_scheduler", scheduler), patch(
+            "py_de_id.pydeid.post_batch", side_effect=post
+        ):
+            deliver_batches("tx", data, batches)
+        self.assertEqual(events[:2], [("start", ["p"]), ("end", ["p"])])
+        # the Observations were then posted at once
+        self.assertEqual([event for event, _ in events[2:5]], ["start"] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
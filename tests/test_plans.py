@@ -0,0 +1,127 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.plans import PlanManager
+from py_de_id.rules import validate_config
+
+RULES = """
+Patient:
+  - field: gender
+    action: replace
+    params: {value}
+"""
+
+
+@patch("py_de_id.plans.cherrypy")
+class TestPlanManager(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "config.yaml")
+        self.mtime = time.time_ns()
+        self.write(RULES.format(value="unknown"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        with open(self.path, "w") as file:
+            file.write(text)
+        # a later modification time, however coarse the file system's clock
+        self.mtime += 10**9
+        os.utime(self.path, ns=(self.mtime, self.mtime))
+
+    def gender(self, plan):
+        return plan.apply({"resourceType": "Patient", "gender": "male"})["gender"]
+
+    def test_reload(self, mock_cherrypy):
+        manager = PlanManager(self.path)
+        first = manager.plan
+        self.assertEqual(first.version, 1)
+        self.assertFalse(manager.check())
+
+        self.write(RULES.format(value="other"))
+        self.assertTrue(manager.check())
+        self.assertEqual(manager.plan.version, 2)
+        self.assertEqual(self.gender(manager.plan), "other")
+        # a job holding the first plan keeps it
+        self.assertEqual(self.gender(first), "unknown")
+
+        # the same rules written again are not a new version
+        self.write(RULES.format(value="other"))
+        self.assertFalse(manager.check())
+        self.assertEqual(manager.stats()["version"], 2)
+
+    def test_invalid_rules_are_ignored(self, mock_cherrypy):
+        manager = PlanManager(self.path)
+        self.write("Patient:\n  - field: gender\n    action: shuffle\n")
+        self.assertFalse(manager.check())
+        self.write("Patient: [")
+        self.assertFalse(manager.check())
+        self.assertEqual(manager.plan.version, 1)
+        self.assertIn("Ignoring", manager.stats()["error"])
+
+        self.write(RULES.format(value="other"))
+        self.assertTrue(manager.check())
+        self.assertIsNone(manager.stats()["error"])
+
+    def test_watch(self, mock_cherrypy):
+        manager = PlanManager(self.path, interval=0.01)
+        manager.start()
+        try:
+            self.write(RULES.format(value="other"))
+            deadline = time.monotonic() + 5
+            while manager.plan.version == 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            manager.stop()
+        self.assertEqual(self.gender(manager.plan), "other")
+
+
+class TestValidateConfig(unittest.TestCase):
+    def test_valid(self):
+        validate_config(
+            {
+                "*": [{"field": "meta", "action": "erase"}],
+                "Patient": [
+                    {"field": "birthDate", "action": "randomize", "params": {"min": -15, "max": 15}},
+                    {"field": "address", "action": "merge", "params": ["[a for a in %input%]"]},
+                    {"field": "extension[url~http://example.org/a.b]", "action": "erase"},
+                    {"field": "address[*].postalCode", "action": "truncate", "params": {"length": 2}},
+                ],
+                "Device": None,
+            }
+        )
+
+    def test_problems(self):
+        with self.assertRaises(ValueError) as raised:
+            validate_config(
+                {
+                    "Patient": [
+                        {"action": "erase"},
+                        {"field": "name", "action": "shuffle"},
+                        {"field": "birthDate", "action": "randomize", "params": {"min": "a"}},
+                        {"field": "address", "action": "merge", "params": ["[a for"]},
+                        {"field": "address[*.city", "action": "erase"},
+                        {"field": "name[*]", "action": "randomize"},
+                        {"field": "address[*].postalCode", "action": "truncate", "params": "2"},
+                        {"field": "address[*].postalCode", "action": "truncate", "params": {"length": 2, "fill": 0}},
+                    ],
+                    "Device": {"field": "x"},
+                }
+            )
+        message = str(raised.exception)
+        for problem in ("Patient[0]", "shuffle", "Patient[2]", "Patient[3]", "Patient[4]", "Patient[5]", "Patient[6]", "Patient[7]", "Device"):
+            self.assertIn(problem, message)
+        with self.assertRaises(ValueError):
+            validate_config(["not", "a", "mapping"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,9 @@ import os
 import sys
 import json
 import shutil
+import cherrypy
+import threading
+import time
 from unittest.mock import patch, MagicMock
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -14,11 +17,15 @@ from py_de_id import (
     base_dir,
     config,
     deidentify_fhir_resource,
+    deliver_batches,
     deliver_clone,
     clone_bundle,
     process_request,
     Deidentifier,
 )
+from py_de_id.jobs import JobQueueFull
+from py_de_id.scheduler import DeliveryScheduler
+from py_de_id.store import JobStore
 
 
 class TestPyDeId(unittest.TestCase):
@@ -26,6 +33,9 @@ class TestPyDeId(unittest.TestCase):
         # Setup a temp directory and config
         self.test_dir = "./input"  # tempfile.mkdtemp()
         os.makedirs(self.test_dir, exist_ok=True)
+        self.store = JobStore(":memory:")
+        self.store_patch = patch("py_de_id.pydeid.job_store", self.store)
+        self.store_patch.start()
         base_dir = self.test_dir
         config = {
             "*": [],
@@ -41,6 +51,7 @@ class TestPyDeId(unittest.TestCase):
         }
 
     def tearDown(self):
+        self.store_patch.stop()
         shutil.rmtree(self.test_dir)
 
     @patch("py_de_id.pydeid.cherrypy")
@@ -81,7 +92,7 @@ class TestPyDeId(unittest.TestCase):
         self.assertEqual(result["gender"], "male")
         self.assertIn("birthDate", result)
 
-    @patch("py_de_id.pydeid.requests.post")
+    @patch("py_de_id.sessions.requests.Session.post")
     @patch("py_de_id.pydeid.cherrypy")
     def test_deliver_clone(self, mock_cherrypy, mock_post):
         transaction_id = "test_tx"
@@ -99,22 +110,45 @@ class TestPyDeId(unittest.TestCase):
             ]
         }
         os.makedirs(os.path.join(self.test_dir, transaction_id), exist_ok=True)
-        with open(f"{self.test_dir}/{transaction_id}.json", "w") as f:
-            json.dump(data, f)
-        assert os.path.exists(f"{self.test_dir}/{transaction_id}.json")
+        self.store.create(transaction_id, "default", data)
         with open(f"{self.test_dir}/{transaction_id}/clone.json", "w") as f:
             json.dump(bundle, f)
         assert os.path.exists(f"{self.test_dir}/{transaction_id}/clone.json")
         # Mock response
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "entry": [{"response": {"status": 201, "location": "Patient/1"}}]
-        }
+        mock_response.content = json.dumps(
+            {"entry": [{"response": {"status": 201, "location": "Patient/1"}}]}
+        ).encode()
         mock_post.return_value = mock_response
         deliver_clone(transaction_id)
         mock_post.assert_called()
 
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_deliver_batches_concurrency(self, mock_cherrypy):
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+
+        def post(transaction_id, session, url, entries, locations=None):
+            with lock:
+                in_flight.append(entries)
+                peak.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(entries)
+            return 200, None
+
+        data = {"target_token": "token", "fhir_target": "http://localhost/fhir/", "concurrency": 3}
+        batches = [[{"resource": {"id": str(i)}}] for i in range(9)]
+        scheduler = DeliveryScheduler(rate=1000, batch_size=1, max_batch=1)
+        with patch("py_de_id.pydeid.delivery_scheduler", scheduler), patch(
+            "py_de_id.pydeid.post_batch", side_effect=post
+        ) as mock_post:
+            deliver_batches("test_tx", data, iter(batches))
+        self.assertEqual(mock_post.call_count, 9)
+        self.assertEqual(max(peak), 3)
+
     @patch("py_de_id.pydeid.deidentify_fhir_resource")
     @patch("py_de_id.pydeid.deliver_clone")
     @patch("py_de_id.pydeid.cherrypy")
@@ -136,36 +170,85 @@ class TestPyDeId(unittest.TestCase):
             json.dump(bundle, f)
         mock_deid.side_effect = lambda r: r
         clone_bundle(transaction_id, True)
-        mock_deliver.assert_called_with(transaction_id)
-        # Check clone.json created
+        # The clone is handed over in memory
+        clone = mock_deliver.call_args.args[1]
+        mock_deliver.assert_called_with(transaction_id, clone)
+        self.assertEqual(clone["type"], "transaction")
+        self.assertFalse(os.path.exists(f"{self.test_dir}/{transaction_id}/clone.json"))
+
+        # Check clone.json created when debug copies are kept
+        with patch("py_de_id.pydeid.DEBUG_COPIES", True):
+            clone_bundle(transaction_id, True, json.loads(json.dumps(bundle)))
         with open(f"{self.test_dir}/{transaction_id}/clone.json") as f:
             clone = json.load(f)
             self.assertEqual(clone["type"], "transaction")
             self.assertIn("entry", clone)
 
-    @patch("py_de_id.pydeid.requests.get")
-    @patch("py_de_id.pydeid.clone_bundle")
+    @patch("py_de_id.sessions.requests.Session.get")
+    @patch("py_de_id.pydeid.post_batch", return_value=(200, None))
     @patch("py_de_id.pydeid.cherrypy")
-    def test_process_request_success(self, mock_cherrypy, mock_clone, mock_get):
+    def test_process_request_success(self, mock_cherrypy, mock_post, mock_get):
         transaction_id = "test_tx"
         data = {
             "source_token": "token",
             "fhir_source": "http://localhost/fhir",
+            "target_token": "token",
+            "fhir_target": "http://localhost/fhir/",
             "deid": True,
         }
         os.makedirs(os.path.join(self.test_dir, transaction_id), exist_ok=True)
-        with open(f"{self.test_dir}/{transaction_id}.json", "w") as f:
-            json.dump(data, f)
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.text = '{"entry":[]}'
-        mock_get.return_value = mock_response
+        self.store.create(transaction_id, "default", data)
+        pages = [
+            {
+                "link": [{"relation": "next", "url": "http://localhost/fhir?page=2"}],
+                "entry": [
+                    {
+                        "resource": {
+                            "resourceType": "Encounter",
+                            "id": "e1",
+                            "subject": {"reference": "Patient/p1"},
+                        }
+                    }
+                ],
+            },
+            {
+                "link": [{"relation": "self", "url": "http://localhost/fhir?page=2"}],
+                "entry": [{"resource": {"resourceType": "Patient", "id": "p1"}}],
+            },
+        ]
+        responses = []
+        for page in pages:
+            mock_response = MagicMock()
+            mock_response.status_code = 200
+            mock_response.iter_content.return_value = [json.dumps(page).encode()]
+            responses.append(mock_response)
+        mock_get.side_effect = responses
         process_request(transaction_id)
-        mock_clone.assert_called_with(transaction_id, True)
-        # Check bundle.json created
-        with open(f"{self.test_dir}/{transaction_id}/bundle.json") as f:
-            bundle = json.load(f)
-            self.assertIn("entry", bundle)
+        self.assertEqual(mock_get.call_args_list[1].args[0], "http://localhost/fhir?page=2")
+        entries = [entry for call in mock_post.call_args_list for entry in call.args[3]]
+        # the Patient on page 2 is created before the Encounter on page 1 referring to it
+        patient, encounter = [entry["resource"] for entry in entries]
+        self.assertEqual(encounter["subject"]["reference"], f"Patient/{patient['id']}")
+        self.assertNotEqual(patient["id"], "p1")
+        self.assertFalse(os.path.exists(f"{self.test_dir}/{transaction_id}"))
+        self.assertEqual(self.store.delivered(transaction_id), {f"Encounter/{encounter['id']}", f"Patient/{patient['id']}"})
+
+    @patch("py_de_id.sessions.requests.Session.get")
+    @patch("py_de_id.pydeid.post_batch")
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_process_request_failure(self, mock_cherrypy, mock_post, mock_get):
+        transaction_id = "test_tx"
+        data = {
+            "source_token": "token",
+            "fhir_source": "http://localhost/fhir",
+            "target_token": "token",
+            "fhir_target": "http://localhost/fhir/",
+            "deid": True,
+        }
+        self.store.create(transaction_id, "default", data)
+        mock_get.return_value.status_code = 404
+        process_request(transaction_id)
+        mock_post.assert_not_called()
 
     # @patch("py_de_id.pydeid.requests.get", side_effect=Exception("fail"))
     # @patch("py_de_id.pydeid.cherrypy")
@@ -203,11 +286,13 @@ class TestPyDeId(unittest.TestCase):
         mock_cherrypy.request.json = {"transaction_id": "tx", "deid": True}
         mock_cherrypy.log = MagicMock()
         mock_cherrypy.response.status = None
-        mock_thread = MagicMock()
-        with patch("py_de_id.pydeid.threading.Thread", return_value=mock_thread):
+        with patch("py_de_id.pydeid.job_scheduler") as mock_scheduler:
             result = deidentifier.deidentify()
             self.assertIn("message", json.loads(result))
-            mock_thread.start.assert_called()
+            transaction = json.loads(result)["transaction"]
+            mock_scheduler.submit.assert_called_with(
+                transaction, "default", mock_process, transaction
+            )
 
         # Test missing transaction_id
         mock_cherrypy.request.json = {}
@@ -215,12 +300,32 @@ class TestPyDeId(unittest.TestCase):
         result = deidentifier.deidentify()
         self.assertIn("missing transaction_id", result)
 
+        # Test full queue
+        with patch("py_de_id.pydeid.job_scheduler") as mock_scheduler:
+            mock_scheduler.submit.side_effect = JobQueueFull("full", tenant=True)
+            mock_cherrypy.request.json = {"transaction_id": "tx", "deid": True}
+            result = deidentifier.deidentify()
+            self.assertEqual(mock_cherrypy.response.status, 429)
+            self.assertEqual(json.loads(result)["message"], "full")
+
         # Test exception branch
-        with patch("py_de_id.pydeid.threading.Thread", side_effect=Exception("fail")):
+        with patch("py_de_id.pydeid.job_scheduler") as mock_scheduler:
+            mock_scheduler.submit.side_effect = Exception("fail")
             mock_cherrypy.request.json = {"transaction_id": "tx", "deid": True}
             result = deidentifier.deidentify()
             self.assertIn("message", json.loads(result))
 
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_jobs(self, mock_cherrypy):
+        deidentifier = Deidentifier()
+        mock_cherrypy.HTTPError = cherrypy.HTTPError
+        with patch("py_de_id.pydeid.job_scheduler") as mock_scheduler:
+            mock_scheduler.status.return_value = {"status": "queued"}
+            self.assertEqual(deidentifier.jobs("tx"), {"status": "queued"})
+            mock_scheduler.status.return_value = None
+            with self.assertRaises(cherrypy.HTTPError):
+                deidentifier.jobs("tx")
+
 
 if __name__ == "__main__":
     unittest.main()
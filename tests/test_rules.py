@@ -0,0 +1,262 @@
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import RulePlan
+from py_de_id.paths import parse_path
+from py_de_id.rules import HashRandom, randomize, randomize_many
+
+
+class TestRulePlan(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            "*": [{"field": "meta", "action": "erase"}],
+            "Patient": [
+                {"field": "telecom", "action": "erase"},
+                {"field": "gender", "action": "replace", "params": "unknown"},
+                {
+                    "field": "birthDate",
+                    "action": "randomize",
+                    "params": {"min": 0, "max": 0},
+                },
+                {
+                    "field": "address",
+                    "action": "merge",
+                    "params": [
+                        '[{k: v for k,v in addr.items() if k != "extension"} for addr in %input%]',
+                        '[{k: v if k != "postalCode" else v[:2]+"000" for k,v in addr.items()} for addr in %input%]',
+                    ],
+                },
+            ],
+        }
+
+    def test_apply(self):
+        plan = RulePlan(self.config)
+        resource = {
+            "resourceType": "Patient",
+            "meta": {},
+            "telecom": [{"value": "555"}],
+            "gender": "male",
+            "birthDate": "2020-01-01",
+            "address": [{"postalCode": "12345", "extension": [], "city": "X"}],
+        }
+        result = plan.apply(resource)
+        self.assertNotIn("meta", result)
+        self.assertNotIn("telecom", result)
+        self.assertEqual(result["gender"], "unknown")
+        self.assertEqual(result["birthDate"], "2020-01-01")
+        self.assertEqual(result["address"], [{"postalCode": "12000", "city": "X"}])
+
+    def test_unconfigured_resource_type(self):
+        plan = RulePlan(self.config)
+        resource = {"resourceType": "Observation", "meta": {}, "status": "final"}
+        self.assertEqual(plan.apply(resource), {"resourceType": "Observation", "status": "final"})
+
+    @patch("py_de_id.rules.cherrypy")
+    def test_bad_rules_are_skipped(self, mock_cherrypy):
+        plan = RulePlan(
+            {
+                "Patient": [
+                    {"field": "gender", "action": "scramble"},
+                    {"field": "name", "action": "merge", "params": ["[x for", "%input%[:1]"]},
+                ]
+            }
+        )
+        resource = {"resourceType": "Patient", "gender": "male", "name": [1, 2]}
+        result = plan.apply(resource)
+        self.assertEqual(result, {"resourceType": "Patient", "gender": "male", "name": [1]})
+        self.assertEqual(mock_cherrypy.log.call_count, 2)
+
+
+class TestRandomizeMany(unittest.TestCase):
+    def setUp(self):
+        self.plan = RulePlan(
+            {
+                "*": [{"field": "meta", "action": "erase"}],
+                "Observation": [
+                    {"field": "status", "action": "replace", "params": "final"},
+                    {"field": "issuedDate", "action": "randomize", "params": {"min": 10, "max": 20}},
+                    {"field": "value", "action": "randomize", "params": {"min": 5, "max": 5}},
+                    {"field": "code", "action": "randomize", "params": {"length": 4}},
+                ],
+            }
+        )
+
+    def resources(self):
+        return [
+            {
+                "resourceType": "Observation",
+                "meta": {},
+                "status": "preliminary",
+                "issuedDate": f"2020-01-{n % 28 + 1:02d}",
+                "value": n * 1.5 if n % 2 else n,
+                "code": "abc",
+            }
+            for n in range(50)
+        ] + [{"resourceType": "Patient", "meta": {}}]
+
+    def test_same_as_apply(self):
+        seeds = [f"seed-{n}" for n in range(51)]
+        expected = [self.plan.apply(resource, seed) for resource, seed in zip(self.resources(), seeds)]
+        self.assertEqual(self.plan.apply_many(self.resources(), seeds), expected)
+
+    def test_unseeded(self):
+        dates = randomize_many("issuedDate", ["2020-01-10"] * 300, {"min": 1, "max": 1})
+        self.assertEqual(set(dates), {"2020-01-09", "2020-01-10", "2020-01-11"})
+        values = randomize_many("value", [10.0, 10] * 100, {"min": 2, "max": 3})
+        self.assertTrue(all(7 <= value <= 13 for value in values[0::2]))
+        self.assertEqual(set(values[1::2]), set(range(8, 14)))
+
+    def test_hash_random(self):
+        draws = [HashRandom("seed").random() for _ in range(2)]
+        self.assertEqual(draws[0], draws[1])
+        rng = HashRandom("seed")
+        many = [rng.random() for _ in range(20)]
+        self.assertEqual(many[0], draws[0])
+        self.assertEqual(len(set(many)), 20)
+        self.assertTrue(all(0 <= draw < 1 for draw in many))
+        self.assertEqual(len(randomize("code", "abc", {"length": 40}, HashRandom("s"))), 40)
+
+
+class Visited(list):
+    """A list counting the reads of its items"""
+
+    reads = 0
+
+    def __getitem__(self, index):
+        Visited.reads += 1
+        return super().__getitem__(index)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+class TestPathRules(unittest.TestCase):
+    def setUp(self):
+        merged = [
+            {
+                "field": "extension",
+                "action": "merge",
+                "params": [
+                    '[x for x in %input% if "mother" not in x["url"]]',
+                    '[x for x in %input% if "birthPlace" not in x["url"]]',
+                ],
+            },
+            {
+                "field": "address",
+                "action": "merge",
+                "params": [
+                    '[{k: v for k,v in addr.items() if k != "extension"} for addr in %input%]',
+                    '[{k: v if k != "line" else ["1 Street"] for k,v in addr.items()} for addr in %input%]',
+                    '[{k: v if k != "postalCode" else v[:2]+"000" for k,v in addr.items()} for addr in %input%]',
+                ],
+            },
+        ]
+        paths = [
+            {"field": "extension[url~mother]", "action": "erase"},
+            {"field": "address[*].extension", "action": "erase"},
+            {"field": "extension[url~birthPlace]", "action": "erase"},
+            {"field": "address[*].line", "action": "replace", "params": ["1 Street"]},
+            {"field": "address[*].postalCode", "action": "truncate", "params": {"length": 2, "fill": "000"}},
+        ]
+        self.merged = RulePlan({"Patient": merged})
+        self.paths = RulePlan({"Patient": paths})
+
+    def patient(self):
+        address = {"line": ["2 Road"], "postalCode": "01101", "extension": [{"url": "geo"}]}
+        return {
+            "resourceType": "Patient",
+            "address": Visited([dict(address), dict(address, line=None), {"city": "X"}]),
+            "extension": [
+                {"url": "patient-mothersMaidenName"},
+                {"url": "patient-birthPlace"},
+                {"url": "us-core-race"},
+            ],
+        }
+
+    def test_same_as_merge(self):
+        self.assertEqual(self.paths.apply(self.patient()), self.merged.apply(self.patient()))
+        # one action per top-level field
+        self.assertEqual(
+            [key for _, _, key in self.paths.actions["Patient"]],
+            [("Patient", "extension", "paths"), ("Patient", "address", "paths")],
+        )
+
+    def test_truncate(self):
+        resource = self.patient()
+        resource["address"] = [{"postalCode": "12345-6789"}, {"postalCode": "1"}, {"postalCode": 12345}]
+        merged = self.patient()
+        merged["address"] = [dict(address) for address in resource["address"][:2]]
+        self.assertEqual(
+            [address["postalCode"] for address in self.paths.apply(resource)["address"]],
+            ["12000", "1000", 12345],
+        )
+        self.assertEqual(
+            [address["postalCode"] for address in self.merged.apply(merged)["address"]],
+            ["12000", "1000"],
+        )
+        plain = RulePlan({"Patient": [{"field": "gender", "action": "truncate", "params": 1}]})
+        self.assertEqual(plain.apply({"resourceType": "Patient", "gender": "female"})["gender"], "f")
+
+    def test_replaced_values_are_not_shared(self):
+        resources = [self.paths.apply(self.patient()) for _ in range(2)]
+        resources[0]["address"][0]["line"].append("changed")
+        self.assertEqual(resources[1]["address"][0]["line"], ["1 Street"])
+        self.assertEqual(resources[0]["address"][1]["line"], ["1 Street"])
+        self.assertEqual(self.paths.config["Patient"][3]["params"], ["1 Street"])
+
+    def test_in_place_and_once(self):
+        resource = self.patient()
+        addresses = resource["address"]
+        Visited.reads = 0
+        self.paths.apply(resource)
+        self.assertIs(resource["address"], addresses)
+        # each address is visited once, by the three rules together
+        self.assertEqual(Visited.reads, 3)
+
+    def test_selectors(self):
+        plan = RulePlan(
+            {
+                "Patient": [
+                    {"field": "extension[url=a.b]", "action": "erase"},
+                    {"field": "contact[*].name.family", "action": "replace", "params": "Doe"},
+                    {"field": "contact[*].telecom[*]", "action": "replace", "params": {}},
+                    {"field": "contact[*].birthDate", "action": "randomize", "params": {"min": 0, "max": 0}},
+                ]
+            }
+        )
+        resource = {
+            "resourceType": "Patient",
+            "extension": [{"url": "a.b"}, {"url": "a.b"}],
+            "contact": [
+                {"name": {"family": "Roe"}, "telecom": [1, 2], "birthDate": "2000-01-01"},
+                {"name": "not a dict", "telecom": "not a list"},
+            ],
+        }
+        self.assertEqual(
+            plan.apply(resource, "seed"),
+            {
+                "resourceType": "Patient",
+                "contact": [
+                    {"name": {"family": "Doe"}, "telecom": [{}, {}], "birthDate": "2000-01-01"},
+                    {"name": "not a dict", "telecom": "not a list"},
+                ],
+            },
+        )
+
+    def test_parse_path(self):
+        self.assertEqual(
+            parse_path("extension[url~http://a.org/x].valueCode"),
+            [("extension", ("url", "~", "http://a.org/x")), ("valueCode", None)],
+        )
+        for path in ("a..b", "a[b]", "a[*", "1a.b"):
+            with self.assertRaises(ValueError):
+                parse_path(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
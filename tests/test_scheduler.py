@@ -0,0 +1,112 @@
+import unittest
+import os
+import sys
+import json
+import time
+from unittest.mock import patch, MagicMock
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import deliver_batches, post_batch
+from py_de_id.scheduler import DeliveryScheduler, TargetLimiter, retry_after
+
+
+class TestRetryAfter(unittest.TestCase):
+    def test_sources(self):
+        self.assertEqual(retry_after({"Retry-After": "3"}), 3.0)
+        self.assertEqual(retry_after({}, json.dumps({"_msBeforeNext": 250})), 0.25)
+        self.assertEqual(retry_after({}, "not json"), 1.0)
+        self.assertEqual(retry_after({"Retry-After": "Thu, 01 Jan 1970 00:00:00 GMT"}), 0.0)
+
+
+class TestTargetLimiter(unittest.TestCase):
+    def test_aimd(self):
+        limiter = TargetLimiter(rate=10, batch_size=10, target_latency=1.0)
+        limiter.succeeded(0.1)
+        self.assertEqual((limiter.batch_size, limiter.rate), (11, 11))
+        limiter.succeeded(5.0)
+        self.assertEqual(limiter.batch_size, 8)
+        limiter.throttled(0)
+        self.assertEqual((limiter.batch_size, limiter.rate), (4, 5.5))
+        self.assertEqual(limiter.stats()["throttled"], 1)
+
+    def test_throttle_blocks(self):
+        limiter = TargetLimiter(rate=1000)
+        limiter.throttled(0.2)
+        start = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_reserve_does_not_wait(self):
+        limiter = TargetLimiter(rate=10)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertAlmostEqual(limiter.reserve(), 0.1, delta=0.01)
+        limiter.throttled(5)
+        self.assertAlmostEqual(limiter.reserve(), 5, delta=0.01)
+
+
+@patch("py_de_id.pydeid.cherrypy")
+class TestDelivery(unittest.TestCase):
+    def setUp(self):
+        self.data = {"target_token": "token", "fhir_target": "http://localhost/fhir/"}
+        self.batches = [[{"resource": {"id": str(i)}} for i in range(4)]]
+
+    def response(self, status, body=None, headers=None):
+        result = MagicMock()
+        result.status_code = status
+        result.headers = headers or {}
+        result.content = json.dumps(body).encode() if body is not None else b""
+        return result
+
+    def test_post_batch_throttled_entry(self, mock_cherrypy):
+        session = MagicMock()
+        diagnostics = json.dumps({"_msBeforeNext": 1500})
+        session.post.return_value = self.response(
+            200, {"entry": [{"response": {"status": "429", "issue": [{"diagnostics": diagnostics}]}}]}
+        )
+        self.assertEqual(post_batch("tx", session, "http://x", []), (429, 1.5))
+        session.post.return_value = self.response(429, headers={"Retry-After": "2"})
+        self.assertEqual(post_batch("tx", session, "http://x", []), (429, 2.0))
+
+    def test_retried_once_without_duplicates(self, mock_cherrypy):
+        scheduler = DeliveryScheduler(rate=1000)
+        with patch("py_de_id.pydeid.delivery_scheduler", scheduler), patch(
+            "py_de_id.pydeid.post_batch", side_effect=[(429, 0.01), (200, None)]
+        ) as mock_post:
+            deliver_batches("tx", self.data, self.batches)
+        first, second = [call.args[3] for call in mock_post.call_args_list]
+        self.assertEqual(first, second)
+        self.assertEqual(len(second), 4)
+        stats = scheduler.stats()["http://localhost/fhir"]
+        self.assertEqual(stats["throttled"], 1)
+
+    def test_throttles_are_not_failures(self, mock_cherrypy):
+        scheduler = DeliveryScheduler(rate=1000)
+        with patch("py_de_id.pydeid.delivery_scheduler", scheduler), patch(
+            "py_de_id.pydeid.post_batch", side_effect=[(429, 0.01), (429, 0.01), (500, None), (200, None)]
+        ) as mock_post:
+            deliver_batches("tx", self.data, self.batches)
+        self.assertEqual(mock_post.call_count, 4)
+        self.assertEqual(scheduler.stats()["http://localhost/fhir"]["throttled"], 2)
+
+        with patch("py_de_id.pydeid.delivery_scheduler", scheduler), patch(
+            "py_de_id.pydeid.post_batch", return_value=(429, 0)
+        ) as mock_post, patch("py_de_id.pydeid.MAX_THROTTLED", 3):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                deliver_batches("tx", self.data, self.batches)
+        self.assertEqual(mock_post.call_count, 3)
+
+    def test_fails_after_one_retry(self, mock_cherrypy):
+        scheduler = DeliveryScheduler(rate=1000)
+        with patch("py_de_id.pydeid.delivery_scheduler", scheduler), patch(
+            "py_de_id.pydeid.post_batch", return_value=(500, None)
+        ) as mock_post:
+            with self.assertRaises(requests.exceptions.HTTPError):
+                deliver_batches("tx", self.data, self.batches)
+        self.assertEqual(mock_post.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
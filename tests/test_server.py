@@ -0,0 +1,234 @@
+import unittest
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import server
+from py_de_id.lazy import Lazy
+from py_de_id.store import JobStore
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """A FHIR server whose $everything answers once the test releases it"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body):
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.server.fetching.set()
+        self.server.release.wait(20)
+        self.send_json({"resourceType": "Bundle", "entry": [{"resource": {"resourceType": "Patient", "id": "p"}}]})
+
+    def do_POST(self):
+        bundle = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.send_json(
+            {
+                "resourceType": "Bundle",
+                "entry": [
+                    {"response": {"status": "201 Created", "location": entry["request"]["url"]}}
+                    for entry in bundle["entry"]
+                ],
+            }
+        )
+
+
+class TestLazy(unittest.TestCase):
+    def test_built_once_on_first_use(self):
+        built = []
+        lazy = Lazy(lambda: built.append(1) or {"a": 1})
+        self.assertFalse(lazy.resolved())
+        self.assertEqual(built, [])
+        self.assertEqual(lazy.get("a"), 1)
+        self.assertEqual(list(lazy.keys()), ["a"])
+        self.assertEqual(built, [1])
+        self.assertTrue(lazy.resolved())
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = dict(
+            os.environ,
+            PYTHONPATH=PROJECT_DIR,
+            PYDEID_INPUT_DIR=os.path.join(self.dir, "input"),
+            PYDEID_SHUTDOWN_GRACE="2",
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_import_has_no_side_effects(self):
+        result = subprocess.run(
+            [sys.executable, "-c", "import py_de_id, py_de_id.pydeid"],
+            cwd=self.dir,
+            env=self.env,
+            capture_output=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout + result.stderr, b"")
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def get(self, url):
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return response.status
+
+    def start(self, workers):
+        """Start the pre-fork server, returning it and its url once it answers"""
+        port = free_port()
+        supervisor = subprocess.Popen(
+            [
+                sys.executable, "-m", "py_de_id.server",
+                "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port),
+            ],
+            cwd=PROJECT_DIR,
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        url = f"http://127.0.0.1:{port}/"
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                self.assertEqual(self.get(url + "health"), 204)
+                return supervisor, url
+            except OSError:
+                if time.monotonic() > deadline:
+                    supervisor.kill()
+                    raise
+                time.sleep(0.1)
+
+    def workers(self, supervisor):
+        return subprocess.run(
+            ["pgrep", "-P", str(supervisor.pid)], capture_output=True, text=True
+        ).stdout.split()
+
+    def test_workers_share_the_socket(self):
+        supervisor, base = self.start(2)
+        try:
+            url = base + "health"
+            workers = self.workers(supervisor)
+            self.assertEqual(len(workers), 2)
+
+            # a worker that dies is replaced, and the others go on serving
+            os.kill(int(workers[0]), signal.SIGKILL)
+            self.assertEqual(self.get(url), 204)
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                replaced = self.workers(supervisor)
+                if len(replaced) == 2 and workers[0] not in replaced:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(len(replaced), 2)
+            self.assertNotIn(workers[0], replaced)
+        finally:
+            supervisor.send_signal(signal.SIGTERM)
+            self.assertEqual(supervisor.wait(20), 0)
+
+    def test_unfinished_jobs_are_adopted_before_the_fork(self):
+        os.makedirs(self.env["PYDEID_INPUT_DIR"])
+        path = os.path.join(self.env["PYDEID_INPUT_DIR"], "jobs.db")
+        store = JobStore(path, owner="3")
+        store.create("old", "default", {})
+        store.create("done", "default", {})
+        store.update("done", "done")
+        store.close()
+
+        with patch("py_de_id.pydeid.base_dir", self.env["PYDEID_INPUT_DIR"]), patch(
+            "py_de_id.server.listen"
+        ), patch("py_de_id.server.cherrypy"), patch("py_de_id.server.Supervisor") as mock_supervisor:
+            server.main(["--workers", "2"])
+        store = JobStore(path)
+        self.assertEqual(store.claim("0"), [("old", "default")])
+        self.assertEqual(store.claim("3"), [])
+
+        # only worker 0 resumes on its first start; any worker does once restarted
+        target = mock_supervisor.call_args.args[2]
+        with patch("py_de_id.pydeid.main") as mock_main:
+            target(0, True)
+            target(1, True)
+            target(1, False)
+        self.assertEqual(
+            [(call.kwargs["worker"], call.kwargs["resume"]) for call in mock_main.call_args_list],
+            [(0, True), (1, False), (1, True)],
+        )
+
+    def test_restarted_worker_resumes_its_jobs(self):
+        fhir = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        fhir.daemon_threads = True
+        fhir.fetching = threading.Event()
+        fhir.release = threading.Event()
+        threading.Thread(target=fhir.serve_forever, daemon=True).start()
+        fhir_url = f"http://127.0.0.1:{fhir.server_address[1]}/fhir/"
+        supervisor, url = self.start(1)
+        try:
+            request = urllib.request.Request(
+                url + "deidentify",
+                data=json.dumps(
+                    {
+                        "transaction_id": "t",
+                        "fhir_source": fhir_url + "Patient/p/$everything",
+                        "source_token": "token",
+                        "fhir_target": fhir_url,
+                        "target_token": "token",
+                        "deid": True,
+                    }
+                ).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+            with urllib.request.urlopen(request, timeout=5) as response:
+                transaction = json.loads(json.loads(response.read()))["transaction"]
+            self.assertTrue(fhir.fetching.wait(10))
+
+            # the worker dies while fetching; the one started in its place takes the job over
+            (worker,) = self.workers(supervisor)
+            os.kill(int(worker), signal.SIGKILL)
+            fhir.release.set()
+            deadline = time.monotonic() + 20
+            while True:
+                try:
+                    with urllib.request.urlopen(url + "jobs/" + transaction, timeout=2) as response:
+                        status = json.loads(response.read())["status"]
+                except OSError:
+                    status = None
+                if status == "done" or time.monotonic() > deadline:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(status, "done")
+        finally:
+            supervisor.send_signal(signal.SIGTERM)
+            self.assertEqual(supervisor.wait(20), 0)
+            fhir.shutdown()
+            fhir.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
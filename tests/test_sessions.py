@@ -0,0 +1,41 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.sessions import SessionPool, base_url
+
+
+class TestSessionPool(unittest.TestCase):
+    def test_base_url(self):
+        self.assertEqual(
+            base_url("https://fhir.example.org:8443/fhir/R4/Patient/1/$everything"),
+            "https://fhir.example.org:8443",
+        )
+
+    def test_shared_per_target_and_token(self):
+        pool = SessionPool()
+        with pool.session("http://a/fhir/Patient", "t1") as first:
+            with pool.session("http://a/fhir/", "t1") as second:
+                self.assertIs(first, second)
+            with pool.session("http://a/fhir/", "t2") as other:
+                self.assertIsNot(first, other)
+                self.assertEqual(other.headers["Authorization"], "Bearer t2")
+        pool.close()
+
+    def test_idle_sessions_are_evicted(self):
+        pool = SessionPool(max_idle=1)
+        with pool.session("http://a/fhir", "t1") as busy:
+            for token in ["t2", "t3", "t4"]:
+                with pool.session("http://a/fhir", token):
+                    pass
+            # the session in use is kept, plus one idle session
+            self.assertEqual(len(pool._sessions), 2)
+        with pool.session("http://a/fhir", "t1") as again:
+            self.assertIs(busy, again)
+        pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
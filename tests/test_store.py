@@ -0,0 +1,180 @@
+import unittest
+import json
+import os
+import sys
+import shutil
+import tempfile
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import process_request
+from py_de_id.pydeid import clone_batches
+from py_de_id.scheduler import DeliveryScheduler
+from py_de_id.store import JobStore
+
+
+def entry(resource_type, id):
+    return {"resource": {"resourceType": resource_type, "id": id}}
+
+
+class TestJobStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "jobs.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_survives_reopening(self):
+        store = JobStore(self.path)
+        store.create("a", "t", {"target_token": "secret"})
+        store.add_batch("a", [entry("Patient", "1"), entry("Patient", "2")])
+        store.add_batch("a", [entry("Patient", "3")])
+        store.cloned("a")
+        store.acknowledge("a", [entry("Patient", "1")])
+        store.update("a", "delivering")
+        namespace = store.job("a")["namespace"]
+        store.close()
+
+        store = JobStore(self.path)
+        job = store.job("a")
+        self.assertEqual(job["data"], {"target_token": "secret"})
+        self.assertEqual(job["namespace"], namespace)
+        self.assertTrue(job["cloned"])
+        self.assertEqual(store.unfinished(), [("a", "t")])
+        self.assertEqual(
+            list(store.batches("a")), [[entry("Patient", "2")], [entry("Patient", "3")]]
+        )
+
+    def test_finished_jobs_are_purged(self):
+        store = JobStore(self.path, history=1)
+        for job_id in ["a", "b"]:
+            store.create(job_id, "t", {"target_token": "secret"})
+            store.add_batch(job_id, [entry("Patient", "1")])
+        store.update("a", "failed", error="boom")
+        self.assertEqual(
+            store.status("a"),
+            {"transaction": "a", "tenant": "t", "status": "failed", "error": "boom"},
+        )
+        self.assertIsNone(store.job("a")["data"])
+        self.assertEqual(list(store.batches("a")), [])
+        store.update("b", "done")
+        self.assertIsNone(store.job("a"))
+        self.assertEqual(store.unfinished(), [])
+
+    def test_claim(self):
+        workers = [JobStore(self.path, owner=str(n)) for n in range(2)]
+        workers[0].create("a", "t", {})
+        workers[1].create("b", "t", {})
+        workers[1].create("c", "t", {})
+        workers[1].update("c", "done")
+        # worker 1 is replaced, and the new one takes over its jobs
+        replaced = JobStore(self.path, owner="1")
+        self.assertEqual(replaced.claim("1"), [("b", "t")])
+        # all of them, when the service starts
+        self.assertEqual(workers[0].claim(), [("a", "t"), ("b", "t")])
+        self.assertEqual(replaced.claim("1"), [])
+
+    def test_restart(self):
+        store = JobStore(":memory:")
+        store.create("a", "t", {})
+        store.add_batch("a", [entry("Patient", "1")])
+        store.cloned("a")
+        store.restart("a")
+        self.assertFalse(store.job("a")["cloned"])
+        self.assertEqual(list(store.batches("a")), [])
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "./input"
+        os.makedirs(self.test_dir, exist_ok=True)
+        self.store = JobStore(":memory:")
+        self.store.create(
+            "tx",
+            "default",
+            {
+                "source_token": "token",
+                "fhir_source": "http://localhost/fhir",
+                "target_token": "token",
+                "fhir_target": "http://localhost/fhir/",
+                "deid": False,
+            },
+        )
+        self.patches = [
+            patch("py_de_id.pydeid.job_store", self.store),
+            patch("py_de_id.pydeid.cherrypy"),
+            patch(
+                "py_de_id.pydeid.delivery_scheduler",
+                DeliveryScheduler(rate=1000, batch_size=2, max_batch=2),
+            ),
+            patch("py_de_id.sessions.requests.Session.get", side_effect=self.get),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        shutil.rmtree(self.test_dir)
+
+    def get(self, url, **kwargs):
+        response = MagicMock()
+        response.status_code = 200
+        page = {"entry": self.page()}
+        response.iter_content.return_value = [json.dumps(page).encode()]
+        return response
+
+    def page(self):
+        return [
+            {"resource": {"resourceType": "Observation", "id": str(i), "subject": {"reference": "Patient/p"}}}
+            for i in range(5)
+        ] + [entry("Patient", "p")]
+
+    def test_resume_after_crash(self):
+        posted = []
+
+        def crash(transaction_id, session, url, entries, locations=None):
+            if posted:
+                raise RuntimeError("crash")
+            posted.append(entries)
+            return 200, None
+
+        with patch("py_de_id.pydeid.post_batch", side_effect=crash):
+            with self.assertRaises(RuntimeError):
+                process_request("tx")
+        # the Patient the Observations refer to was posted first, on its own
+        self.assertEqual(len(self.store.delivered("tx")), 1)
+
+        with patch("py_de_id.pydeid.post_batch", return_value=(200, None)) as mock_post:
+            process_request("tx")
+        resent = [entry for call in mock_post.call_args_list for entry in call.args[3]]
+        self.assertEqual(len(resent), 5)
+        ids = {entry["resource"]["id"] for entry in posted[0] + resent}
+        self.assertEqual(len(ids), 6)
+        # a small clone is kept in memory only
+        self.assertFalse(self.store.job("tx")["cloned"])
+
+    def test_cloned_again_with_the_same_ids(self):
+        job = self.store.job("tx")
+        clones = [
+            list(clone_batches("tx", job["data"], [self.page()], namespace=job["namespace"]))
+            for _ in range(2)
+        ]
+        self.assertEqual(clones[0], clones[1])
+
+    @patch("py_de_id.pydeid.SPILL_BYTES", 100)
+    def test_resume_delivery(self):
+        with patch("py_de_id.pydeid.post_batch", return_value=(200, None)):
+            process_request("tx")
+        self.store.add_batch("tx", [entry("Patient", "late")])
+
+        with patch("py_de_id.pydeid.post_batch", return_value=(200, None)) as mock_post:
+            process_request("tx")
+        self.assertEqual(mock_post.call_args.args[3], [entry("Patient", "late")])
+        self.assertEqual(mock_post.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import unittest
+import io
+import os
+import sys
+import json
+import shutil
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id import stream_clone
+from py_de_id.pydeid import read_page, request_body, stream_deidentify
+from py_de_id.placeholders import PlaceholderCache
+from py_de_id.scheduler import DeliveryScheduler
+from py_de_id.store import JobStore
+from py_de_id.stream import BundleReader, read_chunks, read_ndjson
+
+
+def chunked(data, size):
+    return (data[i : i + size] for i in range(0, len(data), size))
+
+
+class TestBundleReader(unittest.TestCase):
+    def setUp(self):
+        self.bundle = {
+            "resourceType": "Bundle",
+            "link": [{"relation": "next", "url": "http://localhost/fhir?page=2"}],
+            "entry": [
+                {"resource": {"resourceType": "Observation", "id": str(i), "valueQuantity": {"value": 1.25}, "note": "é\"\\" * i}}
+                for i in range(20)
+            ],
+            "total": 12345,
+        }
+
+    def test_any_chunking(self):
+        data = json.dumps(self.bundle, ensure_ascii=False, indent=1).encode("utf-8")
+        for size in [1, 2, 5, 64, len(data)]:
+            reader = BundleReader(chunked(data, size))
+            self.assertEqual(list(reader), self.bundle["entry"])
+            self.assertEqual(reader.fields["link"], self.bundle["link"])
+            self.assertEqual(reader.fields["total"], 12345)
+
+    def test_spool_file(self):
+        data = io.BytesIO(json.dumps(self.bundle).encode("utf-8"))
+        self.assertEqual(len(list(BundleReader(read_chunks(data, 7)))), 20)
+
+    def test_empty(self):
+        self.assertEqual(list(BundleReader([b"{}"])), [])
+        self.assertEqual(list(BundleReader([b'{"entry": []}'])), [])
+
+    def test_truncated(self):
+        data = json.dumps(self.bundle).encode("utf-8")[:-40]
+        with self.assertRaises(ValueError):
+            list(BundleReader(chunked(data, 64)))
+
+
+class TestReadPage(unittest.TestCase):
+    def setUp(self):
+        self.page = {
+            "resourceType": "Bundle",
+            "entry": [{"resource": {"resourceType": "Observation", "id": str(i)}} for i in range(50)],
+            "link": [{"relation": "next", "url": "http://localhost/fhir?page=2"}],
+        }
+        self.data = json.dumps(self.page).encode("utf-8")
+
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_in_memory(self, mock_cherrypy):
+        entries, url = read_page("tx", chunked(self.data, 100), 1)
+        self.assertEqual(entries, self.page["entry"])
+        self.assertEqual(url, "http://localhost/fhir?page=2")
+
+    @patch("py_de_id.pydeid.SPILL_BYTES", 500)
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_spooled(self, mock_cherrypy):
+        entries, url = read_page("tx", chunked(self.data, 100), 1)
+        self.assertIsInstance(entries, BundleReader)
+        self.assertEqual(url, "http://localhost/fhir?page=2")
+        self.assertEqual(list(entries), self.page["entry"])
+
+
+class TestStreamClone(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "./input"
+        os.makedirs(os.path.join(self.test_dir, "stream_tx"), exist_ok=True)
+        self.store = JobStore(":memory:")
+        self.store.create("stream_tx", "default", {})
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    @patch("py_de_id.pydeid.placeholder_cache", PlaceholderCache())
+    @patch("py_de_id.pydeid.delivery_scheduler", DeliveryScheduler(batch_size=2, max_batch=2))
+    @patch("py_de_id.pydeid.post_batch", return_value=(200, None))
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_stream_clone(self, mock_cherrypy, mock_post):
+        bundle = {
+            "link": [],
+            "entry": [
+                {
+                    "fullUrl": "url",
+                    "resource": {
+                        "resourceType": "Encounter",
+                        "id": "e1",
+                        "subject": {"reference": "Patient/p1"},
+                        "participant": [{"individual": {"reference": "Practitioner/x"}}],
+                    },
+                },
+                {"resource": {"resourceType": "Patient", "id": "p1", "meta": {}}},
+                {"search": {}},
+            ],
+        }
+        data = {"target_token": "token", "fhir_target": "http://localhost/fhir/", "deid": True}
+        with patch("py_de_id.pydeid.job_store", self.store):
+            stream_clone("stream_tx", data, chunked(json.dumps(bundle).encode(), 16), batch_size=2)
+
+        batches = [call.args[3] for call in mock_post.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        # the encounter waits for the practitioner, which is never in the bundle
+        patient, practitioner, encounter = [entry["resource"] for batch in batches for entry in batch]
+        self.assertEqual(encounter["subject"]["reference"], f"Patient/{patient['id']}")
+        self.assertNotEqual(patient["id"], "p1")
+        self.assertEqual(
+            encounter["participant"][0]["individual"]["reference"],
+            f"Practitioner/{practitioner['id']}",
+        )
+        self.assertEqual(practitioner["name"], "unknown-practitioner")
+        self.assertFalse(os.path.exists(f"{self.test_dir}/stream_tx"))
+        self.assertEqual(list(self.store.batches("stream_tx")), [])
+
+
+class TestStreamDeidentify(unittest.TestCase):
+    def setUp(self):
+        self.resources = [
+            {"resourceType": "Patient", "id": "p1", "name": [{"family": "Doe"}]},
+            {
+                "resourceType": "Observation",
+                "id": "o1",
+                "subject": {"reference": "Patient/p1"},
+                "performer": [{"reference": "Organization/x"}],
+            },
+        ]
+
+    def test_read_ndjson(self):
+        data = b"".join(json.dumps(resource).encode() + b"\n\n" for resource in self.resources)
+        for size in [1, 7, len(data)]:
+            self.assertEqual(list(read_ndjson(chunked(data, size))), self.resources)
+
+    @patch("py_de_id.pydeid.base_dir", "./no-input")
+    @patch("py_de_id.pydeid.placeholder_cache", PlaceholderCache())
+    @patch("py_de_id.pydeid.cherrypy")
+    def test_bundle_and_ndjson(self, mock_cherrypy):
+        bundle = json.dumps({"resourceType": "Bundle", "entry": [{"resource": r} for r in self.resources]})
+        ndjson = "\n".join(json.dumps(r) for r in self.resources)
+        for body, is_ndjson in [(bundle, False), (ndjson, True)]:
+            lines = b"".join(
+                stream_deidentify(chunked(body.encode(), 10), is_ndjson, target="http://t/fhir/")
+            ).splitlines()
+            # the observation waits for the organization, which is not in the input
+            patient, organization, observation = [json.loads(line) for line in lines]
+            self.assertEqual(patient["name"], [{"family": "FamilyName", "given": ["Person"]}])
+            self.assertEqual(observation["subject"]["reference"], f"Patient/{patient['id']}")
+            self.assertEqual(observation["performer"][0]["reference"], f"Organization/{organization['id']}")
+            self.assertEqual(organization["name"], "unknown-organization")
+        self.assertFalse(os.path.exists("./no-input"))
+
+    def test_request_body(self):
+        class KnownLengthRFile(object):
+            def __init__(self, data):
+                self.rfile = io.BytesIO(data + b"GET / HTTP/1.1")
+                self.remaining = len(data)
+
+        rfile = KnownLengthRFile(b"x" * 10)
+        chunks = request_body(rfile, 4)
+        self.assertEqual(next(chunks), b"xxxx")
+        # the server would drain what it thinks is left when it answers
+        self.assertEqual(rfile.remaining, 0)
+        self.assertEqual(b"".join(chunks), b"xxxxxx")
+        self.assertEqual(list(request_body(io.BytesIO(b"abc"), 2)), [b"ab", b"c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import logging
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_de_id.jobs import JobScheduler
+from py_de_id.logs import debug, redacted
+from py_de_id.tracing import Tracer
+
+
+class TestTracer(unittest.TestCase):
+    def test_not_sampled(self):
+        tracer = Tracer(0)
+        self.assertFalse(tracer.begin("job"))
+        tracer.span("job", "fetch", 0.1)
+        tracer.end("job", "done")
+        self.assertIsNone(tracer.trace("job"))
+        self.assertEqual(tracer.traces(), [])
+
+    def test_spans(self):
+        tracer = Tracer(1, history=2, max_spans=2)
+        for job_id in ("a", "b", "c"):
+            self.assertTrue(tracer.begin(job_id))
+        tracer.span("a", "fetch", 0.25, page=1)
+        tracer.span("a", "clone", 0.0, entries=15)
+        tracer.span("a", "deliver", 0.5)
+        self.assertEqual(tracer.traces()[0]["status"], "running")
+        for job_id in ("a", "b", "c"):
+            tracer.end(job_id, "done")
+
+        # only the last two are kept
+        self.assertIsNone(tracer.trace("a"))
+        self.assertEqual([t["transaction"] for t in tracer.traces()], ["c", "b"])
+
+        tracer = Tracer(1, max_spans=2)
+        tracer.begin("a")
+        tracer.span("a", "fetch", 0.25, page=1)
+        tracer.span("a", "clone", 0.0, entries=15)
+        tracer.span("a", "deliver", 0.5)
+        tracer.end("a", "failed")
+        trace = tracer.trace("a")
+        self.assertEqual(trace["status"], "failed")
+        self.assertEqual(trace["dropped"], 1)
+        fetch, clone = trace["spans"]
+        self.assertEqual((fetch["name"], fetch["page"], fetch["seconds"]), ("fetch", 1, 0.25))
+        self.assertLessEqual(fetch["start"], clone["start"])
+        self.assertEqual(clone["entries"], 15)
+
+    def test_scheduled_jobs_are_traced(self):
+        tracer = Tracer(1)
+        scheduler = JobScheduler(workers=1)
+        done = threading.Event()
+        with patch("py_de_id.jobs.tracer", tracer):
+            scheduler.submit("job", "a", done.set)
+            done.wait(5)
+            self.assertTrue(scheduler.drain(5))
+        trace = tracer.trace("job")
+        self.assertEqual(trace["status"], "done")
+        self.assertEqual(trace["spans"][0]["name"], "queued")
+
+
+class Loud(object):
+    formatted = 0
+
+    def __str__(self):
+        Loud.formatted += 1
+        return "loud"
+
+
+class TestDebugLogging(unittest.TestCase):
+    @patch("py_de_id.logs.cherrypy")
+    def test_formatted_only_when_enabled(self, mock_cherrypy):
+        mock_cherrypy.log.error_log.isEnabledFor.return_value = False
+        debug("%s: %s", "job", Loud())
+        self.assertEqual(Loud.formatted, 0)
+        mock_cherrypy.log.assert_not_called()
+
+        mock_cherrypy.log.error_log.isEnabledFor.return_value = True
+        debug("%s: %s", "job", Loud())
+        self.assertEqual(Loud.formatted, 1)
+        mock_cherrypy.log.assert_called_once_with("job: loud", severity=logging.DEBUG)
+
+    def test_redacted(self):
+        data = {"source_token": "s", "target_token": "t", "fhir_source": "http://source/"}
+        self.assertEqual(redacted(data), {"fhir_source": "http://source/"})
+
+
+if __name__ == "__main__":
+    unittest.main()